@@ -1561,8 +1561,9 @@ def accession_file(f, keypair, server, dryrun, force):
 
     local_fname = dx.name
     logger.info("Downloading %s" %(local_fname))
-    dxpy.download_dxfile(dx.get_id(),local_fname)
-    f.update({'md5sum': common.md5(local_fname)})
+    # hash on the way down rather than reading the file back
+    downloaded = common.stream_dxfile(dx, local_fname)
+    f.update({'md5sum': downloaded['md5sum']})
     f['notes'] = json.dumps(f.get('notes'))
 
     #check to see if md5 already in the database
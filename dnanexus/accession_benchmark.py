@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+'''Offline benchmark of download, md5 and upload for accessioning'''
+
+import os, sys, time, shutil, subprocess, tempfile, logging
+import common
+
+EPILOG = '''Notes:
+	Stands in a local file for the DNAnexus file and a local directory for
+	the S3 bucket, so no credentials or network are needed.  --bandwidth
+	throttles reads from the stand-in platform, in MB/s.
+
+Examples:
+
+	%(prog)s --size 2048
+	%(prog)s --infile ENCFF000XUL.bam --bandwidth 200
+'''
+
+logger = logging.getLogger(__name__)
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser(
+		description=__doc__, epilog=EPILOG,
+		formatter_class=argparse.RawDescriptionHelpFormatter)
+
+	parser.add_argument('--infile', help="File to stand in for the DNAnexus file", default=None)
+	parser.add_argument('--size', help="MB of random data to make if no infile", type=int, default=512)
+	parser.add_argument('--bandwidth', help="Throttle platform reads to this many MB/s", type=float, default=None)
+	parser.add_argument('--workdir', help="Scratch directory", default=None)
+	parser.add_argument('--debug', help="Print debug messages", default=False, action='store_true')
+	args = parser.parse_args()
+
+	if args.debug:
+		logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+	else:
+		logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+	return args
+
+class LocalDXFile(object):
+	# enough of dxpy.DXFile for dxpy.download_dxfile-style copies and stream_dxfile
+	def __init__(self, path, bandwidth=None):
+		self.path = path
+		self.name = os.path.basename(path)
+		self.bandwidth = bandwidth
+		self.fh = None
+
+	def get_id(self):
+		return 'file-%s' %(self.name)
+
+	def read(self, size):
+		if self.fh is None:
+			self.fh = open(self.path, 'rb')
+		start = time.time()
+		chunk = self.fh.read(size)
+		if self.bandwidth:
+			delay = len(chunk)/(self.bandwidth*1024*1024) - (time.time() - start)
+			if delay > 0:
+				time.sleep(delay)
+		if not chunk:
+			self.fh.close()
+			self.fh = None
+		return chunk
+
+class LocalObjectStore(object):
+	# a directory standing in for the bucket behind upload_credentials
+	def __init__(self, dirname):
+		self.dirname = dirname
+
+	def put(self, fname, key):
+		# like aws s3 cp, reads the local file end to end
+		with open(fname, 'rb') as infh, self.open(key) as outfh:
+			shutil.copyfileobj(infh, outfh, 16*1024*1024)
+
+	def open(self, key):
+		return open(os.path.join(self.dirname, key), 'wb')
+
+def download(dx, fname):
+	with open(fname, 'wb') as fh:
+		for chunk in iter(lambda: dx.read(16*1024*1024), ''):
+			fh.write(chunk)
+
+def md5sum(fname):
+	# what accession_file used to shell out to
+	return subprocess.check_output(['md5sum', fname]).partition(' ')[0]
+
+def three_pass(dx, store, fname):
+	download(dx, fname)
+	md5 = md5sum(fname)
+	store.put(fname, 'three_pass')
+	return md5
+
+def two_pass(dx, store, fname):
+	# the accession_file path, the upload needs the md5 before it can start
+	md5 = common.stream_dxfile(dx, fname)['md5sum']
+	store.put(fname, 'two_pass')
+	return md5
+
+def one_pass(dx, store, fname):
+	# for destinations that are known before the md5 is
+	with store.open('one_pass') as sink:
+		md5 = common.stream_dxfile(dx, fname, sinks=[sink])['md5sum']
+	return md5
+
+def main():
+	args = get_args()
+	workdir = tempfile.mkdtemp(dir=args.workdir)
+	try:
+		if args.infile:
+			infile = args.infile
+		else:
+			infile = os.path.join(workdir, 'platform.dat')
+			with open(infile, 'wb') as fh:
+				for i in range(args.size):
+					fh.write(os.urandom(1024*1024))
+		store_dir = os.path.join(workdir, 'bucket')
+		os.mkdir(store_dir)
+		store = LocalObjectStore(store_dir)
+		size_mb = os.path.getsize(infile)/(1024.0*1024)
+
+		md5s = set()
+		for method in [three_pass, two_pass, one_pass]:
+			fname = os.path.join(workdir, method.__name__)
+			start = time.time()
+			md5s.add(method(LocalDXFile(infile, args.bandwidth), store, fname))
+			duration = time.time() - start
+			print "%s\t%.2f s\t%.1f MB/s" %(method.__name__, duration, size_mb/duration)
+			os.remove(fname)
+		if len(md5s) != 1:
+			logger.error("md5 mismatch: %s" %(md5s))
+			sys.exit(1)
+	finally:
+		shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+	main()
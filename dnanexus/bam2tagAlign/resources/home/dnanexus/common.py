@@ -0,0 +1,2557 @@
+#!/usr/bin/env python
+
+import sys, os, subprocess, shlex, logging, re, urlparse, struct, collections, contextlib, math
+import dateutil.parser
+from time import sleep
+
+def test():
+    print "In common.test"
+
+
+def flat(l):
+    result = []
+    for el in l:
+        if hasattr(el, "__iter__") and not isinstance(el, basestring):
+            result.extend(flat(el))
+        else:
+            result.append(el)
+    return result
+
+def rstrips(string, substring):
+    if not string.endswith(substring):
+        return string
+    else:
+        return string[:len(string)-len(substring)]
+
+def touch(fname, times=None):
+    with open(fname, 'a'):
+        os.utime(fname, times)
+
+def block_on(command):
+    process = subprocess.Popen(shlex.split(command), stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+    for line in iter(process.stdout.readline, ''):
+        sys.stdout.write(line)
+    process.wait()
+    return process.returncode
+
+def run_pipe(steps, outfile=None):
+    #break this out into a recursive function
+    #TODO:  capture stderr
+    from subprocess import Popen, PIPE
+    p = None
+    p_next = None
+    first_step_n = 1
+    last_step_n = len(steps)
+    for n,step in enumerate(steps, start=first_step_n):
+        print "step %d: %s" %(n,step)
+        if n == first_step_n:
+            if n == last_step_n and outfile: #one-step pipeline with outfile
+                with open(outfile, 'w') as fh:
+                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
+                    p = Popen(shlex.split(step), stdout=fh)
+                break
+            print "first step shlex to stdout: %s" %(shlex.split(step))
+            p = Popen(shlex.split(step), stdout=PIPE)
+            #need to close p.stdout here?
+        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
+            with open(outfile, 'w') as fh:
+                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
+                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
+                p.stdout.close()
+                p = p_last
+        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
+            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
+            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
+            p.stdout.close()
+            p = p_next
+    out,err = p.communicate()
+    return out,err
+
+def _restore_sigpipe():
+    # python ignores SIGPIPE and children inherit that, so a producer whose
+    # consumer exits early would spin on EPIPE instead of terminating
+    import signal
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+def _pump(src_fd, dsts, bufsize=1024*1024):
+    # copy one producer's stdout to every consumer - tee to pipes rather than to disk
+    live = list(dsts)
+    while live:
+        chunk = os.read(src_fd, bufsize)
+        if not chunk:
+            break
+        for dst in list(live):
+            try:
+                dst.write(chunk)
+            except IOError:
+                # consumer went away, its returncode will tell the story
+                live.remove(dst)
+                dst.close()
+    os.close(src_fd)
+    for dst in live:
+        try:
+            dst.close()
+        except IOError:
+            pass
+
+def _drain(fh, chunks):
+    for chunk in iter(lambda: fh.read(1024*1024), ''):
+        chunks.append(chunk)
+    fh.close()
+
+def _run_callable(step, infh, outfh, results):
+    import traceback
+    try:
+        step['command'](infh, outfh)
+    except Exception:
+        results[step['name']] = (1, traceback.format_exc())
+    else:
+        results[step['name']] = (0, '')
+    finally:
+        for fh in [infh, outfh]:
+            if fh is not None:
+                try:
+                    fh.close()
+                except IOError:
+                    pass
+
+def run_dag(steps, check=True):
+    '''
+    Run a small DAG of commands connected by in-memory pipes.
+
+    steps is a list of dicts, each with:
+        name     unique step name
+        command  command line (run without a shell), or a python callable
+                 that is called as command(infh, outfh) in its own thread
+        input    optional name of the step whose stdout feeds this step,
+                 or the name of a local file
+        outfile  optional filename for this step's stdout
+
+    A step whose stdout feeds several steps is fanned out by a pump thread,
+    so one read of the producer serves every consumer.  stdout of sink steps
+    with no outfile is captured, stderr is captured for every step.
+    With check=True a non-zero exit from any step raises CalledProcessError
+    (pipefail).  Returns (out, err), dicts keyed by step name.
+    '''
+    import threading
+
+    by_name = dict((step['name'], step) for step in steps)
+    if len(by_name) != len(steps):
+        raise ValueError('run_dag step names must be unique')
+    consumers = dict((step['name'], []) for step in steps)
+    for step in steps:
+        if step.get('input') in by_name:
+            consumers[step['input']].append(step['name'])
+    for step in steps:
+        seen = set()
+        name = step['name']
+        while name in by_name:
+            if name in seen:
+                raise ValueError('run_dag steps form a cycle at %s' %(name))
+            seen.add(name)
+            name = by_name[name].get('input')
+
+    stdin_fds = {}
+    stdout_fds = {}
+    threads = []
+    outputs = {}
+    for step in steps:
+        name = step['name']
+        if step.get('outfile'):
+            if consumers[name]:
+                raise ValueError('run_dag step %s has both an outfile and consumers' %(name))
+            stdout_fds[name] = os.open(step['outfile'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        elif not consumers[name]:
+            r, w = os.pipe()
+            outputs[name] = []
+            threads.append(threading.Thread(target=_drain, args=(os.fdopen(r, 'rb'), outputs[name])))
+            stdout_fds[name] = w
+        elif len(consumers[name]) == 1:
+            r, w = os.pipe()
+            stdin_fds[consumers[name][0]] = r
+            stdout_fds[name] = w
+        else:
+            r, w = os.pipe()
+            stdout_fds[name] = w
+            dsts = []
+            for consumer in consumers[name]:
+                cr, cw = os.pipe()
+                stdin_fds[consumer] = cr
+                dsts.append(os.fdopen(cw, 'wb'))
+            threads.append(threading.Thread(target=_pump, args=(r, dsts)))
+        if step.get('input') and step['input'] not in by_name:
+            stdin_fds[name] = os.open(step['input'], os.O_RDONLY)
+
+    processes = {}
+    callable_results = {}
+    stderr_chunks = {}
+    for step in steps:
+        name = step['name']
+        stdin = stdin_fds.get(name)
+        stdout = stdout_fds[name]
+        if callable(step['command']):
+            print "step %s: %s" %(name, getattr(step['command'], '__name__', step['command']))
+            infh = os.fdopen(stdin, 'rb') if stdin is not None else None
+            outfh = os.fdopen(stdout, 'wb')
+            threads.append(threading.Thread(target=_run_callable, args=(step, infh, outfh, callable_results)))
+        else:
+            print "step %s: %s" %(name, step['command'])
+            p = subprocess.Popen(shlex.split(step['command']), stdin=stdin, stdout=stdout,
+                                 stderr=subprocess.PIPE, close_fds=True, preexec_fn=_restore_sigpipe)
+            processes[name] = p
+            stderr_chunks[name] = []
+            threads.append(threading.Thread(target=_drain, args=(p.stderr, stderr_chunks[name])))
+            # the child has its own copies now
+            if stdin is not None:
+                os.close(stdin)
+            os.close(stdout)
+
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for name, p in processes.iteritems():
+        p.wait()
+    for t in threads:
+        t.join()
+
+    out = dict((name, ''.join(chunks)) for name, chunks in outputs.iteritems())
+    err = {}
+    failed = []
+    for step in steps:
+        name = step['name']
+        if name in processes:
+            returncode = processes[name].returncode
+            err[name] = ''.join(stderr_chunks[name])
+        else:
+            returncode, err[name] = callable_results.get(name, (1, 'did not run'))
+        if returncode != 0:
+            logging.error("step %s exited with %s: %s" %(name, returncode, err[name]))
+            failed.append((name, returncode))
+    if check and failed:
+        name, returncode = failed[0]
+        command = by_name[name]['command']
+        raise subprocess.CalledProcessError(returncode, getattr(command, '__name__', command))
+    return out, err
+
+GZIP_BLOCK_SIZE = 1024*1024
+# htslib's BGZF_BLOCK_SIZE, which leaves room in BSIZE for incompressible data
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+def _read_blocks(fh, size):
+    for block in iter(lambda: fh.read(size), ''):
+        yield block
+
+def _parallel_map(func, blocks, threads):
+    # ordered map with a bounded number of blocks in flight - zlib releases
+    # the GIL, so threads are enough to keep every core busy
+    from multiprocessing.pool import ThreadPool
+    from collections import deque
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for block in blocks:
+            pending.append(pool.apply_async(func, (block,)))
+            if len(pending) >= 2*threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+def _gzip_member(block, level=6):
+    # a complete gzip member, and gzip members concatenate
+    import zlib
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(block) + c.flush()
+
+def _bgzf_block(block, level=6):
+    import zlib, struct
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = c.compress(block) + c.flush()
+    # 18 byte header with the BC subfield, BSIZE is the whole block size - 1
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(cdata) + 25)
+    trailer = struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+    return header + cdata + trailer
+
+def _bgzf_blocks(fh, rest):
+    # whole BGZF blocks, until the first member that doesn't say how long it is
+    import struct
+    while True:
+        header = fh.read(18)
+        if len(header) == 18 and header[:4] == '\x1f\x8b\x08\x04' and header[10:16] == '\x06\x00BC\x02\x00':
+            bsize = struct.unpack('<H', header[16:18])[0] + 1
+            yield header + fh.read(bsize - 18)
+        else:
+            rest.append(header)
+            return
+
+def _inflate_bgzf_block(block):
+    import zlib, struct
+    data = zlib.decompress(block[18:-8], -zlib.MAX_WBITS)
+    crc, isize = struct.unpack('<II', block[-8:])
+    if zlib.crc32(data) & 0xffffffff != crc or len(data) != isize:
+        raise IOError("BGZF block failed CRC check")
+    return data
+
+class _GunzipWriter(object):
+    # file-like sink that inflates gzip written to it, member after member
+    def __init__(self, outfh):
+        import zlib
+        self.outfh = outfh
+        self.decompressobj = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.d = self.decompressobj()
+        # whether the current member has had any input yet
+        self.needs_input = True
+
+    def write(self, chunk):
+        while chunk:
+            self.outfh.write(self.d.decompress(chunk))
+            self.needs_input = False
+            # the next member starts in unused_data
+            chunk = self.d.unused_data
+            if chunk:
+                self.outfh.write(self.d.flush())
+                self.d = self.decompressobj()
+                self.needs_input = True
+
+    def close(self):
+        import zlib
+        if not self.needs_input:
+            # zlib only moves input to unused_data once the member's trailer
+            # has been read, so a byte past a complete member lands there.
+            # Python 2 has no decompressobj.eof to ask instead, and this has
+            # to be before flush, which ends a complete member's stream.
+            try:
+                self.d.decompress('\0')
+                eof = bool(self.d.unused_data)
+            except zlib.error:
+                eof = False
+            if not eof:
+                raise IOError("gzip stream is truncated")
+        self.outfh.write(self.d.flush())
+
+def _gunzip_stream(head, fh, outfh):
+    import itertools
+    w = _GunzipWriter(outfh)
+    for chunk in itertools.chain([head], _read_blocks(fh, GZIP_BLOCK_SIZE)):
+        w.write(chunk)
+    w.close()
+
+def pgzip(infh, outfh, threads=None, level=6, bgzf=False, eof=True):
+    '''
+    gzip infh to outfh, compressing independent blocks on all cores.
+
+    The output is multi-member gzip, or BGZF if bgzf is True, either of
+    which gzip -dc reads like any other gzip file.  With eof False BGZF
+    output has no end-of-file block, so it can be concatenated with more
+    BGZF blocks.  Takes (infh, outfh) so it can be a run_dag step.
+    '''
+    import functools
+    from multiprocessing import cpu_count
+    threads = threads or cpu_count()
+    if bgzf:
+        func, size = functools.partial(_bgzf_block, level=level), BGZF_BLOCK_SIZE
+    else:
+        func, size = functools.partial(_gzip_member, level=level), GZIP_BLOCK_SIZE
+    empty = True
+    for member in _parallel_map(func, _read_blocks(infh, size), threads):
+        outfh.write(member)
+        empty = False
+    if bgzf:
+        if eof:
+            outfh.write(BGZF_EOF)
+    elif empty:
+        outfh.write(func(''))
+
+def pgunzip(infh, outfh, threads=None):
+    '''
+    gunzip infh to outfh.  BGZF blocks are inflated on all cores, anything
+    else (including plain multi-member gzip) is inflated as one stream.
+    '''
+    from multiprocessing import cpu_count
+    threads = threads or cpu_count()
+    rest = []
+    for data in _parallel_map(_inflate_bgzf_block, _bgzf_blocks(infh, rest), threads):
+        outfh.write(data)
+    _gunzip_stream(rest[0], infh, outfh)
+
+def uncompress(filename, threads=None):
+    #leaves compressed file intact
+    m = re.match('(.*)(\.((gz)|(Z)|(bz)|(bz2)))',filename)
+    if m:
+        basename = m.group(1)
+        logging.info(subprocess.check_output(shlex.split('ls -l %s' %(filename))))
+        logging.info("Decompressing %s" %(filename))
+        if is_gzipped(filename):
+            with open(filename, 'rb') as infh, open(basename, 'wb') as outfh:
+                pgunzip(infh, outfh, threads)
+        else:
+            out,err = run_pipe([
+                'gzip -dc %s' %(filename)],
+                basename)
+        logging.info(subprocess.check_output(shlex.split('ls -l %s' %(basename))))
+        return basename
+    else:
+        return filename
+
+def compress(filename, threads=None, bgzf=False):
+    #leaves uncompressed file intact
+    if re.match('(.*)(\.((gz)|(Z)|(bz)|(bz2)))',filename):
+        return filename
+    else:
+        logging.info(subprocess.check_output(shlex.split('ls -l %s' %(filename))))
+        logging.info("Compressing %s" %(filename))
+        new_filename = filename + '.gz'
+        with open(filename, 'rb') as infh, open(new_filename, 'wb') as outfh:
+            pgzip(infh, outfh, threads, bgzf=bgzf)
+        logging.info(subprocess.check_output(shlex.split('ls -l %s' %(new_filename))))
+        return new_filename
+
+def compress_to(infh, filename, threads=None, errors=None, level=6):
+    '''
+    pgzip infh to the file filename, then close infh, as the target of a
+    thread compressing what another writes into a pipe.  An exception is
+    appended to errors, for the writer to raise once the thread is joined.
+    '''
+    try:
+        with open(filename, 'wb') as outfh:
+            pgzip(infh, outfh, threads, level=level)
+    except Exception as e:
+        if errors is None:
+            raise
+        errors.append(e)
+    finally:
+        infh.close()
+
+def is_gzipped(fname):
+    with open(fname, 'rb') as fh:
+        return fh.read(2) == b'\x1f\x8b'
+
+def _counts_sidecar(fname):
+    return fname + '.counts.json'
+
+def recorded_line_count(fname, dxfile=None):
+    import json
+    # counts recorded as properties when the file was uploaded are good for
+    # as long as the object's size agrees, since closed files are immutable
+    if dxfile is not None:
+        import dxpy
+        if not isinstance(dxfile, dxpy.DXFile):
+            dxfile = dxpy.DXFile(dxfile)
+        desc = dxfile.describe(incl_properties=True)
+        properties = desc.get('properties') or {}
+        if 'line_count' in properties and properties.get('file_size') == str(desc.get('size')):
+            logging.info("%s: using recorded line count %s" %(desc.get('name'), properties['line_count']))
+            return int(properties['line_count'])
+    # the local sidecar is good for as long as the file is unchanged
+    sidecar_fn = _counts_sidecar(fname)
+    if os.path.isfile(sidecar_fn):
+        with open(sidecar_fn, 'r') as fh:
+            counts = json.load(fh)
+        stat = os.stat(fname)
+        if counts.get('file_size') == stat.st_size and counts.get('mtime') == stat.st_mtime:
+            return counts['line_count']
+    return None
+
+def count_lines(fname, dxfile=None):
+    '''
+    Number of lines in fname, which may be gzipped.
+
+    A count recorded by record_counts, as properties of dxfile or in the
+    local sidecar next to fname, is used if it still matches the file.
+    Otherwise the lines are counted and the sidecar written.
+    '''
+    line_count = recorded_line_count(fname, dxfile)
+    if line_count is not None:
+        return line_count
+    if is_gzipped(fname):
+        out, err = run_pipe([
+            'gzip -dc %s' %(fname),
+            'wc -l'])
+        line_count = int(out.split()[0])
+    else:
+        wc_output = subprocess.check_output(shlex.split('wc -l %s' %(fname)))
+        line_count = int(wc_output.split()[0])
+    record_counts(fname, line_count)
+    return line_count
+
+def record_counts(fname, line_count=None, sort_order=None):
+    '''
+    Record the line count, size and sort order of fname in a local sidecar
+    and return them as DNAnexus file properties to upload fname with, so
+    that downstream applets need not decompress it just to count it.
+    sort_order is free text, like coordinate, unsorted or -k8gr,8gr
+    '''
+    import json
+    if line_count is None:
+        line_count = count_lines(fname)
+    stat = os.stat(fname)
+    with open(_counts_sidecar(fname), 'w') as fh:
+        json.dump({'line_count': line_count, 'file_size': stat.st_size, 'mtime': stat.st_mtime}, fh)
+    return {
+        'line_count': str(line_count),
+        'file_size': str(stat.st_size),
+        'sort_order': sort_order or 'unknown'
+    }
+
+def bed2bb(bed_filename, chrom_sizes, as_file, bed_type='bed6+4'):
+    if bed_filename.endswith('.bed'):
+        bb_filename = bed_filename[:-4] + '.bb'
+    else:
+        bb_filename = bed_filename + '.bb'
+    bed_filename_sorted = bed_filename + ".sorted"
+
+    logging.debug("In bed2bb with bed_filename=%s, chrom_sizes=%s, as_file=%s" %(bed_filename, chrom_sizes, as_file))
+
+    print "Sorting"
+    print subprocess.check_output(shlex.split("sort -k1,1 -k2,2n -o %s %s" %(bed_filename_sorted, bed_filename)), shell=False, stderr=subprocess.STDOUT)
+
+    for fn in [bed_filename, bed_filename_sorted, chrom_sizes, as_file]:
+        print "head %s" %(fn)
+        print subprocess.check_output('head %s' %(fn), shell=True, stderr=subprocess.STDOUT)
+
+    command = "bedToBigBed -type=%s -as=%s %s %s %s" %(bed_type, as_file, bed_filename_sorted, chrom_sizes, bb_filename)
+    print command
+    try:
+        process = subprocess.Popen(shlex.split(command), stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        for line in iter(process.stdout.readline, ''):
+            sys.stdout.write(line)
+        process.wait()
+        returncode = process.returncode
+        if returncode != 0:
+            raise subprocess.CalledProcessError
+    except:
+        e = sys.exc_info()[0]
+        sys.stderr.write('%s: bedToBigBed failed. Skipping bb creation.' %(e))
+        return None
+
+    #print subprocess.check_output('ls -l', shell=True, stderr=subprocess.STDOUT)
+
+    #this is necessary in case bedToBegBed failes to create the bb file but doesn't return a non-zero returncode
+    try:
+        os.remove(bed_filename_sorted)
+    except:
+        pass
+    if not os.path.isfile(bb_filename):
+        bb_filename = None
+
+    print "Returning bb file %s" %(bb_filename)
+    return bb_filename
+
+def _line_chunks(fh, chunk_size=100000):
+    # non-blank lines, without newlines, in lists of up to chunk_size
+    chunk = []
+    for line in fh:
+        line = line.rstrip('\n')
+        if not line.strip():
+            continue
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def rescale_scores(fn, scores_col, new_min=10, new_max=1000, sort_col=None, name_peaks=False, rescaled_fn=None):
+    '''
+    Linearly rescale column scores_col of a peak file into new_min..new_max.
+
+    The first pass finds the score range, the second rewrites the scores.
+    With sort_col the rewritten lines go through sort -k <sort_col>gr,
+    which spills to disk rather than holding the peaks in memory, and with
+    name_peaks column 4 is replaced by Peak_<rank> on the way out.
+    '''
+    import numpy as np
+
+    if not rescaled_fn:
+        rescaled_fn = '%s-rescaled' %(fn)
+    score_i = scores_col - 1
+
+    min_score = None
+    max_score = None
+    with open(fn, 'r') as fh:
+        for lines in _line_chunks(fh):
+            scores = np.array([line.split('\t')[score_i] for line in lines], dtype=float)
+            if min_score is None:
+                min_score, max_score = scores.min(), scores.max()
+            else:
+                min_score, max_score = min(min_score, scores.min()), max(max_score, scores.max())
+    if min_score is None:
+        # nothing to rescale
+        open(rescaled_fn, 'w').close()
+        return rescaled_fn
+
+    # same integer truncation as the awk this replaces
+    a = int(min_score)
+    b = int(max_score)
+    x = new_min
+    y = new_max
+    logging.info("Rescaling %s column %d from %d-%d to %d-%d" %(fn, scores_col, a, b, x, y))
+
+    def rescaled_lines(lines):
+        scores = np.array([line.split('\t')[score_i] for line in lines], dtype=float)
+        if b == a:
+            new_scores = np.repeat(y, len(scores))
+        else:
+            new_scores = np.trunc(((scores - a)*(y - x)/float(b - a)) + x).astype(int)
+        for line, new_score in zip(lines, new_scores):
+            fields = line.split('\t')
+            fields[score_i] = str(new_score)
+            yield fields
+
+    with open(fn, 'r') as fh, open(rescaled_fn, 'w') as out_fh:
+        if sort_col:
+            # sort reads all its input before writing any, so feeding it
+            # everything and then reading it back cannot deadlock
+            sorter = subprocess.Popen(['sort', '-k', '%dgr,%dgr' %(sort_col, sort_col)],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=-1)
+            for lines in _line_chunks(fh):
+                sorter.stdin.writelines('\t'.join(fields) + '\n' for fields in rescaled_lines(lines))
+            sorter.stdin.close()
+            for rank, line in enumerate(sorter.stdout, start=1):
+                if name_peaks:
+                    fields = line.split('\t')
+                    fields[3] = 'Peak_%d' %(rank)
+                    line = '\t'.join(fields)
+                out_fh.write(line)
+            sorter.stdout.close()
+            if sorter.wait():
+                raise subprocess.CalledProcessError(sorter.returncode, 'sort -k %dgr,%dgr' %(sort_col, sort_col))
+        else:
+            rank = 0
+            for lines in _line_chunks(fh):
+                for fields in rescaled_lines(lines):
+                    rank += 1
+                    if name_peaks:
+                        fields[3] = 'Peak_%d' %(rank)
+                    out_fh.write('\t'.join(fields) + '\n')
+    return rescaled_fn
+
+
+def slop_clip(filename, chrom_sizes):
+    clipped_fn = '%s-clipped' % (filename)
+    # Remove coordinates outside chromosome sizes
+    pipe = ['slopBed -i %s -g %s -b 0' % (filename, chrom_sizes),
+            'bedClip stdin %s %s' % (chrom_sizes, clipped_fn)]
+    print pipe
+    out, err = run_pipe(pipe)
+    return clipped_fn
+
+
+def _open_text(fname):
+    # a line iterator over fname, decompressing it in another process if need be
+    if is_gzipped(fname):
+        return subprocess.Popen(['gzip', '-dc', fname], stdout=subprocess.PIPE, bufsize=-1).stdout
+    return open(fname, 'r')
+
+def read_peaks(fname):
+    # the non-blank lines of the peak file fname, which may be gzipped
+    fh = _open_text(fname)
+    try:
+        return [line if line.endswith('\n') else line + '\n' for line in fh if line.strip()]
+    finally:
+        fh.close()
+
+def index_intervals(chroms, starts, ends):
+    '''
+    Index intervals by chromosome, as a dict of (starts, ends, positions)
+    arrays sorted by start, positions being where each interval was in
+    the arrays given.  Intervals that start together keep their order.
+    '''
+    import numpy as np
+    chroms = np.asarray(chroms, dtype=str)
+    order = np.lexsort((starts, chroms))
+    chroms, starts, ends = chroms[order], np.asarray(starts)[order], np.asarray(ends)[order]
+    bounds = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+    index = {}
+    for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(order)]):
+        if hi > lo:
+            index[chroms[lo]] = (starts[lo:hi], ends[lo:hi], order[lo:hi])
+    return index
+
+def _peak_columns(lines):
+    # chromosome, start and end of each peak line
+    import numpy as np
+    fields = [line.split('\t', 3) for line in lines]
+    chroms = np.array([f[0] for f in fields], dtype=str)
+    starts = np.array([int(f[1]) for f in fields], dtype=np.int64)
+    ends = np.array([int(f[2]) for f in fields], dtype=np.int64)
+    return chroms, starts, ends
+
+def index_peaks(lines):
+    # index_intervals() of peak lines, by line number
+    return index_intervals(*_peak_columns(lines))
+
+def overlap_pairs(a_starts, a_ends, b_starts, b_ends):
+    '''
+    Every pair of intervals from a and b, on the same chromosome and b
+    sorted by start, that share at least a base.  Returns index arrays
+    into a and into b, in order of a then b, and the overlap lengths.
+    '''
+    import numpy as np
+    # b intervals starting before a ends, and late enough that even the
+    # longest of them could reach a's start, are candidates
+    longest = (b_ends - b_starts).max()
+    lo = np.searchsorted(b_starts, a_starts - longest, 'right')
+    hi = np.searchsorted(b_starts, a_ends, 'left')
+    n = np.maximum(hi - lo, 0)
+    a_i = np.repeat(np.arange(len(a_starts)), n)
+    b_i = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n - lo, n)
+    overlap = np.minimum(a_ends[a_i], b_ends[b_i]) - np.maximum(a_starts[a_i], b_starts[b_i])
+    found = overlap > 0
+    return a_i[found], b_i[found], overlap[found]
+
+def index_overlaps(index, other_index):
+    '''
+    overlap_pairs() of every chromosome of two indexes, as arrays of
+    positions in index, positions in other_index and overlap lengths.
+    '''
+    import numpy as np
+    pairs = []
+    for chrom, (starts, ends, positions) in index.items():
+        if chrom not in other_index:
+            continue
+        other_starts, other_ends, other_positions = other_index[chrom]
+        a_i, b_i, overlap = overlap_pairs(starts, ends, other_starts, other_ends)
+        pairs.append((positions[a_i], other_positions[b_i], overlap,
+                      ends[a_i] - starts[a_i], other_ends[b_i] - other_starts[b_i]))
+    if not pairs:
+        return [np.zeros(0, dtype=np.int64)]*5
+    return [np.concatenate(column) for column in zip(*pairs)]
+
+def peaks_supported(index, npeaks, other_index, min_overlap=0.5):
+    '''
+    Which of the npeaks peaks of index overlap a peak of other_index by at
+    least min_overlap of the length of either of them, as a boolean array
+    by position.  A min_overlap of 0 takes any overlap.
+    '''
+    import numpy as np
+    found = np.zeros(npeaks, dtype=bool)
+    a, b, overlap, a_lengths, b_lengths = index_overlaps(index, other_index)
+    enough = (overlap >= min_overlap*a_lengths) | (overlap >= min_overlap*b_lengths)
+    found[a[enough]] = True
+    return found
+
+_LEADING_NUMBER = re.compile(r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+def _leading_number(s):
+    # the number s starts with, or 0, as awk and sort -n read it
+    m = _LEADING_NUMBER.match(s)
+    return float(m.group(0)) if m else 0.0
+
+def _idr_peak_key(line):
+    # sort -k7n,7n -k1,1 -k2n,2n -k3n,3n -k10n,10n, ties falling back to
+    # the whole line as sort does
+    line = line.rstrip('\n')
+    f = line.split('\t')
+    return (_leading_number(f[6]), f[0], _leading_number(f[1]), _leading_number(f[2]),
+            _leading_number(f[9]), line)
+
+def idr_common_peaks(pooled_lines, reps_lines):
+    '''
+    The pooled narrowPeak lines that overlap a peak of every replicate, in
+    IDR v1's order: by signal, then position and summit.
+    '''
+    import numpy as np
+    pooled_index = index_peaks(pooled_lines)
+    common = np.ones(len(pooled_lines), dtype=bool)
+    for rep_lines in reps_lines:
+        common &= peaks_supported(pooled_index, len(pooled_lines), index_peaks(rep_lines), min_overlap=0)
+    return sorted([pooled_lines[i] for i in common.nonzero()[0]], key=_idr_peak_key)
+
+def _summits(lines, starts):
+    # absolute summit positions of narrowPeak lines
+    import numpy as np
+    return starts + np.array([int(line.split('\t')[9]) for line in lines], dtype=np.int64)
+
+def idr_match_summits(common_lines, rep_lines):
+    '''
+    IDR v1's input for a replicate: for each common pooled peak, its own
+    4 bp about the pooled summit with the signal, p and q values of the
+    overlapping replicate peak whose summit is nearest.  Consecutive
+    pooled peaks with the same position and summit give one line.
+    '''
+    import numpy as np
+    common_chroms, common_starts, common_ends = _peak_columns(common_lines)
+    rep_chroms, rep_starts, rep_ends = _peak_columns(rep_lines)
+    common_summits = _summits(common_lines, common_starts)
+    rep_summits = _summits(rep_lines, rep_starts)
+    a, b, overlap, a_lengths, b_lengths = index_overlaps(
+        index_intervals(common_chroms, common_starts, common_ends),
+        index_intervals(rep_chroms, rep_starts, rep_ends))
+    distance = np.abs(common_summits[a] - rep_summits[b])
+    # nearest first for each common peak, the first replicate peak of equals
+    order = np.lexsort((np.arange(len(a)), distance, a))
+    a, b = a[order], b[order]
+    first = np.r_[True, a[1:] != a[:-1]] if len(a) else np.zeros(0, dtype=bool)
+    nearest = np.empty(len(common_lines), dtype=np.int64)
+    nearest[a[first]] = b[first]
+
+    match_lines = []
+    previous = None
+    for i, line in enumerate(common_lines):
+        f = line.rstrip('\n').split('\t')
+        key = (f[0], f[1], f[2], f[9])
+        if key == previous:
+            continue
+        previous = key
+        r = rep_lines[nearest[i]].rstrip('\n').split('\t')
+        summit = common_summits[i]
+        match_lines.append('\t'.join([f[0], str(summit - 2), str(summit + 2), f[3], f[4], f[5], r[6], r[7], r[8], '2']) + '\n')
+    return match_lines
+
+def idr_match_peaks(pooled_peaks_fn, rep_peaks_fns, common_peaks_fn, common_match_fns):
+    '''
+    IDR v1's preprocessing, with each peak file read once: write the
+    pooled peaks common to all the replicates to common_peaks_fn and each
+    replicate's idr_match_summits() to common_match_fns.  Returns the
+    common pooled peak lines.
+    '''
+    pooled_lines = read_peaks(pooled_peaks_fn)
+    reps_lines = [read_peaks(fn) for fn in rep_peaks_fns]
+    common_lines = idr_common_peaks(pooled_lines, reps_lines)
+    with open(common_peaks_fn, 'w') as fh:
+        fh.writelines(common_lines)
+    for rep_lines, match_fn in zip(reps_lines, common_match_fns):
+        with open(match_fn, 'w') as fh:
+            fh.writelines(idr_match_summits(common_lines, rep_lines))
+    logging.info("%d of %d pooled peaks are common to the replicates" %(len(common_lines), len(pooled_lines)))
+    return common_lines
+
+def _general_number(s):
+    # sort -g: numbers in order after anything that is not one
+    try:
+        return (1, float(s))
+    except ValueError:
+        return (0, 0.0)
+
+def idr_overlapped_peaks(overlapped_fn, overlapped_peaks_fn):
+    '''
+    The R IDR's -overlapped-peaks.txt as narrowPeak, by global IDR:
+    the span of the pair, the rank, the two ranking measures and the
+    local and global IDR.  Returns the narrowPeak lines.
+    '''
+    with open(overlapped_fn) as fh:
+        lines = [line.replace('"', '').rstrip('\n') for line in fh][1:]
+    rows = sorted(((_general_number(line.split()[10]), line) for line in lines if line.strip()))
+    peaks = []
+    for n, (key, line) in enumerate(rows, start=1):
+        f = line.split()
+        start = min(_leading_number(f[2]), _leading_number(f[6]))
+        stop = max(_leading_number(f[3]), _leading_number(f[7]))
+        peaks.append("%s\t%d\t%d\t%d\t%s\t.\t%s\t%f\t%f\n"
+                     %(f[1], start, stop, n, f[4], f[8], _leading_number(f[9]), _leading_number(f[10])))
+    with open(overlapped_peaks_fn, 'w') as fh:
+        fh.writelines(peaks)
+    return peaks
+
+def idr_pooled_table(common_lines, overlapped_peaks, pooled_idr_fn):
+    '''
+    The common pooled peaks with the two ranking measures and the local
+    and global IDR of the overlapped peaks at their summits, written to
+    pooled_idr_fn.  Each pooled peak is taken from its summit - 2 to its
+    start + twice its summit offset, as the awk this replaces had it.
+    Returns the number of lines written.
+    '''
+    import numpy as np
+    chroms, starts, ends = _peak_columns(common_lines)
+    offsets = _summits(common_lines, starts) - starts
+    recalibrated_starts = starts + offsets - 2
+    a, b, overlap, a_lengths, b_lengths = index_overlaps(
+        index_intervals(chroms, recalibrated_starts, recalibrated_starts + offsets + 2),
+        index_peaks(overlapped_peaks))
+    order = np.lexsort((np.arange(len(a)), a))
+    n = 0
+    with open(pooled_idr_fn, 'w') as fh:
+        for i, j in zip(a[order], b[order]):
+            f = common_lines[i].rstrip('\n').split('\t')
+            o = overlapped_peaks[j].rstrip('\n').split('\t')
+            fh.write('\t'.join(f[:10] + [o[4], o[6], o[7], o[8]]) + '\n')
+            n += 1
+    return n
+
+# narrowPeak columns IDR v2 can rank on, and how it merges each over the
+# replicate peaks that fall in one pooled peak
+IDR2_RANK_COLUMNS = {'signal.value': 6, 'p.value': 7, 'q.value': 8}
+IDR2_MERGE = {'signal.value': 'sum', 'p.value': 'min', 'q.value': 'min'}
+# IDR v2's starting mu, sigma, rho and mixture proportion
+IDR2_INITIAL_PARAMS = (0.1, 1.0, 0.2, 0.05)
+
+def idr2_merge_peaks(pooled_lines, reps_lines, rank='signal.value'):
+    '''
+    Match replicate peaks to the pooled peaks as IDR v2 does with a peak
+    list: each replicate peak goes to the pooled peak it overlaps most,
+    and each pooled peak takes the sum (the minimum for p or q values) of
+    the ranking measure of its peaks in each replicate.  Returns the line
+    numbers of the pooled peaks found in every replicate and, for each
+    replicate, their merged measures, starts, ends and summits (those of
+    the replicate's strongest peak).
+    '''
+    import numpy as np
+    column = IDR2_RANK_COLUMNS[rank]
+    npooled = len(pooled_lines)
+    pooled_index = index_peaks(pooled_lines)
+    found = np.ones(npooled, dtype=bool)
+    merged = []
+    for rep_lines in reps_lines:
+        chroms, starts, ends = _peak_columns(rep_lines)
+        summits = _summits(rep_lines, starts)
+        measures = np.array([_leading_number(line.split('\t')[column]) for line in rep_lines])
+        a, b, overlap, a_lengths, b_lengths = index_overlaps(index_intervals(chroms, starts, ends), pooled_index)
+        # the most overlapped pooled peak for each replicate peak, the first of equals
+        order = np.lexsort((np.arange(len(a)), -overlap, a))
+        a, b = a[order], b[order]
+        first = np.r_[True, a[1:] != a[:-1]] if len(a) else np.zeros(0, dtype=bool)
+        a, b = a[first], b[first]
+        # the replicate peaks of each pooled peak together, in their order,
+        # to reduce with reduceat (ufunc.at and np.full need numpy 1.8, newer
+        # than the apt python-numpy the applets get)
+        order = np.argsort(b, kind='mergesort')
+        a, b = a[order], b[order]
+        groups = np.flatnonzero(np.r_[True, b[1:] != b[:-1]]) if len(b) else np.zeros(0, dtype=np.int64)
+        grouped = b[groups]
+        if IDR2_MERGE[rank] == 'sum':
+            measure = np.bincount(b, weights=measures[a], minlength=npooled)
+        else:
+            measure = np.empty(npooled)
+            measure.fill(np.inf)
+            if len(b):
+                measure[grouped] = np.minimum.reduceat(measures[a], groups)
+        merged_starts = np.empty(npooled, dtype=np.int64)
+        merged_starts.fill(np.iinfo(np.int64).max)
+        merged_ends = np.zeros(npooled, dtype=np.int64)
+        if len(b):
+            merged_starts[grouped] = np.minimum.reduceat(starts[a], groups)
+            merged_ends[grouped] = np.maximum.reduceat(ends[a], groups)
+        # the strongest peak's summit, written last
+        strongest = np.lexsort((measures[a], b))
+        merged_summits = np.zeros(npooled, dtype=np.int64)
+        merged_summits[b[strongest]] = summits[a[strongest]]
+        found &= np.bincount(b, minlength=npooled) > 0
+        merged.append((measure, merged_starts, merged_ends, merged_summits))
+    pooled = found.nonzero()[0]
+    return pooled, [tuple(column[pooled] for column in rep) for rep in merged]
+
+def _normal_cdf(x):
+    import numpy as np
+    return 0.5*(1 + np.vectorize(math.erf)(np.asarray(x, dtype=float)/math.sqrt(2)))
+
+def _mixture_quantiles(u, mu, sigma, p, npoints=2000):
+    # the inverse of the mixture p*N(mu, sigma^2) + (1-p)*N(0, 1) CDF at u,
+    # interpolated from a grid
+    import numpy as np
+    grid = np.linspace(min(-8.0, mu - 8*sigma), max(mu + 8*sigma, 8.0), npoints)
+    cdf = p*_normal_cdf((grid - mu)/sigma) + (1 - p)*_normal_cdf(grid)
+    return np.interp(u, cdf, grid)
+
+def _bivariate_normal_pdf(z1, z2, mu, sigma, rho):
+    import numpy as np
+    a = (z1 - mu)/sigma
+    b = (z2 - mu)/sigma
+    q = (a*a - 2*rho*a*b + b*b)/(1 - rho*rho)
+    return np.exp(-q/2)/(2*math.pi*sigma*sigma*math.sqrt(1 - rho*rho))
+
+def idr2_fit(ranks1, ranks2, params=IDR2_INITIAL_PARAMS, max_iter=3000, eps=1e-6):
+    '''
+    Fit IDR v2's copula mixture, of a reproducible Gaussian with mean mu,
+    sd sigma and correlation rho in proportion p and an independent
+    standard one, to two rank vectors by EM.  The pseudo-values the
+    Gaussians are fitted to are recomputed from the ranks with each new
+    estimate.  Returns (mu, sigma, rho, p), the number of iterations, the
+    log likelihood and the local IDR of each pair.
+    '''
+    import numpy as np
+    n = len(ranks1)
+    mu, sigma, rho, p = params
+    ranks1 = np.asarray(ranks1)
+    ranks2 = np.asarray(ranks2)
+    # both rank vectors are permutations of 0..n-1, so the pseudo-values
+    # are found once for each rank and looked up
+    levels = (np.arange(n) + 1.0)/(n + 1)
+    log_likelihood = None
+    for i in range(1, max_iter + 1):
+        pseudo_values = _mixture_quantiles(levels, mu, sigma, p)
+        z1 = pseudo_values[ranks1]
+        z2 = pseudo_values[ranks2]
+        signal = p*_bivariate_normal_pdf(z1, z2, mu, sigma, rho)
+        noise = (1 - p)*_bivariate_normal_pdf(z1, z2, 0.0, 1.0, 0.0)
+        total = signal + noise
+        previous, log_likelihood = log_likelihood, np.log(total).sum()
+        if previous is not None and abs(log_likelihood - previous) < eps:
+            break
+        w = signal/total
+        w_sum = w.sum()
+        p = min(max(w_sum/n, 1e-6), 1 - 1e-6)
+        mu = (w*(z1 + z2)).sum()/(2*w_sum)
+        d1 = z1 - mu
+        d2 = z2 - mu
+        squares = (w*(d1*d1 + d2*d2)).sum()
+        sigma = max(math.sqrt(squares/(2*w_sum)), 1e-6)
+        rho = min(max(2*(w*d1*d2).sum()/squares, -0.999), 0.999)
+    return (mu, sigma, rho, p), i, log_likelihood, noise/total
+
+def global_idr(local_idr):
+    # the mean local IDR of the pairs no less reproducible than each, pairs
+    # with equal local IDR all counting each other as the idr package's
+    # rankdata(method='max') does
+    import numpy as np
+    order = np.argsort(local_idr, kind='mergesort')
+    ordered = local_idr[order]
+    means = np.cumsum(ordered)/np.arange(1, len(ordered) + 1)
+    # the last of each run of equal values
+    last = np.flatnonzero(np.r_[ordered[1:] != ordered[:-1], True]) if len(ordered) else np.zeros(0, dtype=np.int64)
+    run = np.cumsum(np.r_[0, ordered[1:] != ordered[:-1]]) if len(ordered) else np.zeros(0, dtype=np.int64)
+    result = np.empty(len(local_idr))
+    result[order] = means[last[run]]
+    return result
+
+def _idr2_plot(ranks1, ranks2, idr, plot_fn, threshold=0.05):
+    # ranks coloured by whether they pass threshold, and -log10 IDR by rank
+    import numpy as np
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    passed = idr <= threshold
+    fig = plt.figure(figsize=(10, 5))
+    ax = fig.add_subplot(121)
+    ax.scatter(ranks1[~passed], ranks2[~passed], s=1, c='r', edgecolors='none')
+    ax.scatter(ranks1[passed], ranks2[passed], s=1, c='k', edgecolors='none')
+    ax.set_xlabel("Sample 1 rank")
+    ax.set_ylabel("Sample 2 rank")
+    ax.set_title("Ranks - (red <= %.2f IDR)" %(threshold))
+    ax = fig.add_subplot(122)
+    ax.scatter(ranks1, -np.log10(np.maximum(idr, 1e-300)), s=1, c='k', edgecolors='none')
+    ax.set_xlabel("Sample 1 rank")
+    ax.set_ylabel("-log10 IDR")
+    fig.tight_layout()
+    fig.savefig(plot_fn)
+    plt.close(fig)
+
+def idr2_peaks(pooled_lines, reps_lines, output_fn, log_fn=None, rank='signal.value', seed=0, plot_fn=None):
+    '''
+    IDR v2 of two replicates' peaks matched to the pooled peaks, written
+    to output_fn in IDR v2's layout: the pooled narrowPeak columns with
+    the score set from the global IDR, then -log10 local and global IDR
+    and each replicate's start, end, merged measure and summit.  Ties in
+    rank are broken at random from seed.  Returns the number of peaks.
+
+    This is not the idr package and differs from its idr --peak-list run
+    (as the idr2 applet makes it) in ways idr2_compare.py measures:
+    p and q values are merged by their minimum, which need not be the
+    package's --peak-merge-method default; each replicate peak counts
+    for only the pooled peak it overlaps most; there is no
+    --use-best-multisummit-IDR, so a pooled peak's summits are scored
+    apart; random tie breaks do not draw the same numbers; and the fit
+    is plain pseudo-value EM, so the parameters agree only as closely as
+    the two optimizers converge.
+    '''
+    import numpy as np
+    pooled, reps = idr2_merge_peaks(pooled_lines, reps_lines, rank)
+    rs = np.random.RandomState(seed)
+    ranks = [np.lexsort((rs.random_sample(len(rep[0])), rep[0])).argsort() for rep in reps]
+    params, iterations, log_likelihood, local = idr2_fit(ranks[0], ranks[1])
+    idr = global_idr(local)
+    local_log = -np.log10(np.maximum(local, 1e-300))
+    global_log = -np.log10(np.maximum(idr, 1e-300))
+    scores = np.minimum(-125*np.log2(np.maximum(idr, 1e-300)), 1000).astype(int)
+
+    with open(output_fn, 'w') as fh:
+        for i in np.argsort(idr, kind='mergesort'):
+            f = pooled_lines[pooled[i]].rstrip('\n').split('\t')
+            fields = [f[0], f[1], f[2], '.', str(scores[i]), f[5], f[6], f[7], f[8], f[9],
+                      "%.5f" %(local_log[i]), "%.5f" %(global_log[i])]
+            for measure, starts, ends, summits in reps:
+                fields.extend(["%d" %(starts[i]), "%d" %(ends[i]), "%.5f" %(measure[i]), "%d" %(summits[i] - starts[i])])
+            fh.write('\t'.join(fields) + '\n')
+
+    mu, sigma, rho, p = params
+    report = ["Initial parameter values: [%.2f %.2f %.2f %.2f]" %IDR2_INITIAL_PARAMS,
+              "Finished running IDR on the datasets after %d iterations" %(iterations),
+              "Final parameter values: [%.2f %.2f %.2f %.2f]" %(mu, sigma, rho, p),
+              "Log likelihood: %f" %(log_likelihood if log_likelihood is not None else 0),
+              "Number of reported peaks - %d/%d (%.1f%%)" %(len(pooled), len(pooled_lines), 100.0*len(pooled)/max(len(pooled_lines), 1))]
+    for threshold in [0.01, 0.02, 0.05, 0.1]:
+        npass = (idr <= threshold).sum()
+        report.append("Number of peaks passing IDR cutoff of %.2f - %d/%d (%.1f%%)" %(threshold, npass, len(idr), 100.0*npass/max(len(idr), 1)))
+    for line in report:
+        logging.info(line)
+    if log_fn:
+        with open(log_fn, 'w') as fh:
+            fh.write('\n'.join(report) + '\n')
+    if plot_fn:
+        _idr2_plot(ranks[0], ranks[1], idr, plot_fn)
+    return len(pooled)
+
+def idr2_threshold(idr_fn, thresholded_fn, idr_threshold):
+    '''
+    The narrowPeak columns of the IDR v2 peaks in idr_fn whose global IDR
+    passes idr_threshold, sorted by signal, written to thresholded_fn as
+    the idr applet's awk $12>=%2.2f and sort -k7n,7n select them.
+    Returns the number of peaks written.
+    '''
+    cutoff = float("%2.2f" %(-math.log10(idr_threshold)))
+    peaks = []
+    with open(idr_fn, 'r') as fh:
+        for line in fh:
+            f = line.rstrip('\n').split('\t')
+            if _leading_number(f[11]) >= cutoff:
+                peaks.append('\t'.join(f[:10]))
+    peaks.sort(key=lambda line: (_leading_number(line.split('\t')[6]), line))
+    with open(thresholded_fn, 'w') as fh:
+        fh.writelines(line + '\n' for line in peaks)
+    return len(peaks)
+
+def read_tag_starts(tagAlign_fn, exclude_chroms=None, chunk_bytes=64*1024*1024):
+    '''
+    Read a tagAlign into per-chromosome arrays of tag 5' ends the way spp's
+    read.tagalign.tags does - start for + strand tags, end for - strand
+    tags - skipping chromosomes whose names match the exclude_chroms
+    regex.  Returns ({chrom: (plus, minus)}, read length), the read length
+    being the rounded median length of the first 500 tags.
+    '''
+    import numpy as np
+    exclude = re.compile(exclude_chroms) if exclude_chroms else None
+    chunks = {}
+    read_lengths = []
+    fh = _open_text(tagAlign_fn)
+    for lines in iter(lambda: fh.readlines(chunk_bytes), []):
+        rows = [line.split('\t', 6) for line in lines if line.strip()]
+        if len(read_lengths) < 500:
+            read_lengths.extend(int(row[2]) - int(row[1]) for row in rows[:500 - len(read_lengths)])
+        chroms = np.array([row[0] for row in rows])
+        starts = np.array([row[1] for row in rows]).astype(np.int64)
+        ends = np.array([row[2] for row in rows]).astype(np.int64)
+        plus = np.array([row[5].startswith('+') for row in rows], dtype=bool)
+        names, inverse = np.unique(chroms, return_inverse=True)
+        for i, chrom in enumerate(names):
+            if exclude and exclude.search(chrom):
+                continue
+            on_chrom = inverse == i
+            chunks.setdefault(chrom, ([], []))
+            chunks[chrom][0].append(starts[on_chrom & plus])
+            chunks[chrom][1].append(ends[on_chrom & ~plus])
+    fh.close()
+    tags = dict((chrom, (np.concatenate(p), np.concatenate(m))) for chrom, (p, m) in chunks.iteritems())
+    read_length = int(np.round(np.median(read_lengths))) if read_lengths else 0
+    return tags, read_length
+
+def value_counts(values):
+    '''
+    The distinct values and how often each occurs, like np.unique with
+    return_counts, which needs numpy 1.9 - older than the apt python-numpy
+    the applets get.
+    '''
+    import numpy as np
+    values = np.sort(values)
+    if not len(values):
+        return values, np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    return values[starts], np.diff(np.append(starts, len(values)))
+
+def _tag_scc(args):
+    # spp's tag.scc for one chromosome - the correlation of binned + and -
+    # strand tag counts at each shift in bins, with bins holding 10x the mean
+    # count dropped as anomalies.  Pairs of bins within range of each other
+    # are enumerated directly, which is cheap because tags are sparse.
+    import numpy as np
+    plus, minus, shifts, bin, llim = args
+    pb, pv = value_counts(np.floor(plus/float(bin) + 0.5).astype(np.int64))
+    nb, nv = value_counts(np.floor(minus/float(bin) + 0.5).astype(np.int64))
+    # a + tag at 0 is neither strand to spp
+    pv = pv[pb > 0]; pb = pb[pb > 0]
+    nv = nv[nb > 0]; nb = nb[nb > 0]
+    if llim:
+        mean_count = np.concatenate([pv, nv]).mean() if len(pv) + len(nv) else 0
+        pb, pv = pb[pv < llim*mean_count], pv[pv < llim*mean_count]
+        nb, nv = nb[nv < llim*mean_count], nv[nv < llim*mean_count]
+    if not len(pb) or not len(nb):
+        return np.nan*np.ones(len(shifts))
+    l = max(pb.max(), nb.max()) - min(pb.min(), nb.min()) + 1
+    mp = pv.sum()*bin/float(l)
+    mn = nv.sum()*bin/float(l)
+    pv = pv - mp
+    nv = nv - mn
+    ss = np.sqrt((np.sum(pv*pv) + (l - len(pv))*mp**2) * (np.sum(nv*nv) + (l - len(nv))*mn**2))
+
+    smin, smax = shifts[0], shifts[-1]
+    matched_product = np.zeros(len(shifts))
+    matched_p = np.zeros(len(shifts))
+    matched_n = np.zeros(len(shifts))
+    n_matched = np.zeros(len(shifts))
+    chunk = 1000000
+    for c in range(0, len(pb), chunk):
+        cpb, cpv = pb[c:c+chunk], pv[c:c+chunk]
+        lo = np.searchsorted(nb, cpb + smin, 'left')
+        hi = np.searchsorted(nb, cpb + smax, 'right')
+        counts = hi - lo
+        i = np.repeat(np.arange(len(cpb)), counts)
+        j = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        k = nb[j] - cpb[i] - smin
+        matched_product += np.bincount(k, weights=cpv[i]*nv[j], minlength=len(shifts))
+        matched_p += np.bincount(k, weights=cpv[i], minlength=len(shifts))
+        matched_n += np.bincount(k, weights=nv[j], minlength=len(shifts))
+        n_matched += np.bincount(k, minlength=len(shifts))
+    # R's ntv[-integer(0)] is empty, so with no matches the unmatched - sum is 0
+    unmatched_n = np.where(n_matched > 0, nv.sum() - matched_n, 0)
+    return (matched_product - mn*(pv.sum() - matched_p) - mp*unmatched_n +
+            mp*mn*(l - len(pv) - len(nv) + n_matched))/ss
+
+def _r_format(x):
+    # numbers the way R's cat prints them
+    if x is None or x != x:
+        return 'NA'
+    return '%.7g' %(x)
+
+def strand_xcor(tagAlign_fn, scores_fn=None, plot_fn=None, srange=(-500, 1500), bin=5, exclude_chroms='chrM', threads=None):
+    '''
+    Strand cross-correlation QC as phantompeakqualtools' run_spp_nodups.R
+    computes it, without R.  Writes the CC_SCORE line
+
+        Filename numReads estFragLen corr_estFragLen PhantomPeak
+        corr_phantomPeak argmin_corr min_corr phantomPeakCoef
+        relPhantomPeakCoef QualityTag
+
+    to scores_fn (with only the top fragment length estimate), the profile
+    plot to plot_fn, and returns the fields as a dict along with the
+    profile itself.  Chromosomes are correlated in parallel.
+    '''
+    import numpy as np
+    from multiprocessing import Pool, cpu_count
+    tags, read_length = read_tag_starts(tagAlign_fn, exclude_chroms)
+    chroms = sorted(tags)
+    num_tags = sum(len(tags[c][0]) + len(tags[c][1]) for c in chroms)
+    shifts = np.arange(int(np.floor(srange[0]/float(bin) + 0.5)), int(np.floor(srange[1]/float(bin) + 0.5)) + 1)
+    work = [(tags[c][0], tags[c][1], shifts, bin, 10) for c in chroms]
+    if threads == 1 or len(work) < 2:
+        ccs = map(_tag_scc, work)
+    else:
+        pool = Pool(min(threads or cpu_count(), len(work)))
+        try:
+            ccs = pool.map(_tag_scc, work)
+        finally:
+            pool.close()
+            pool.join()
+    # chromosome average weighted by tag count, chromosomes with no profile dropped
+    weights = np.array([len(tags[c][0]) + len(tags[c][1]) for c in chroms], dtype=float)
+    weights /= weights.sum()
+    ccs = np.array(ccs)
+    good = ~np.isnan(ccs).any(axis=1)
+    x = shifts*bin
+    y = np.sum(ccs[good]*weights[good][:, np.newaxis], axis=0)
+
+    min_x, min_y = x[-1], y[-1]
+    # smoothing window and peak detection lag as run_spp.R sets them
+    sbw = 2*int(np.floor(np.ceil(5.0/bin)/2)) + 1
+    smoothed = np.array([y[max(0, i - sbw/2):i + sbw/2 + 1].mean() for i in range(len(y))])
+    bw = int(np.ceil(2.0/bin))
+    rising = (smoothed[bw:] - smoothed[:-bw] >= 0).astype(int)
+    peakidx = np.where(rising[bw:] - rising[:-bw] == -1)[0] + bw
+    exclude_max = read_length + 10
+    peakidx = peakidx[(x[peakidx] < 10) | (x[peakidx] > exclude_max) | (x[peakidx] < 0)]
+    if not len(peakidx):
+        peakidx = np.array([np.argmax(np.where((x < 10) | (x > exclude_max), smoothed, -np.inf))])
+    maxpeak = peakidx[np.argmax(smoothed[peakidx])]
+    peakidx = peakidx[(smoothed[peakidx] >= 0.9*smoothed[maxpeak]) & (x[peakidx] >= x[maxpeak])]
+    top = peakidx[np.argsort(-smoothed[peakidx], kind='mergesort')][:3]
+    peak_x, peak_y = x[top[0]], smoothed[top[0]]
+
+    phantom = np.where((x >= read_length - round(2*bin)) & (x <= read_length + round(1.5*bin)))[0]
+    if not len(phantom):
+        phantom = np.array([np.argmin(np.abs(x - read_length))])
+    phantom = phantom[np.argmax(y[phantom])]
+    phantom_x, phantom_y = x[phantom], y[phantom]
+
+    nsc = peak_y/min_y
+    rsc = (peak_y - min_y)/(phantom_y - min_y)
+    quality_tag = None
+    for lower, upper, tag in [(0, 0.25, -2), (0.25, 0.5, -1), (0.5, 1, 0), (1, 1.5, 1), (1.5, float('inf'), 2)]:
+        if lower <= rsc < upper:
+            quality_tag = tag
+
+    result = {
+        'Filename': os.path.basename(tagAlign_fn),
+        'numReads': num_tags,
+        'estFragLen': peak_x,
+        'corr_estFragLen': peak_y,
+        'PhantomPeak': phantom_x,
+        'corr_phantomPeak': phantom_y,
+        'argmin_corr': min_x,
+        'min_corr': min_y,
+        'phantomPeakCoef': nsc,
+        'relPhantomPeakCoef': rsc,
+        'QualityTag': quality_tag,
+        'readLength': read_length,
+        'profile': (x, y)}
+    logging.info("strand_xcor %s: fragment length estimates %s" %(tagAlign_fn, list(x[top])))
+    if scores_fn:
+        with open(scores_fn, 'w') as fh:
+            fh.write('\t'.join([result['Filename'], str(num_tags)] +
+                               [_r_format(v) for v in [peak_x, peak_y, phantom_x, phantom_y, min_x, min_y, nsc, rsc, quality_tag]]) + '\n')
+    if plot_fn:
+        plot_xcor(result, plot_fn, list(x[top]))
+    return result
+
+def plot_xcor(result, plot_fn, peak_xs=None):
+    # the run_spp.R -savp plot
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    x, y = result['profile']
+    peak_xs = peak_xs or [result['estFragLen']]
+    fig = plt.figure(figsize=(5, 5))
+    ax = fig.add_subplot(111)
+    ax.plot(x, y, 'k-')
+    for peak_x in peak_xs:
+        ax.axvline(peak_x, linestyle='--', color='r')
+    ax.axvline(result['PhantomPeak'], linestyle='--', color='b')
+    ax.set_xlabel("strand-shift (%s)\nNSC=%s,RSC=%s,Qtag=%s" %(
+        ','.join(_r_format(v) for v in peak_xs), _r_format(result['phantomPeakCoef']),
+        _r_format(result['relPhantomPeakCoef']), _r_format(result['QualityTag'])))
+    ax.set_ylabel("cross-correlation")
+    ax.set_title(result['Filename'], fontsize=8)
+    fig.tight_layout()
+    fig.savefig(plot_fn)
+    plt.close(fig)
+
+
+class _LinesReader(object):
+    # file-like read(size) over a list of lines, so pgzip can compress them
+    def __init__(self, lines, batch=10000):
+        self.lines = lines
+        self.batch = batch
+        self.next_line = 0
+        self.buf = ''
+
+    def read(self, size):
+        while len(self.buf) < size and self.next_line < len(self.lines):
+            self.buf += ''.join(self.lines[self.next_line:self.next_line + self.batch])
+            self.next_line += self.batch
+        block, self.buf = self.buf[:size], self.buf[size:]
+        return block
+
+class _ChromFilter(dict):
+    # chrom -> whether to keep it, deciding each name once
+    def __init__(self, exclude_chroms):
+        dict.__init__(self)
+        self.exclude = re.compile(exclude_chroms)
+
+    def __missing__(self, chrom):
+        keep = self[chrom] = not self.exclude.search(chrom)
+        return keep
+
+def _skip_ahead(rs, k, log_w, last, size=65536):
+    # the next size replacements of Algorithm L as (positions, slots, log_w,
+    # last): each multiplies w by U**(1/k), then skips floor(log(U)/log(1-w))
+    # lines past the previous one
+    import numpy as np
+    log_ws = log_w + np.cumsum(np.log1p(-rs.random_sample(size)))/k
+    with np.errstate(divide='ignore', over='ignore'):
+        gaps = np.floor(np.log1p(-rs.random_sample(size))/np.log1p(-np.exp(log_ws)))
+    positions = np.minimum(last + np.cumsum(gaps + 1), 2.0**62).astype(np.int64)
+    slots = rs.randint(k, size=size)
+    return positions.tolist(), slots.tolist(), log_ws[-1], positions[-1]
+
+def reservoir_sample(infh, depths, seed=None, exclude_chroms=None, chunk_bytes=64*1024*1024):
+    '''
+    Uniform random samples of the lines of infh, one of each size in
+    depths, from one pass with Algorithm L (Li, 1994), skipping lines whose
+    first field matches the exclude_chroms regex.  Only max(depths) lines
+    are held; the smaller samples are nested prefixes of a shuffle of the
+    largest, so each is itself uniform.  A depth larger than the input
+    gets every line.  Returns ({depth: lines}, lines considered).
+    '''
+    import numpy as np
+    rs = np.random.RandomState(seed)
+    keep = _ChromFilter(exclude_chroms) if exclude_chroms else None
+    k = max(depths)
+    reservoir = []
+    seen = 0
+    # replacements are drawn in batches, as 0-based line positions
+    positions, slots, log_w, last = _skip_ahead(rs, k, 0.0, k - 1)
+    j = 0
+    for lines in iter(lambda: infh.readlines(chunk_bytes), []):
+        if not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        if keep is not None:
+            lines = [line for line in lines if keep[line[:line.find('\t')]]]
+        if len(reservoir) < k:
+            reservoir.extend(lines[:k - len(reservoir)])
+        end = seen + len(lines)
+        while positions[j] < end:
+            reservoir[slots[j]] = lines[positions[j] - seen]
+            j += 1
+            if j == len(positions):
+                positions, slots, log_w, last = _skip_ahead(rs, k, log_w, last)
+                j = 0
+        seen = end
+    order = rs.permutation(len(reservoir))
+    samples = dict((depth, [reservoir[i] for i in order[:depth]]) for depth in depths)
+    return samples, seen
+
+def sample_tags(infh, outfiles, seed=None, exclude_chroms=None, threads=None):
+    '''
+    reservoir_sample infh once for every depth in outfiles, a dict of
+    {depth: filename}, and gzip each sample to its file.  Returns
+    {depth: lines written}.
+    '''
+    samples, seen = reservoir_sample(infh, outfiles.keys(), seed, exclude_chroms)
+    logging.info("Sampled %s of %d lines with seed %s" %(sorted(outfiles), seen, seed))
+    for depth, filename in outfiles.iteritems():
+        with open(filename, 'wb') as outfh:
+            pgzip(_LinesReader(samples[depth]), outfh, threads)
+    return dict((depth, len(lines)) for depth, lines in samples.iteritems())
+
+
+BAM_MAGIC = 'BAM\x01'
+BAM_FPAIRED = 0x1
+BAM_FUNMAP = 0x4
+BAM_FMUNMAP = 0x8
+BAM_FREVERSE = 0x10
+BAM_FSECONDARY = 0x100
+BAM_FDUP = 0x400
+BAM_FSUPPLEMENTARY = 0x800
+
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+_BAM_CORE = struct.Struct('<iiBBHHHiiii')
+_BAM_INT = struct.Struct('<i')
+
+def read_bam_header(fh):
+    '''
+    Read the header of an uncompressed BAM stream, leaving fh at the first
+    record.  Returns (raw, text, references), raw being the header bytes
+    to copy into another BAM and references a list of (name, length).
+    '''
+    magic = fh.read(8)
+    if magic[:4] != BAM_MAGIC:
+        raise IOError('not an uncompressed BAM stream')
+    text = fh.read(_BAM_INT.unpack(magic[4:])[0])
+    raw = [magic, text, fh.read(4)]
+    references = []
+    for i in range(_BAM_INT.unpack(raw[-1])[0]):
+        raw.append(fh.read(4))
+        l_name = _BAM_INT.unpack(raw[-1])[0]
+        raw.append(fh.read(l_name + 4))
+        references.append((raw[-1][:l_name - 1], _BAM_INT.unpack(raw[-1][l_name:])[0]))
+    return ''.join(raw), text.rstrip('\x00'), references
+
+def bam_records(fh, chunk_bytes=4*1024*1024):
+    # the raw records, block_size and all, of an uncompressed BAM stream
+    # positioned after its header
+    buf = fh.read(chunk_bytes)
+    start = 0
+    while True:
+        while start + 4 <= len(buf):
+            end = start + 4 + _BAM_INT.unpack_from(buf, start)[0]
+            if end > len(buf):
+                break
+            yield buf[start:end]
+            start = end
+        more = fh.read(chunk_bytes)
+        if not more:
+            if start < len(buf):
+                raise IOError('truncated BAM record')
+            return
+        buf = buf[start:] + more
+        start = 0
+
+# base qualities that count towards a read's score, as MarkDuplicates
+# sums them
+_QUAL_SCORE_TABLE = ''.join(chr(q) if q >= 15 else '\x00' for q in range(256))
+
+class _DuplicateMarker(object):
+    '''
+    Picard MarkDuplicates over a coordinate-sorted stream.  Reads are
+    grouped by library, reference, unclipped 5' position and strand, pairs
+    by the same for both ends, and all but the highest scoring read (pair)
+    of each group are duplicates.  Unpaired reads are duplicates of any
+    pair with an end at the same place.  A group is settled once the
+    stream is past any position a new member could start from, so only
+    the records within a read length plus insert size of the current one
+    are held.
+    '''
+    def __init__(self, header_text, outfh, remove_duplicates, optical_distance, flagstat=None):
+        import heapq, collections
+        self.heapq = heapq
+        self.outfh = outfh
+        self.flagstat = flagstat
+        self.remove_duplicates = remove_duplicates
+        self.optical_distance = optical_distance
+        self.libraries = {}
+        for line in header_text.splitlines():
+            if line.startswith('@RG'):
+                tags = dict(field.split(':', 1) for field in line.split('\t')[1:] if ':' in field)
+                self.libraries[tags.get('ID')] = tags.get('LB', 'Unknown Library')
+        self.metrics = collections.defaultdict(lambda: dict((field, 0) for field in DUPLICATION_METRICS[1:7]))
+        self.held = collections.deque()
+        self.entries = {}
+        self.fragments = {}
+        self.pairs = {}
+        self.groups = []
+        self.pending = {}
+        self.pending_bounds = []
+        self.mate_deadlines = []
+        self.lookbehind = 0
+        self.index = 0
+        self.next_settle = (-1, 0)
+
+    def library(self, rec, aux_offset):
+        if not self.libraries:
+            return 'Unknown Library'
+        at = rec.find('RGZ', aux_offset)
+        if at < 0:
+            return 'Unknown Library'
+        return self.libraries.get(rec[at + 3:rec.index('\x00', at + 3)], 'Unknown Library')
+
+    def add(self, rec):
+        ref, pos, l_read_name, mapq, bin_, n_cigar, flag, l_seq, mate_ref, mate_pos, tlen = _BAM_CORE.unpack_from(rec, 4)
+        index = self.index
+        self.index += 1
+        entry = [rec, False, False]
+        self.held.append(entry)
+        if ref < 0:
+            # unmapped reads with no position come last, nothing more can join a group
+            self.settle(None)
+        cigar_offset = 36 + l_read_name
+        qual_offset = cigar_offset + 4*n_cigar + (l_seq + 1)/2
+        aux_offset = qual_offset + l_seq
+        library = self.library(rec, aux_offset)
+        primary = not flag & (BAM_FSECONDARY | BAM_FSUPPLEMENTARY)
+        if flag & BAM_FUNMAP or not primary:
+            if primary:
+                self.metrics[library]['UNMAPPED_READS'] += 1
+            entry[1] = True
+            self.emit()
+            return
+        self.entries[index] = entry
+        cigar = struct.unpack_from('<%dI' %(n_cigar), rec, cigar_offset)
+        reverse = bool(flag & BAM_FREVERSE)
+        if reverse:
+            # unclipped end: aligned reference length plus trailing clips
+            end = pos
+            for op in cigar:
+                if op & 0xf in (0, 2, 3, 7, 8):
+                    end += op >> 4
+            for op in reversed(cigar):
+                if op & 0xf not in (4, 5):
+                    break
+                end += op >> 4
+            five_prime = end - 1
+        else:
+            five_prime = pos
+            for op in cigar:
+                if op & 0xf not in (4, 5):
+                    break
+                five_prime -= op >> 4
+        self.lookbehind = max(self.lookbehind, l_seq, pos - five_prime)
+        quals = rec[qual_offset:aux_offset]
+        score = sum(bytearray(quals.translate(_QUAL_SCORE_TABLE))) if quals[:1] != '\xff' else 0
+        paired = bool(flag & BAM_FPAIRED) and not flag & BAM_FMUNMAP
+        metrics = self.metrics[library]
+        if paired:
+            metrics['READ_PAIRS_EXAMINED'] += 1
+        else:
+            metrics['UNPAIRED_READS_EXAMINED'] += 1
+
+        key = (library, ref, five_prime, reverse)
+        if key not in self.fragments:
+            self.fragments[key] = []
+            self.heapq.heappush(self.groups, ((ref, five_prime), 'fragment', key))
+        self.fragments[key].append((index, score, paired))
+
+        if paired:
+            name = (library, rec[36:35 + l_read_name])
+            mate = self.pending.pop(name, None)
+            if mate is None:
+                location = self.location(name[1], rec, aux_offset)
+                self.pending[name] = (index, ref, five_prime, reverse, score, location)
+                bound = min((ref, five_prime), (mate_ref, mate_pos - self.lookbehind))
+                self.heapq.heappush(self.pending_bounds, (bound, name, index))
+                self.heapq.heappush(self.mate_deadlines, ((mate_ref, mate_pos), name, index))
+            else:
+                mate_index, mate_ref, mate_five_prime, mate_reverse, mate_score, location = mate
+                # the end at or past the other is read2, ties going to the later record
+                if (mate_ref, mate_five_prime) >= (ref, five_prime):
+                    key = (library, ref, five_prime, reverse, mate_ref, mate_five_prime, mate_reverse)
+                    read1_index, read2_index = index, mate_index
+                else:
+                    key = (library, mate_ref, mate_five_prime, mate_reverse, ref, five_prime, reverse)
+                    read1_index, read2_index = mate_index, index
+                if key not in self.pairs:
+                    self.pairs[key] = []
+                    self.heapq.heappush(self.groups, ((key[1], key[2]), 'pair', key))
+                self.pairs[key].append((read1_index, read2_index, score + mate_score, location))
+
+        # settling costs a few heap operations, so it waits for the stream
+        # to move on by another read length or so
+        if (ref, pos) >= self.next_settle:
+            self.settle((ref, pos))
+            self.next_settle = (ref, pos + self.lookbehind)
+
+    def location(self, name, rec, aux_offset):
+        # (read group, tile, x, y) from Illumina read names, as Picard's
+        # default READ_NAME_REGEX finds them
+        fields = name.split(':')
+        if len(fields) not in (5, 7):
+            return None
+        try:
+            tile, x, y = [int(field) for field in fields[-3:]]
+        except ValueError:
+            return None
+        at = rec.find('RGZ', aux_offset)
+        read_group = rec[at + 3:rec.index('\x00', at + 3)] if at >= 0 else None
+        return (read_group, tile, x, y)
+
+    def settle(self, position):
+        # settle every group no new read can join once the stream is at
+        # position, or all of them at the end of the mapped reads
+        heappop = self.heapq.heappop
+        while self.mate_deadlines and (position is None or self.mate_deadlines[0][0] < position):
+            deadline, name, index = heappop(self.mate_deadlines)
+            mate = self.pending.get(name)
+            if mate is not None and mate[0] == index:
+                # the mate is not in the stream, so this read is in no pair
+                del self.pending[name]
+                self.decide(index, False)
+        while self.pending_bounds and self.pending.get(self.pending_bounds[0][1], (None,))[0] != self.pending_bounds[0][2]:
+            heappop(self.pending_bounds)
+        if position is not None:
+            position = (position[0], position[1] - self.lookbehind)
+        while self.groups:
+            group_position, kind, key = self.groups[0]
+            if position is not None and group_position >= position:
+                break
+            if kind == 'pair' and self.pending_bounds and group_position >= self.pending_bounds[0][0]:
+                break
+            heappop(self.groups)
+            if kind == 'fragment':
+                self.settle_fragments(key[0], self.fragments.pop(key))
+            else:
+                self.settle_pairs(key[0], self.pairs.pop(key))
+        self.emit()
+
+    def settle_fragments(self, library, ends):
+        unpaired = [(index, score) for index, score, paired in ends if not paired]
+        if len(unpaired) == len(ends):
+            best = max(unpaired, key=lambda end: (end[1], -end[0]))[0]
+        else:
+            best = None
+        for index, score in unpaired:
+            self.decide(index, index != best, library)
+
+    def settle_pairs(self, library, ends):
+        ends.sort()
+        best = max(ends, key=lambda end: (end[2], -end[0], -end[1]))
+        for end in ends:
+            self.decide(end[0], end is not best, library, True)
+            self.decide(end[1], end is not best, library, True)
+        if len(ends) > 1:
+            self.metrics[library]['READ_PAIR_OPTICAL_DUPLICATES'] += self.optical_duplicates([end[3] for end in ends])
+
+    def optical_duplicates(self, locations):
+        # later pairs within optical_distance of an earlier one on the same tile
+        distance = self.optical_distance
+        flags = [False]*len(locations)
+        for i, lhs in enumerate(locations):
+            if lhs is None:
+                continue
+            for j in range(i + 1, len(locations)):
+                rhs = locations[j]
+                if flags[j] or rhs is None or lhs[:2] != rhs[:2]:
+                    continue
+                if abs(lhs[2] - rhs[2]) <= distance and abs(lhs[3] - rhs[3]) <= distance:
+                    flags[j] = True
+        return sum(flags)
+
+    def decide(self, index, duplicate, library=None, paired=False):
+        entry = self.entries.pop(index)
+        entry[1] = True
+        entry[2] = duplicate
+        if duplicate:
+            if paired:
+                self.metrics[library]['READ_PAIR_DUPLICATES'] += 1
+            else:
+                self.metrics[library]['UNPAIRED_READ_DUPLICATES'] += 1
+
+    def emit(self):
+        held = self.held
+        write = self.outfh.write
+        flagstat = self.flagstat
+        while held and held[0][1]:
+            rec, decided, duplicate = held.popleft()
+            if duplicate and self.remove_duplicates:
+                continue
+            flag = struct.unpack_from('<H', rec, 18)[0]
+            marked = flag | BAM_FDUP if duplicate else flag & ~BAM_FDUP
+            if marked != flag:
+                rec = rec[:18] + struct.pack('<H', marked) + rec[20:]
+            write(rec)
+            if flagstat:
+                flagstat.add(marked, rec[4:8] != rec[24:28], rec[13] >= '\x05')
+
+    def finish(self):
+        self.settle(None)
+        if self.held:
+            raise ValueError('%d reads were never settled' %(len(self.held)))
+        for library, metrics in self.metrics.iteritems():
+            metrics['READ_PAIRS_EXAMINED'] /= 2
+            metrics['READ_PAIR_DUPLICATES'] /= 2
+            _derive_duplication_metrics(metrics)
+        return dict(self.metrics)
+
+def _derive_duplication_metrics(metrics):
+    examined = metrics['UNPAIRED_READS_EXAMINED'] + 2*metrics['READ_PAIRS_EXAMINED']
+    duplicates = metrics['UNPAIRED_READ_DUPLICATES'] + 2*metrics['READ_PAIR_DUPLICATES']
+    metrics['PERCENT_DUPLICATION'] = float(duplicates)/examined if examined else None
+    metrics['ESTIMATED_LIBRARY_SIZE'] = estimate_library_size(
+        metrics['READ_PAIRS_EXAMINED'] - metrics['READ_PAIR_OPTICAL_DUPLICATES'],
+        metrics['READ_PAIRS_EXAMINED'] - metrics['READ_PAIR_DUPLICATES'])
+
+def combine_duplication_metrics(metrics_list):
+    '''
+    The metrics mark_duplicates would have returned for all the reads of
+    several calls over disjoint reads, e.g. one per chromosome: the counts
+    are summed by library and the percentage and library size recomputed.
+    '''
+    combined = {}
+    for metrics in metrics_list:
+        for library, counts in metrics.iteritems():
+            totals = combined.setdefault(library, dict((field, 0) for field in DUPLICATION_METRICS[1:7]))
+            for field in DUPLICATION_METRICS[1:7]:
+                totals[field] += counts[field]
+    for metrics in combined.itervalues():
+        _derive_duplication_metrics(metrics)
+    return combined
+
+DUPLICATION_METRICS = ['LIBRARY', 'UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED', 'UNMAPPED_READS',
+                       'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES', 'READ_PAIR_OPTICAL_DUPLICATES',
+                       'PERCENT_DUPLICATION', 'ESTIMATED_LIBRARY_SIZE']
+
+def estimate_library_size(read_pairs, unique_read_pairs):
+    # Picard's Lander-Waterman estimate, by bisection as Picard does it
+    import math
+    if not (read_pairs > 0 and read_pairs > unique_read_pairs):
+        return None
+    f = lambda x: float(unique_read_pairs)/x - 1 + math.exp(-float(read_pairs)/x)
+    m, M = 1.0, 100.0
+    if unique_read_pairs >= read_pairs or f(m*unique_read_pairs) < 0:
+        raise ValueError('Invalid values for pairs and unique pairs: %d, %d' %(read_pairs, unique_read_pairs))
+    while f(M*unique_read_pairs) >= 0:
+        M *= 10.0
+    for i in range(40):
+        r = (m + M)/2.0
+        u = f(r*unique_read_pairs)
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+    return long(unique_read_pairs*(m + M)/2.0)
+
+def _picard_format(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return ('%.6f' %(value)).rstrip('0').rstrip('.')
+    return str(value)
+
+def write_duplication_metrics(metrics, metrics_fn, command_line=''):
+    '''
+    Write metrics from mark_duplicates as Picard writes a MarkDuplicates
+    METRICS_FILE, so dup_parse reads it the same way.
+    '''
+    import time, math
+    with open(metrics_fn, 'w') as fh:
+        fh.write('## net.sf.picard.metrics.StringHeader\n# %s\n' %(command_line))
+        fh.write('## net.sf.picard.metrics.StringHeader\n# Started on: %s\n\n' %(time.strftime('%a %b %d %H:%M:%S %Z %Y')))
+        fh.write('## METRICS CLASS\tnet.sf.picard.sam.DuplicationMetrics\n')
+        fh.write('\t'.join(DUPLICATION_METRICS) + '\n')
+        for library in sorted(metrics):
+            fh.write('\t'.join([library] + [_picard_format(metrics[library][field]) for field in DUPLICATION_METRICS[1:]]) + '\n')
+        fh.write('\n')
+        if len(metrics) == 1:
+            library_metrics = metrics.values()[0]
+            size = library_metrics['ESTIMATED_LIBRARY_SIZE']
+            if size:
+                pairs = library_metrics['READ_PAIRS_EXAMINED'] - library_metrics['READ_PAIR_OPTICAL_DUPLICATES']
+                unique_pairs = library_metrics['READ_PAIRS_EXAMINED'] - library_metrics['READ_PAIR_DUPLICATES']
+                fh.write('## HISTOGRAM\tjava.lang.Double\nBIN\tVALUE\n')
+                for x in range(1, 101):
+                    fh.write('%.1f\t%s\n' %(x, _picard_format(size*(1 - math.exp(-(x*pairs)/float(size)))/unique_pairs)))
+                fh.write('\n')
+
+def mark_duplicates(infh, outfh, metrics_fn=None, remove_duplicates=False, optical_distance=100, flagstat=None):
+    '''
+    Mark (or with remove_duplicates, drop) duplicate reads and read pairs
+    in a coordinate-sorted uncompressed BAM stream, writing the
+    uncompressed BAM to outfh, the way Picard MarkDuplicates does with
+    ASSUME_SORTED=true.  Writes Picard's METRICS_FILE to metrics_fn and
+    returns the metrics, a dict per library.  The header is copied as is.
+    The records written are tallied into flagstat, a FlagStat, if given.
+    '''
+    header, text, references = read_bam_header(infh)
+    outfh.write(header)
+    marker = _DuplicateMarker(text, outfh, remove_duplicates, optical_distance, flagstat)
+    for rec in bam_records(infh):
+        marker.add(rec)
+    metrics = marker.finish()
+    if metrics_fn:
+        write_duplication_metrics(metrics, metrics_fn,
+            'mark_duplicates REMOVE_DUPLICATES=%s OPTICAL_DUPLICATE_PIXEL_DISTANCE=%d' %(str(remove_duplicates).lower(), optical_distance))
+    return metrics
+
+FLAGSTAT_FORMAT = '''%d + %d in total (QC-passed reads + QC-failed reads)
+%d + %d duplicates
+%d + %d mapped (%s:%s)
+%d + %d paired in sequencing
+%d + %d read1
+%d + %d read2
+%d + %d properly paired (%s:%s)
+%d + %d with itself and mate mapped
+%d + %d singletons (%s:%s)
+%d + %d with mate mapped to a different chr
+%d + %d with mate mapped to a different chr (mapQ>=5)
+'''
+
+class FlagStat(object):
+    '''
+    samtools (0.1.19) flagstat counts, tallied as records stream past
+    rather than by reading the BAM again.  Counts are [QC-passed,
+    QC-failed] pairs, and str() is the flagstat report.
+    '''
+    FIELDS = ['in_total', 'duplicates', 'mapped', 'paired_in_sequencing', 'read1', 'read2',
+              'properly_paired', 'with_self_mate_mapped', 'singletons',
+              'mate_mapped_different_chr', 'mate_mapped_different_chr_hiQ']
+
+    def __init__(self):
+        # tallies by (flag, mate on another chromosome, mapq >= 5), so a
+        # read costs a dict update and the flag logic runs once per kind
+        self.kinds = collections.defaultdict(int)
+        # counts from flagstat reports, of reads tallied elsewhere
+        self.reported = dict((field, [0, 0]) for field in self.FIELDS)
+
+    def add(self, flag, different_chr, high_mapq):
+        self.kinds[(flag, different_chr, high_mapq)] += 1
+
+    def update(self, other):
+        # add in the reads another FlagStat has counted
+        for kind, n in other.kinds.iteritems():
+            self.kinds[kind] += n
+        for field in self.FIELDS:
+            for w in range(2):
+                self.reported[field][w] += other.reported[field][w]
+
+    def add_report(self, report):
+        # add in the counts of a flagstat report, say one of several chunks'
+        # (samtools 1.x secondary and supplementary lines are passed over)
+        lines = [line for line in report.splitlines() if not re.search(r' \+ \d+ (secondary|supplementary)$', line)]
+        for field, line in zip(self.FIELDS, lines):
+            m = re.match(r'(\d+) \+ (\d+) ', line)
+            self.reported[field][0] += int(m.group(1))
+            self.reported[field][1] += int(m.group(2))
+
+    def add_sam_lines(self, lines):
+        kinds = self.kinds
+        for line in lines:
+            if line[:1] == '@':
+                continue
+            fields = line.split('\t', 7)
+            kinds[(int(fields[1]), fields[6] != '=' and fields[6] != fields[2], int(fields[4]) >= 5)] += 1
+
+    def tally(self):
+        counts = dict((field, list(self.reported[field])) for field in self.FIELDS)
+        for (flag, different_chr, high_mapq), n in self.kinds.iteritems():
+            w = 1 if flag & 0x200 else 0
+            counts['in_total'][w] += n
+            if flag & BAM_FPAIRED:
+                counts['paired_in_sequencing'][w] += n
+                if flag & 0x2:
+                    counts['properly_paired'][w] += n
+                if flag & 0x40:
+                    counts['read1'][w] += n
+                if flag & 0x80:
+                    counts['read2'][w] += n
+                if flag & BAM_FMUNMAP and not flag & BAM_FUNMAP:
+                    counts['singletons'][w] += n
+                if not flag & BAM_FUNMAP and not flag & BAM_FMUNMAP:
+                    counts['with_self_mate_mapped'][w] += n
+                    if different_chr:
+                        counts['mate_mapped_different_chr'][w] += n
+                        if high_mapq:
+                            counts['mate_mapped_different_chr_hiQ'][w] += n
+            if not flag & BAM_FUNMAP:
+                counts['mapped'][w] += n
+            if flag & BAM_FDUP:
+                counts['duplicates'][w] += n
+        return counts
+
+    def __str__(self):
+        counts = self.tally()
+        def percent(n, d):
+            # as samtools prints (float)n/d*100.0
+            if not d:
+                return '-nan%' if not n else 'inf%'
+            f32 = lambda x: struct.unpack('f', struct.pack('f', x))[0]
+            return '%.2f%%' %(f32(f32(n)/f32(d))*100.0)
+        values = []
+        for field in self.FIELDS:
+            values.extend(counts[field])
+            if field == 'mapped':
+                values.extend(percent(n, d) for n, d in zip(counts['mapped'], counts['in_total']))
+            elif field in ('properly_paired', 'singletons'):
+                values.extend(percent(n, d) for n, d in zip(counts[field], counts['paired_in_sequencing']))
+        return FLAGSTAT_FORMAT %tuple(values)
+
+    def write(self, fname):
+        with open(fname, 'w') as fh:
+            fh.write(str(self))
+
+def flagstat_sam(infh, outfh, flagstat, chunk_bytes=16*1024*1024):
+    # copy SAM text from infh to outfh, tallying it into flagstat; a
+    # run_dag step once flagstat is bound
+    for lines in iter(lambda: infh.readlines(chunk_bytes), []):
+        outfh.writelines(lines)
+        flagstat.add_sam_lines(lines)
+
+REFERENCE_CACHE_DIR = os.getenv('REFERENCE_CACHE_DIR', os.path.join(os.path.expanduser('~'), 'reference_cache'))
+REFERENCE_CACHE_BUDGET = int(os.getenv('REFERENCE_CACHE_BUDGET', 100*1024**3))
+
+def _reference_manifest(dirname):
+    # the manifest of a completely extracted reference, if every file it
+    # lists is there at its recorded size, else None
+    import json
+    try:
+        with open(os.path.join(dirname, '.manifest'), 'r') as fh:
+            manifest = json.load(fh)
+    except (IOError, ValueError):
+        return None
+    for name, size in manifest['files'].iteritems():
+        path = os.path.join(dirname, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return None
+    return manifest
+
+def _extract_reference(dxfile, dirname, make_room=None, chunk_size=16*1024*1024, room_every=256*1024*1024):
+    # stream the tarball from the platform into tar, so the download and
+    # the extraction overlap and the tarball itself never lands on disk;
+    # make_room is called every room_every bytes of tarball, to evict for
+    # what has been extracted so far
+    name = dxfile.describe()['name']
+    z = 'z' if name.endswith('.gz') or name.endswith('.tgz') else ''
+    tar_command = 'tar -x%s --no-same-owner --no-same-permissions -C %s -f -' %(z, dirname)
+    logging.info("Unpacking %s: %s" %(name, tar_command))
+    tar = subprocess.Popen(shlex.split(tar_command), stdin=subprocess.PIPE)
+    streamed = 0
+    try:
+        for chunk in iter(lambda: dxfile.read(chunk_size), ''):
+            tar.stdin.write(chunk)
+            streamed += len(chunk)
+            if make_room and streamed >= room_every:
+                make_room()
+                streamed = 0
+    finally:
+        tar.stdin.close()
+    if tar.wait() != 0:
+        raise subprocess.CalledProcessError(tar.returncode, tar_command)
+
+def _evict_references(cache_dir, budget, keep):
+    # remove the least recently used references that no one is using until
+    # the cache, counting every reference at its extracted size, fits in
+    # budget bytes
+    import fcntl, shutil
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        dirname = os.path.join(cache_dir, name)
+        if not os.path.isdir(dirname):
+            continue
+        manifest = _reference_manifest(dirname)
+        if manifest:
+            size = manifest['bytes']
+            last_used = os.path.getmtime(os.path.join(dirname, '.manifest'))
+        else:
+            # left over from an extraction that did not finish
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(dirname) for f in files)
+            last_used = 0
+        total += size
+        if name != keep:
+            entries.append((last_used, name, size))
+    for last_used, name, size in sorted(entries):
+        if total <= budget:
+            break
+        with open(os.path.join(cache_dir, name + '.lock'), 'a') as lockfh:
+            try:
+                fcntl.flock(lockfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue
+            logging.info("Evicting cached reference %s (%d bytes)" %(name, size))
+            shutil.rmtree(os.path.join(cache_dir, name))
+            total -= size
+
+@contextlib.contextmanager
+def cached_reference(reference_tar, cache_dir=None, budget=None):
+    '''
+    Yield the path of the reference fasta in a bwa index tarball, a
+    DNAnexus file, extracted into a cache directory named for the file's
+    ID (closed files never change) the first time it is asked for and
+    reused after that by anything else on the same host.  Every DNAnexus
+    job, subjobs included, starts on a fresh worker, so there the cache
+    only saves the extraction for a second use within one job; it pays
+    off on hosts that outlive a job, like local runs of the applet.
+
+    A manifest of the extracted files and their sizes marks a complete
+    extraction.  Each reference has a lock file, held exclusively while it
+    is extracted and shared while it is in use, so concurrent users wait
+    for one extraction and references in use are never evicted.  The
+    least recently used references are evicted to keep the extracted
+    references within budget bytes (REFERENCE_CACHE_BUDGET), as the
+    extraction grows as well as once it is done.
+    '''
+    import dxpy, fcntl, json, shutil
+    cache_dir = cache_dir or REFERENCE_CACHE_DIR
+    budget = REFERENCE_CACHE_BUDGET if budget is None else budget
+    dxfile = dxpy.DXFile(reference_tar)
+    key = dxfile.get_id()
+    dirname = os.path.join(cache_dir, key)
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+    lockfh = open(dirname + '.lock', 'a')
+    try:
+        fcntl.flock(lockfh, fcntl.LOCK_EX)
+        manifest = _reference_manifest(dirname)
+        if manifest is None:
+            if os.path.isdir(dirname):
+                shutil.rmtree(dirname)
+            # the tarball's size is all that is known of the extracted size
+            # up front, the partial extraction is charged as it grows
+            _evict_references(cache_dir, budget - dxfile.describe()['size'], keep=key)
+            os.makedirs(dirname)
+            _extract_reference(dxfile, dirname, make_room=lambda: _evict_references(cache_dir, budget, keep=key))
+            files = {}
+            for root, dirs, names in os.walk(dirname):
+                for name in names:
+                    path = os.path.join(root, name)
+                    files[os.path.relpath(path, dirname)] = os.path.getsize(path)
+            # assume the reference file is the only .fa or .fna file
+            reference = next((f for f in os.listdir(dirname) if f.endswith('.fa') or f.endswith('.fna') or f.endswith('.fa.gz') or f.endswith('.fna.gz')), None)
+            manifest = {'file_id': key, 'reference': reference, 'files': files, 'bytes': sum(files.values())}
+            with open(os.path.join(dirname, '.manifest.tmp'), 'w') as fh:
+                json.dump(manifest, fh)
+            os.rename(os.path.join(dirname, '.manifest.tmp'), os.path.join(dirname, '.manifest'))
+        else:
+            logging.info("Using cached reference %s" %(dirname))
+        # the manifest's mtime is the reference's last use
+        os.utime(os.path.join(dirname, '.manifest'), None)
+        fcntl.flock(lockfh, fcntl.LOCK_SH)
+        _evict_references(cache_dir, budget, keep=key)
+        if manifest['reference'] is None:
+            raise IOError('No .fa or .fna file in %s' %(dxfile.describe()['name']))
+        yield os.path.join(dirname, manifest['reference'])
+    finally:
+        fcntl.flock(lockfh, fcntl.LOCK_UN)
+        lockfh.close()
+
+def processkey(key=None, keyfile=None):
+
+    import json
+
+    if not (key or keyfile) and os.getenv('ENCODE_AUTHID',None) and os.getenv('ENCODE_AUTHPW',None) and os.getenv('ENCODE_SERVER',None):
+        authid = os.getenv('ENCODE_AUTHID',None)
+        authpw = os.getenv('ENCODE_AUTHPW',None)
+        server = os.getenv('ENCODE_SERVER',None)
+    else:
+        if not keyfile:
+            if 'KEYFILE' in globals(): #this is to support scripts where KEYFILE is a global
+                keyfile = KEYFILE
+            else:
+                logging.error("Keyfile must be specified or in global KEYFILE.")
+                return None
+        if key:
+            try:
+                keysf = open(keyfile,'r')
+            except IOError as e:
+                logging.error("Failed to open keyfile %s" %(keyfile))
+                logging.error("e.")
+                return None
+            except:
+                raise
+            keys_json_string = keysf.read()
+            keysf.close()
+            try:
+                keys = json.loads(keys_json_string)
+            except ValueError as e:
+                logging.error(e.message)
+                logging.error("Keyfile %s not in parseable JSON" %(keyfile))
+                return None
+            except:
+                raise
+            try:
+                key_dict = keys[key]
+            except ValueError:
+                logging.error(e.message)
+                logging.error("Keyfile %s has no key named %s" %(keyfile,key))
+                return None
+            except:
+                raise
+        else:
+            key_dict = {}
+
+        if key_dict:
+            authid = key_dict.get('key')
+            authpw = key_dict.get('secret')
+            server = key_dict.get('server')
+        else:
+            return None
+
+    if not server.endswith("/"):
+        server += "/"
+
+    return (authid,authpw,server)
+
+# Portal client settings - see encoded_client
+ENCODED_MAX_CONCURRENCY = 8
+ENCODED_MAX_RETRIES = 8
+ENCODED_BACKOFF = 0.5
+ENCODED_MAX_SLEEP = 30
+ENCODED_CACHE_SIZE = 4096
+ENCODED_CACHE_TTL = 3600
+ENCODED_CACHE_DIR = os.getenv('ENCODED_CACHE_DIR', None)
+
+_encoded = {}
+
+def encoded_client(max_concurrency=None, cache=False, cache_size=None, cache_dir=None, cache_ttl=None):
+    '''
+    Configure the shared portal client, replacing any existing one.
+
+    Every encoded_* call goes through one pooled requests.Session with at
+    most max_concurrency requests in flight.
+
+    With cache True, which is meant for read-only reports, encoded_get
+    responses are kept in an in-memory LRU of cache_size entries and, if
+    cache_dir is given (or ENCODED_CACHE_DIR is set), on disk keyed by URL
+    (which includes the frame) and authid.  Entries older than cache_ttl
+    seconds are revalidated with their ETag.  Searches and
+    datastore=database reads are never cached, and any write through
+    encoded_update empties the cache.
+    '''
+    import requests, threading, collections
+    from requests.adapters import HTTPAdapter
+    max_concurrency = max_concurrency or ENCODED_MAX_CONCURRENCY
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    _encoded.clear()
+    _encoded.update({
+        'session': session,
+        'slots': threading.BoundedSemaphore(max_concurrency),
+        'max_concurrency': max_concurrency,
+        'lock': threading.Lock(),
+        'lru': collections.OrderedDict(),
+        'cache_size': (ENCODED_CACHE_SIZE if cache_size is None else cache_size) if cache else 0,
+        'cache_dir': (cache_dir or ENCODED_CACHE_DIR) if cache else None,
+        'cache_ttl': ENCODED_CACHE_TTL if cache_ttl is None else cache_ttl
+    })
+    if _encoded['cache_dir'] and not os.path.isdir(_encoded['cache_dir']):
+        os.makedirs(_encoded['cache_dir'])
+    return _encoded
+
+def _encoded_client():
+    return _encoded or encoded_client()
+
+def _encoded_not_sent(e):
+    # whether a connection error came before any of the request went out
+    import requests
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return type(reason).__name__ in ('NewConnectionError', 'ConnectTimeoutError')
+
+def _encoded_request(method, url, **kwargs):
+    # one request with exponential backoff on connection errors and on the
+    # statuses that mean try again later.  A POST that may have reached the
+    # portal could have made the object already, so it is only retried on
+    # 429 and when the connection failed before anything was sent.
+    import requests, random
+    client = _encoded_client()
+    idempotent = method in ('GET', 'HEAD', 'PUT', 'PATCH')
+    for attempt in range(ENCODED_MAX_RETRIES + 1):
+        try:
+            with client['slots']:
+                response = client['session'].request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.SSLError) as e:
+            if not (idempotent or _encoded_not_sent(e)):
+                raise
+            error = e
+        else:
+            if response.status_code not in ((429, 502, 503, 504) if idempotent else (429,)):
+                return response
+            error = "%d %s" %(response.status_code, response.reason)
+        if attempt == ENCODED_MAX_RETRIES:
+            break
+        delay = min(ENCODED_MAX_SLEEP, ENCODED_BACKOFF * 2**attempt) * random.uniform(0.5, 1)
+        logging.warning("%s %s: %s ... retrying in %.1fs" %(method, url, error, delay))
+        sleep(delay)
+    if isinstance(error, Exception):
+        raise error
+    return response
+
+def _encoded_cache_paths(key, url):
+    # entries live in a directory per object path, so that an update can drop
+    # every frame and query of that object at once
+    import hashlib
+    path = urlparse.urlsplit(url).path.rstrip('/')
+    dirname = os.path.join(_encoded['cache_dir'], hashlib.sha1(path).hexdigest())
+    return dirname, os.path.join(dirname, hashlib.sha1(repr(key)).hexdigest() + '.json')
+
+def _encoded_cache_get(key, url):
+    import json, time
+    client = _encoded_client()
+    with client['lock']:
+        entry = client['lru'].pop(key, None)
+        if entry is not None:
+            client['lru'][key] = entry
+    if entry is None and client['cache_dir']:
+        dirname, fname = _encoded_cache_paths(key, url)
+        try:
+            with open(fname, 'r') as fh:
+                entry = json.load(fh)
+        except (IOError, ValueError):
+            entry = None
+    if entry is None:
+        return None, None
+    if time.time() - entry['fetched'] < client['cache_ttl']:
+        return entry, True
+    return entry, False
+
+def _encoded_cache_put(key, url, entry):
+    import json
+    client = _encoded_client()
+    if client['cache_size'] > 0:
+        with client['lock']:
+            client['lru'].pop(key, None)
+            client['lru'][key] = entry
+            while len(client['lru']) > client['cache_size']:
+                client['lru'].popitem(last=False)
+    if client['cache_dir']:
+        dirname, fname = _encoded_cache_paths(key, url)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+        # write then rename so concurrent readers never see half an entry
+        tmp_fname = '%s.%d.%d' %(fname, os.getpid(), id(entry))
+        with open(tmp_fname, 'w') as fh:
+            json.dump(entry, fh)
+        os.rename(tmp_fname, fname)
+
+def encoded_invalidate(url=None):
+    '''Drop cached GETs of the object at url, in every frame, or of everything'''
+    import shutil
+    client = _encoded_client()
+    if url is None:
+        with client['lock']:
+            client['lru'].clear()
+        if client['cache_dir']:
+            for dirname in os.listdir(client['cache_dir']):
+                shutil.rmtree(os.path.join(client['cache_dir'], dirname), ignore_errors=True)
+        return
+    path = urlparse.urlsplit(url).path.rstrip('/')
+    with client['lock']:
+        for key in [k for k in client['lru'] if urlparse.urlsplit(k[1]).path.rstrip('/') == path]:
+            del client['lru'][key]
+    if client['cache_dir']:
+        dirname, fname = _encoded_cache_paths(None, url)
+        shutil.rmtree(dirname, ignore_errors=True)
+
+def _encoded_cacheable(url):
+    # searches and reads straight from the database are how a script sees
+    # its own writes, so they always go to the portal
+    url_obj = urlparse.urlsplit(url)
+    query = urlparse.parse_qs(url_obj.query)
+    return not (url_obj.path.rstrip('/').endswith('/search') or 'database' in query.get('datastore', []))
+
+def encoded_get(url, keypair=None, frame='object', return_response=False):
+    import urlparse, urllib, requests, json, time
+    #it is not strictly necessary to include both the accept header, and format=json, but we do
+    #so as to get exactly the same URL as one would use in a web browser
+    HEADERS = {'accept': 'application/json'}
+    url_obj = urlparse.urlsplit(url)
+    new_url_list = list(url_obj)
+    query = urlparse.parse_qs(url_obj.query)
+    if 'format' not in query:
+        new_url_list[3] += "&format=json"
+    if 'frame' not in query:
+        new_url_list[3] += "&frame=%s" %(frame)
+    if 'limit' not in query:
+        new_url_list[3] += "&limit=all"
+    if new_url_list[3].startswith('&'):
+        new_url_list[3] = new_url_list[3].replace('&','',1)
+    get_url = urlparse.urlunsplit(new_url_list)
+    logging.debug('encoded_get: %s' %(get_url))
+    # callers that ask for the response want to see the portal as it is now
+    key = (keypair[0] if keypair else None, get_url)
+    cacheable = not return_response and _encoded_cacheable(get_url)
+    entry, fresh = _encoded_cache_get(key, get_url) if cacheable else (None, None)
+    if fresh:
+        return json.loads(entry['body'])
+    headers = dict(HEADERS)
+    if entry and entry.get('etag'):
+        headers['if-none-match'] = entry['etag']
+    try:
+        response = _encoded_request('GET', get_url, auth=keypair, headers=headers)
+    except Exception as e:
+        print >> sys.stderr, e
+        return None
+    if return_response:
+        return response
+    if response.status_code == 304 and entry:
+        entry['fetched'] = time.time()
+        _encoded_cache_put(key, get_url, entry)
+        return json.loads(entry['body'])
+    if response.status_code == 200 and cacheable:
+        _encoded_cache_put(key, get_url, {
+            'fetched': time.time(),
+            'etag': response.headers.get('etag'),
+            'body': response.text})
+    return response.json()
+
+def encoded_get_many(urls, keypair=None, frame='object'):
+    '''encoded_get each of urls concurrently, results in the same order'''
+    import threading
+    urls = list(urls)
+    if len(urls) < 2:
+        return [encoded_get(url, keypair, frame) for url in urls]
+    results = [None] * len(urls)
+    indexes = iter(range(len(urls)))
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                i = next(indexes, None)
+            if i is None:
+                return
+            results[i] = encoded_get(urls[i], keypair, frame)
+    threads = [threading.Thread(target=worker) for n in range(min(len(urls), _encoded_client()['max_concurrency']))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def encoded_update(method, url, keypair, payload, return_response):
+    import urlparse, urllib, requests, json
+    if method not in ['patch', 'post', 'put']:
+        logging.error('Invalid HTTP method: %s' %(method))
+        return
+
+    HEADERS = {'accept': 'application/json', 'content-type': 'application/json'}
+    try:
+        response = _encoded_request(method.upper(), url, auth=keypair, headers=HEADERS, data=json.dumps(payload))
+    except (requests.exceptions.ConnectionError, requests.exceptions.SSLError) as e:
+        logging.error("%s %s failed: %s" %(method, url, e))
+        return
+    finally:
+        # a write can change any search or embedded frame, not just url,
+        # and may have landed even if the response never came back
+        encoded_invalidate()
+    if return_response:
+        return response
+    else:
+        return response.json()
+
+def encoded_patch(url, keypair, payload, return_response=False):
+    return encoded_update('patch', url, keypair, payload, return_response)
+
+def encoded_post(url, keypair, payload, return_response=False):
+    return encoded_update('post', url, keypair, payload, return_response)
+
+def encoded_put(url, keypair, payload, return_response=False):
+    return encoded_update('put', url, keypair, payload, return_response)
+
+def pprint_json(JSON_obj):
+    import json
+    print json.dumps(JSON_obj, sort_keys=True, indent=4, separators=(',', ': '))
+
+def merge_dicts(*dict_args):
+    '''
+    Given any number of dicts, shallow copy and merge into a new dict,
+    precedence goes to key value pairs in latter dicts.
+    '''
+    result = {}
+    for dictionary in dict_args:
+        result.update(dictionary)
+    return result
+
+def md5(fn):
+    import hashlib
+    h = hashlib.md5()
+    with open(fn, 'rb') as fh:
+        for chunk in _read_blocks(fh, GZIP_BLOCK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+class _LineCounter(object):
+    def __init__(self):
+        self.lines = 0
+
+    def write(self, chunk):
+        self.lines += chunk.count('\n')
+
+def stream_dxfile(dxfile, fname=None, sinks=None, count_lines=False, chunk_size=16*1024*1024):
+    '''
+    Read dxfile once, writing it to the local file fname and to each of
+    sinks (anything with a write method, like the stdin of aws s3 cp -)
+    while computing its md5, size and, if count_lines, its number of
+    (uncompressed) lines.
+
+    dxfile is a DXFile, a file ID, or any object with a read method.
+    Returns a dict with md5sum, file_size and line_count (None if not counted).
+    '''
+    import hashlib
+    if not hasattr(dxfile, 'read'):
+        import dxpy
+        dxfile = dxpy.DXFile(dxfile)
+    h = hashlib.md5()
+    file_size = 0
+    counter = None
+    line_sink = None
+    outfh = open(fname, 'wb') if fname else None
+    dsts = [fh for fh in [outfh] + list(sinks or []) if fh is not None]
+    try:
+        for chunk in iter(lambda: dxfile.read(chunk_size), ''):
+            if line_sink is None and count_lines:
+                counter = _LineCounter()
+                line_sink = _GunzipWriter(counter) if chunk.startswith('\x1f\x8b') else counter
+            h.update(chunk)
+            file_size += len(chunk)
+            for dst in dsts:
+                dst.write(chunk)
+            if line_sink is not None:
+                line_sink.write(chunk)
+        if isinstance(line_sink, _GunzipWriter):
+            line_sink.close()
+    finally:
+        if outfh is not None:
+            outfh.close()
+    return {
+        'md5sum': h.hexdigest(),
+        'file_size': file_size,
+        'line_count': counter.lines if counter else (0 if count_lines else None)
+    }
+
+def after(date1, date2):
+    try:
+        result = dateutil.parser.parse(date1) > dateutil.parser.parse(date2)
+    except TypeError:
+        if not re.search('\+.*$', date1):
+            date1 += 'T00:00:00-07:00'
+        if not re.search('\+.*$', date2):
+            date1 += 'T00:00:00-07:00'
+    try:
+        result = dateutil.parser.parse(date1) > dateutil.parser.parse(date2)
+    except Exception as e:
+        logger.error("%s Cannot compare %s with %s" %(e, date1, date2))
+        raise
+    else:
+        return result
+
+
+# provenance nodes fetched so far in this run, keyed by (server, accession)
+# for files and (server, @id) for replicates
+_provenance_nodes = {}
+
+def _file_accession(f):
+    if isinstance(f, dict):
+        return f.get('accession')
+    m = re.match('^/?(files)?/?(\w*)', f)
+    if m:
+        return m.group(2)
+    return re.search('ENCFF[0-9]{3}[A-Z]{3}', f).group(0)
+
+def _fetch_provenance_wave(wave, server, keypair):
+    # one batch of concurrent GETs for whatever in the wave hasn't been seen
+    wanted = [(kind, key) for kind, key in set(wave) if (server, kind, key) not in _provenance_nodes]
+    urls = [urlparse.urljoin(server, '/files/%s' %(key) if kind == 'file' else key) for kind, key in wanted]
+    for (kind, key), obj in zip(wanted, encoded_get_many(urls, keypair)):
+        _provenance_nodes[(server, kind, key)] = obj or {}
+
+def resolve_provenance(files, server, keypair):
+    '''
+    Walk the derived_from graph of each of files (accessions, @ids or file
+    objects) a level at a time, fetching each level as one concurrent
+    batch and remembering every node for later calls.
+
+    Returns a list with a dict for each of files with
+        biorep_ns   biological replicate numbers of the files it derives from
+        references  @ids of the reference files it derives from
+    '''
+    roots = [_file_accession(f) for f in files]
+    seen = set()
+    wave = [('file', acc) for acc in roots if acc]
+    while wave:
+        _fetch_provenance_wave(wave, server, keypair)
+        seen.update(wave)
+        next_wave = set()
+        for kind, key in wave:
+            obj = _provenance_nodes[(server, kind, key)]
+            if kind != 'file':
+                continue
+            if obj.get('derived_from'):
+                next_wave.update(('file', _file_accession(uri)) for uri in obj['derived_from'])
+            elif obj.get('replicate'):
+                next_wave.add(('replicate', obj['replicate']))
+        wave = [key for key in next_wave if key not in seen and key[1]]
+
+    memo = {}
+    def provenance(acc):
+        if acc not in memo:
+            memo[acc] = (set(), set()) # guards against cycles
+            obj = _provenance_nodes.get((server, 'file', acc), {})
+            repns, references = set(), set()
+            if obj.get('derived_from'):
+                for uri in obj['derived_from']:
+                    parent_acc = _file_accession(uri)
+                    parent = _provenance_nodes.get((server, 'file', parent_acc), {})
+                    parent_repns, parent_references = provenance(parent_acc)
+                    repns.update(parent_repns)
+                    if parent.get('output_category') == "reference":
+                        references.add(parent.get('@id'))
+                    else:
+                        references.update(parent_references)
+            else:
+                replicate = _provenance_nodes.get((server, 'replicate', obj.get('replicate')), {})
+                repns.add(replicate.get('biological_replicate_number'))
+            memo[acc] = (repns, references)
+        return memo[acc]
+
+    results = []
+    for acc in roots:
+        repns, references = provenance(acc) if acc else (set(), set())
+        results.append({
+            'biorep_ns': [n for n in repns if n is not None],
+            'references': [r for r in references if r is not None]})
+    return results
+
+def biorep_ns_generator(f, server, keypair):
+    for repnum in resolve_provenance([f], server, keypair)[0]['biorep_ns']:
+        yield repnum
+
+
+def biorep_ns(f, server, keypair):
+    return resolve_provenance([f], server, keypair)[0]['biorep_ns']
+
+
+def derived_from_references_generator(f, server, keypair):
+    for reference in resolve_provenance([f], server, keypair)[0]['references']:
+        yield reference
+
+
+def derived_from_references(f, server, keypair):
+    return resolve_provenance([f], server, keypair)[0]['references']
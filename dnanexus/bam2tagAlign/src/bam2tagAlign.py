@@ -13,43 +13,11 @@
 
 import os, subprocess, shlex
 import dxpy
-
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
+import common
 
 
 @dxpy.entry_point('main')
-def main(input_bam, paired_end):
+def main(input_bam, paired_end, input_bedpe=None):
 
     input_bam_file = dxpy.DXFile(input_bam)
 
@@ -60,7 +28,6 @@ def main(input_bam, paired_end):
     input_bam_basename = input_bam_file.name.rstrip('.bam')
     dxpy.download_dxfile(input_bam_file.get_id(), input_bam_filename)
 
-    intermediate_TA_filename = input_bam_basename + ".tagAlign"
     if paired_end:
         end_infix = 'PE2SE'
     else:
@@ -72,27 +39,28 @@ def main(input_bam, paired_end):
     # ===================
     # Create tagAlign file
     # ===================
-    out,err = run_pipe([
-        "bamToBed -i %s" %(input_bam_filename),
-        r"""awk 'BEGIN{OFS="\t"}{$4="N";$5="1000";print $0}'""",
-        "tee %s" %(intermediate_TA_filename),
-        "gzip -c"],
-        outfile=final_TA_filename)
+    out,err = common.run_dag([
+        {'name': 'bamToBed', 'command': "bamToBed -i %s" %(input_bam_filename)},
+        {'name': 'tagAlign', 'input': 'bamToBed',
+         'command': r"""awk 'BEGIN{OFS="\t"}{$4="N";$5="1000";print $0}'"""},
+        {'name': 'gzip', 'input': 'tagAlign', 'command': common.pgzip, 'outfile': final_TA_filename},
+        {'name': 'count', 'input': 'tagAlign', 'command': "wc -l"}])
+    TA_counts = common.record_counts(final_TA_filename, int(out['count']), sort_order='coordinate')
     print subprocess.check_output('ls -l', shell=True)
 
     # ================
     # Create BEDPE file
     # ================
-    if paired_end:
+    # unless filter_qc already made it from its name-sorted reads
+    if paired_end and not input_bedpe:
         final_nmsrt_bam_prefix = input_bam_basename + ".filt.nmsrt.nodup"
         final_nmsrt_bam_filename = final_nmsrt_bam_prefix + ".bam"
         subprocess.check_call(shlex.split("samtools sort -n %s %s" %(input_bam_filename, final_nmsrt_bam_prefix)))
 
         final_BEDPE_filename = input_bam_basename + ".bedpe.gz"
-        out,err = run_pipe([
-            "bamToBed -bedpe -mate1 -i %s" %(final_nmsrt_bam_filename),
-            "gzip -c"],
-            outfile=final_BEDPE_filename)
+        out,err = common.run_dag([
+            {'name': 'bedpe', 'command': "bamToBed -bedpe -mate1 -i %s" %(final_nmsrt_bam_filename)},
+            {'name': 'gzip', 'input': 'bedpe', 'command': common.pgzip, 'outfile': final_BEDPE_filename}])
 
     print subprocess.check_output('ls -l', shell=True)
 
@@ -102,9 +70,12 @@ def main(input_bam, paired_end):
     # have used the output field name for the filename for each output, but you
     # can change that behavior to suit your needs.
 
-    tagAlign_file = dxpy.upload_local_file(final_TA_filename)
+    tagAlign_file = dxpy.upload_local_file(final_TA_filename, properties=TA_counts)
     if paired_end:
-        BEDPE_file = dxpy.upload_local_file(final_BEDPE_filename)
+        if input_bedpe:
+            BEDPE_file = dxpy.DXFile(input_bedpe)
+        else:
+            BEDPE_file = dxpy.upload_local_file(final_BEDPE_filename)
 
     # The following line fills in some basic dummy output and assumes
     # that you have created variables to represent your output with
@@ -1,69 +1,278 @@
 #!/usr/bin/env python
 # ENCODE_BWA 0.0.1
 
-import os, subprocess, shlex, time
-from multiprocessing import Pool, cpu_count
-from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
+import os, subprocess, shlex, logging, itertools, threading, re
+from multiprocessing import cpu_count
+from subprocess import Popen, PIPE
 import dxpy
+import common
 
 logger = logging.getLogger(__name__)
 
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
-
-def resolve_reference():
-    # assume the reference file is the only .fa or .fna file
-    return next((f for f in os.listdir(".") if f.endswith('.fa') or f.endswith('.fna') or f.endswith('.fa.gz') or f.endswith('.fna.gz')), None)
+CIGAR_OP = re.compile(r'(\d+)([MIDNSHP=X])')
+
+def mapped_basename(unmapped_reads_filenames):
+    # the name the mapped reads are given, from the names of the fastqs
+    return ''.join(fn.rstrip('.gz').rstrip('.fq').rstrip('.fastq') for fn in unmapped_reads_filenames)
+
+def cigar_read_length(cigar):
+    # the sequence length a CIGAR accounts for, counting every operation
+    # but D as the awk bad CIGAR check did
+    return sum(int(n) for n, op in CIGAR_OP.findall(cigar) if op != 'D')
+
+def filter_bad_cigars(infh, outfh, chunk_bytes=16*1024*1024):
+    '''
+    Copy SAM from infh to outfh, dropping all the records of a read (pair)
+    if any of them has a CIGAR that does not account for its sequence.
+    A read's records are expected together, as bwa sampe writes them.
+    Returns the number of reads dropped.
+    '''
+    lengths = {}
+    group = []
+    group_name = None
+    bad = False
+    dropped = 0
+    for lines in iter(lambda: infh.readlines(chunk_bytes), []):
+        kept = []
+        for line in lines:
+            if line[0] == '@':
+                kept.append(line)
+                continue
+            fields = line.split('\t', 10)
+            if fields[0] != group_name:
+                if bad:
+                    dropped += 1
+                else:
+                    kept.extend(group)
+                group, group_name, bad = [], fields[0], False
+            group.append(line)
+            cigar = fields[5]
+            if cigar != '*':
+                length = lengths.get(cigar)
+                if length is None:
+                    length = lengths[cigar] = cigar_read_length(cigar)
+                if length != len(fields[9]):
+                    bad = True
+        outfh.writelines(kept)
+    if bad:
+        dropped += 1
+    else:
+        outfh.writelines(group)
+    return dropped
+
+def split_fastqs(infhs, outfhs, records_per_block=100000):
+    '''
+    Deal the records of the fastqs infhs (the two ends of paired reads in
+    lockstep) out to the chunks outfhs, a list per chunk of a file per
+    fastq, a block of records_per_block reads at a time round robin.
+    Chunks differ by at most a block and mates stay in the same chunk at
+    the same place.  Returns the number of reads in each chunk.
+    '''
+    nlines = 4*records_per_block
+    counts = [0]*len(outfhs)
+    for chunk in itertools.cycle(range(len(outfhs))):
+        blocks = [list(itertools.islice(fh, nlines)) for fh in infhs]
+        if any(len(block) != len(blocks[0]) for block in blocks):
+            raise ValueError('The fastqs have different numbers of reads')
+        if len(blocks[0]) % 4:
+            raise ValueError('Truncated fastq record')
+        if not blocks[0]:
+            break
+        for outfh, block in zip(outfhs[chunk], blocks):
+            outfh.writelines(block)
+        counts[chunk] += len(blocks[0])/4
+    return counts
+
+@dxpy.entry_point("scatter")
+def scatter(unmapped_reads, chunks):
+    # split the fastq(s) into chunks of reads for separate process and
+    # postprocess subjobs
+
+    print "In scatter"
+
+    infhs = []
+    readers = []
+    chunk_filenames = []
+    for reads in unmapped_reads:
+        fn = dxpy.describe(reads)['name']
+        dxpy.download_dxfile(reads, fn)
+        if common.is_gzipped(fn):
+            readers.append(Popen(['gzip', '-dc', fn], stdout=PIPE))
+            infhs.append(readers[-1].stdout)
+        else:
+            infhs.append(open(fn, 'rb'))
+        basename = fn.rstrip('.gz').rstrip('.fq').rstrip('.fastq')
+        chunk_filenames.append(["%s.chunk%03d.fq.gz" %(basename, i) for i in range(chunks)])
+
+    errors = []
+    outfhs = [[] for i in range(chunks)]
+    compressors = []
+    for filenames in chunk_filenames:
+        for i, chunk_filename in enumerate(filenames):
+            r, w = os.pipe()
+            t = threading.Thread(target=common.compress_to,
+                args=(os.fdopen(r, 'rb'), chunk_filename, max(1, cpu_count()/(chunks*len(chunk_filenames))), errors),
+                kwargs={'level': 1})
+            t.start()
+            compressors.append(t)
+            outfhs[i].append(os.fdopen(w, 'wb'))
+    try:
+        counts = split_fastqs(infhs, outfhs)
+    finally:
+        for fh in itertools.chain(*outfhs):
+            fh.close()
+        for t in compressors:
+            t.join()
+    for p in readers:
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, 'gzip -dc')
+    if errors:
+        raise errors[0]
+    print "Reads in each chunk: %s" %(counts)
+
+    output = {}
+    for n, filenames in enumerate(chunk_filenames):
+        output["reads%d_chunks" %(n+1)] = [dxpy.dxlink(dxpy.upload_local_file(fn)) for fn in filenames]
+    print "Returning from scatter with output: %s" %(output)
+    return output
 
-@dxpy.entry_point("postprocess")
-def postprocess(indexed_reads, unmapped_reads, reference_tar, bwa_version, samtools_version):
+@dxpy.entry_point("gather")
+def gather(mapped_chunks, mapping_statistics_chunks, raw_bam_filename, samtools_version):
+    # merge the coordinate-sorted chunk BAMs, which samtools merge does
+    # a k-way merge of rather than sorting again, and sum their flagstats
 
-    print "In postprocess with:"
+    print "In gather"
 
+    samtools = samtools_executable(samtools_version)
+
+    chunk_filenames = []
+    raw_flagstat = common.FlagStat()
+    for i, (mapped, mapping_statistics) in enumerate(zip(mapped_chunks, mapping_statistics_chunks)):
+        fn = "chunk%03d.raw.srt.bam" %(i)
+        dxpy.download_dxfile(mapped, fn)
+        chunk_filenames.append(fn)
+        raw_flagstat.add_report(dxpy.DXFile(mapping_statistics).read())
+
+    raw_bam_mapstats_filename = raw_bam_filename + ".flagstat.qc"
     if samtools_version == "0.1.19":
-        samtools = "/usr/local/bin/samtools-0.1.19/samtools"
-    elif samtools_version == "1.0":
-        samtools = "/usr/local/bin/samtools-1.0/bin/samtools"
+        merge_command = "%s merge %s %s" %(samtools, raw_bam_filename, ' '.join(chunk_filenames))
     else:
-        samtools = "/usr/local/bin/samtools-0.1.19/samtools"
+        merge_command = "%s merge -@%d %s %s" %(samtools, cpu_count(), raw_bam_filename, ' '.join(chunk_filenames))
+    print merge_command
+    subprocess.check_call(shlex.split(merge_command))
+    raw_flagstat.write(raw_bam_mapstats_filename)
+
+    print subprocess.check_output('ls -l', shell=True)
+    mapped_reads = dxpy.upload_local_file(raw_bam_filename)
+    mapping_statistics = dxpy.upload_local_file(raw_bam_mapstats_filename)
 
+    output = { "mapped_reads": dxpy.dxlink(mapped_reads),
+               "mapping_statistics": dxpy.dxlink(mapping_statistics) }
+    print "Returning from gather with output: %s" %(output)
+    return output
+
+def bwa_executable(bwa_version):
     if bwa_version == "0.7.7":
-        bwa = "bwa0.7.7"
+        return "bwa0.7.7"
     elif bwa_version == "0.7.10":
-        bwa = "bwa0.7.10"
+        return "bwa0.7.10"
+    else:
+        print "BWA version %s not supported, defaulting to 0.7.7" %(bwa_version)
+        return "bwa0.7.7"
+
+def samtools_executable(samtools_version):
+    if samtools_version == "0.1.19":
+        return "/usr/local/bin/samtools-0.1.19/samtools"
+    elif samtools_version == "1.0":
+        return "/usr/local/bin/samtools-1.0/bin/samtools"
+    else:
+        return "/usr/local/bin/samtools-0.1.19/samtools"
+
+def sai_basename(reads_filename):
+    reads_basename = reads_filename
+    # the order of this list is important.  It strips from the right inward, so
+    # the expected right-most extensions should appear first (like .gz)
+    for extension in ['.gz', '.fq', '.fastq', '.fa', '.fasta']:
+        reads_basename = reads_basename.rstrip(extension)
+    return reads_basename
+
+def bwa_aln(bwa, bwa_aln_params, reference_filename, reads_filenames):
+    '''
+    Align each of reads_filenames with bwa aln at the same time against
+    the one index, dividing the cpus between them.  Returns the names of
+    the .sai files, in the same order.
+    '''
+    threads = max(1, cpu_count()/len(reads_filenames))
+    alns = []
+    for reads_filename in reads_filenames:
+        sai_filename = '%s.sai' %(sai_basename(reads_filename))
+        bwa_command = "%s aln %s -t %d %s %s" \
+            %(bwa, bwa_aln_params, threads, reference_filename, reads_filename)
+        print bwa_command
+        with open(sai_filename, 'w') as sai_file:
+            alns.append((Popen(shlex.split(bwa_command), stdout=sai_file), bwa_command, sai_filename))
+    for p, bwa_command, sai_filename in alns:
+        p.wait()
+    for p, bwa_command, sai_filename in alns:
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, bwa_command)
+    return [sai_filename for p, bwa_command, sai_filename in alns]
+
+def map_to_bam(bwa, samtools, samtools_version, reference_filename, indexed_reads_filenames, unmapped_reads_filenames,
+               raw_bam_filename, raw_bam_mapstats_filename):
+    # bwa samse/sampe the .sai files into the coordinate-sorted
+    # raw_bam_filename, with its flagstat in raw_bam_mapstats_filename
+
+    paired_end = len(indexed_reads_filenames) == 2
+
+    if paired_end:
+        reads1_filename = indexed_reads_filenames[0]
+        reads2_filename = indexed_reads_filenames[1]
+        unmapped_reads1_filename = unmapped_reads_filenames[0]
+        unmapped_reads2_filename = unmapped_reads_filenames[1]
+        # pairs with a read whose CIGAR does not match its sequence are
+        # dropped as sampe's output streams past
+        dropped = []
+        steps = [ {'name': 'sampe',
+                   'command': "%s sampe -P %s %s %s %s %s" %(bwa, reference_filename, reads1_filename, reads2_filename, unmapped_reads1_filename, unmapped_reads2_filename)},
+                  {'name': 'sam', 'input': 'sampe',
+                   'command': lambda infh, outfh: dropped.append(filter_bad_cigars(infh, outfh))} ]
+    else: #single end
+        reads_filename = indexed_reads_filenames[0]
+        unmapped_reads_filename = unmapped_reads_filenames[0]
+        steps = [ {'name': 'sam',
+                   'command': "%s samse %s %s %s" %(bwa, reference_filename, reads_filename, unmapped_reads_filename)} ]
+    # the flagstat counts are tallied from the SAM on its way to samtools,
+    # rather than by reading the sorted BAM back
+    raw_flagstat = common.FlagStat()
+    steps.append({'name': 'flagstat', 'input': 'sam',
+                  'command': lambda infh, outfh: common.flagstat_sam(infh, outfh, raw_flagstat)})
+    if samtools_version == "0.1.9":
+        steps.extend([{'name': 'view', 'input': 'flagstat', 'command': "%s view -Su -" %(samtools)},
+                      {'name': 'sort', 'input': 'view', 'command': "%s sort - %s" %(samtools, raw_bam_filename.rstrip('.bam'))}]) # samtools adds .bam
     else:
-        print "BWA version %s not supported, defaulting to 0.7.7"
-        bwa = "bwa0.7.7"
+        steps.extend([{'name': 'view', 'input': 'flagstat', 'command': "%s view -@%d -Su -" %(samtools, cpu_count())},
+                      {'name': 'sort', 'input': 'view', 'command': "%s sort -@%d - %s" %(samtools, cpu_count(), raw_bam_filename.rstrip('.bam'))}]) # samtools adds .bam
+    print "Running pipe:"
+    print steps
+    out,err = common.run_dag(steps)
+    if paired_end:
+        print "Dropped %d read pairs with bad CIGARs" %(dropped[0])
+
+    if out.get('sort'):
+        print "samtools output: %s" %(out['sort'])
+    if any(err.values()):
+        print "samtools error: %s" %(err)
+
+    raw_flagstat.write(raw_bam_mapstats_filename)
+
+@dxpy.entry_point("postprocess")
+def postprocess(indexed_reads, unmapped_reads, reference_tar, bwa_version, samtools_version):
+
+    print "In postprocess with:"
+
+    samtools = samtools_executable(samtools_version)
+    bwa = bwa_executable(bwa_version)
 
     print "samtools version: %s" %(samtools)
     print "bwa version %s" %(bwa)
@@ -84,70 +293,17 @@ def postprocess(indexed_reads, unmapped_reads, reference_tar, bwa_version, samto
         unmapped_reads_filenames.append(fn)
         dxpy.download_dxfile(unmapped,fn)
 
-    reference_tar_filename = dxpy.describe(reference_tar)['name']
-    print "reference_tar: %s" %(reference_tar_filename)
-    dxpy.download_dxfile(reference_tar, reference_tar_filename)
-    # extract the reference files from the tar
-    if reference_tar_filename.endswith('.gz') or reference_tar_filename.endswith('.tgz'):
-        tar_command = 'tar -xzv --no-same-owner --no-same-permissions -f %s' %(reference_tar_filename)
-    else:
-        tar_command = 'tar -xv --no-same-owner --no-same-permissions -f %s' %(reference_tar_filename)
-    print "Unpacking %s" %(reference_tar_filename)
-    print tar_command
-    print subprocess.check_output(shlex.split(tar_command))
-    reference_filename = resolve_reference()
-
-    paired_end = len(indexed_reads) == 2
+    print "reference_tar: %s" %(dxpy.describe(reference_tar)['name'])
 
-    if paired_end:
-        r1_basename = unmapped_reads_filenames[0].rstrip('.gz').rstrip('.fq').rstrip('.fastq')
-        r2_basename = unmapped_reads_filenames[1].rstrip('.gz').rstrip('.fq').rstrip('.fastq')
-        reads_basename = r1_basename + r2_basename
-    else:
-        reads_basename = unmapped_reads_filenames[0].rstrip('.gz').rstrip('.fq').rstrip('.fastq')
+    reads_basename = mapped_basename(unmapped_reads_filenames)
     raw_bam_filename = '%s.raw.srt.bam' %(reads_basename)
     raw_bam_mapstats_filename = '%s.raw.srt.bam.flagstat.qc' %(reads_basename)
 
-    if paired_end:
-        reads1_filename = indexed_reads_filenames[0]
-        reads2_filename = indexed_reads_filenames[1]
-        unmapped_reads1_filename = unmapped_reads_filenames[0]
-        unmapped_reads2_filename = unmapped_reads_filenames[1]
-        raw_sam_filename = reads_basename + ".raw.sam"
-        badcigar_filename = "badreads.tmp"
-        steps = [ "%s sampe -P %s %s %s %s %s" %(bwa, reference_filename, reads1_filename, reads2_filename, unmapped_reads1_filename, unmapped_reads2_filename),
-                  "tee %s" %(raw_sam_filename),
-                  r"""awk 'BEGIN {FS="\t" ; OFS="\t"} ! /^@/ && $6!="*" { cigar=$6; gsub("[0-9]+D","",cigar); n = split(cigar,vals,"[A-Z]"); s = 0; for (i=1;i<=n;i++) s=s+vals[i]; seqlen=length($10) ; if (s!=seqlen) print $1"\t" ; }'""",
-                  "sort",
-                  "uniq" ]
-        out,err = run_pipe(steps,badcigar_filename)
-        if err:
-            print "sampe error: %s" %(err)
-
-        steps = [ "cat %s" %(raw_sam_filename),
-                  "grep -v -F -f %s" %(badcigar_filename)]
-    else: #single end
-        reads_filename = indexed_reads_filenames[0]
-        unmapped_reads_filename = unmapped_reads_filenames[0]
-        steps = [ "%s samse %s %s %s" %(bwa, reference_filename, reads_filename, unmapped_reads_filename) ]
-    if samtools_version == "0.1.9":
-        steps.extend(["%s view -Su -" %(samtools),
-                      "%s sort - %s" %(samtools, raw_bam_filename.rstrip('.bam')) ]) # samtools adds .bam
-    else:
-        steps.extend(["%s view -@%d -Su -" %(samtools, cpu_count()),
-                      "%s sort -@%d - %s" %(samtools, cpu_count(), raw_bam_filename.rstrip('.bam')) ]) # samtools adds .bam
-    print "Running pipe:"
-    print steps
-    out,err = run_pipe(steps)
-
-    if out:
-        print "samtools output: %s" %(out)
-    if err:
-        print "samtools error: %s" %(err)
-
-    with open(raw_bam_mapstats_filename, 'w') as fh:
-        subprocess.check_call(shlex.split("%s flagstat %s" \
-            %(samtools, raw_bam_filename)), stdout=fh)
+    # the index is extracted once per host, so a local run shares it with process
+    with common.cached_reference(reference_tar) as reference_filename:
+        print "Using reference file: %s" %(reference_filename)
+        map_to_bam(bwa, samtools, samtools_version, reference_filename, indexed_reads_filenames, unmapped_reads_filenames,
+                   raw_bam_filename, raw_bam_mapstats_filename)
 
     print subprocess.check_output('ls', shell=True)
     mapped_reads = dxpy.upload_local_file(raw_bam_filename)
@@ -166,46 +322,20 @@ def process(reads_file, reference_tar, bwa_aln_params, bwa_version):
 
     print "In process"
 
-    if bwa_version == "0.7.7":
-        bwa = "bwa0.7.7"
-    elif bwa_version == "0.7.10":
-        bwa = "bwa0.7.10"
-    else:
-        bwa = "bwa0.7.7"
+    bwa = bwa_executable(bwa_version)
     print "Using bwa version %s" %(bwa_version)
 
     # Generate filename strings and download the files to the local filesystem
     reads_filename = dxpy.describe(reads_file)['name']
-    reads_basename = reads_filename
-    # the order of this list is important.  It strips from the right inward, so
-    # the expected right-most extensions should appear first (like .gz)
-    for extension in ['.gz', '.fq', '.fastq', '.fa', '.fasta']:
-        reads_basename = reads_basename.rstrip(extension)
     reads_file = dxpy.download_dxfile(reads_file,reads_filename)
 
-    reference_tar_filename = dxpy.describe(reference_tar)['name']
-    reference_tar_file = dxpy.download_dxfile(reference_tar,reference_tar_filename)
-    # extract the reference files from the tar
-    if reference_tar_filename.endswith('.gz') or reference_tar_filename.endswith('.tgz'):
-        tar_command = 'tar -xzv --no-same-owner --no-same-permissions -f %s' %(reference_tar_filename)
-    else:
-        tar_command = 'tar -xv --no-same-owner --no-same-permissions -f %s' %(reference_tar_filename)
-    print "Unpacking %s" %(reference_tar_filename)
-    print tar_command
-    print subprocess.check_output(shlex.split(tar_command))
-    reference_filename = resolve_reference()
-    print "Using reference file: %s" %(reference_filename)
-
     print subprocess.check_output('ls -l', shell=True)
 
     #generate the suffix array index file
-    sai_filename = '%s.sai' %(reads_basename)
-    with open(sai_filename,'w') as sai_file:
-        # Build the bwa command and call bwa
-        bwa_command = "%s aln %s -t %d %s %s" \
-            %(bwa, bwa_aln_params, cpu_count(), reference_filename, reads_filename)
-        print bwa_command
-        subprocess.check_call(shlex.split(bwa_command), stdout=sai_file) 
+    # the index is extracted once per host, so a local run shares it with postprocess
+    with common.cached_reference(reference_tar) as reference_filename:
+        print "Using reference file: %s" %(reference_filename)
+        sai_filename, = bwa_aln(bwa, bwa_aln_params, reference_filename, [reads_filename])
 
     print subprocess.check_output('ls -l', shell=True)
 
@@ -217,8 +347,52 @@ def process(reads_file, reference_tar, bwa_aln_params, bwa_version):
     print process_output
     return process_output
 
+@dxpy.entry_point("align")
+def align(unmapped_reads, reference_tar, bwa_aln_params, bwa_version, samtools_version):
+    # process and postprocess in one job: both ends are aligned at once
+    # against one copy of the index and sampe reads the .sai files from
+    # local disk, so neither the index nor the .sai files are moved
+    # between jobs
+
+    print "In align"
+
+    samtools = samtools_executable(samtools_version)
+    bwa = bwa_executable(bwa_version)
+
+    print "samtools version: %s" %(samtools)
+    print "bwa version %s" %(bwa)
+
+    unmapped_reads_filenames = []
+    for i,reads in enumerate(unmapped_reads):
+        fn = dxpy.describe(reads)['name']
+        print "unmapped reads %d: %s" %(i+1, fn)
+        unmapped_reads_filenames.append(fn)
+        dxpy.download_dxfile(reads,fn)
+
+    print "reference_tar: %s" %(dxpy.describe(reference_tar)['name'])
+
+    reads_basename = mapped_basename(unmapped_reads_filenames)
+    raw_bam_filename = '%s.raw.srt.bam' %(reads_basename)
+    raw_bam_mapstats_filename = '%s.raw.srt.bam.flagstat.qc' %(reads_basename)
+
+    with common.cached_reference(reference_tar) as reference_filename:
+        print "Using reference file: %s" %(reference_filename)
+        indexed_reads_filenames = bwa_aln(bwa, bwa_aln_params, reference_filename, unmapped_reads_filenames)
+        print subprocess.check_output('ls -l', shell=True)
+        map_to_bam(bwa, samtools, samtools_version, reference_filename, indexed_reads_filenames, unmapped_reads_filenames,
+                   raw_bam_filename, raw_bam_mapstats_filename)
+
+    print subprocess.check_output('ls', shell=True)
+    mapped_reads = dxpy.upload_local_file(raw_bam_filename)
+    mapping_statistics = dxpy.upload_local_file(raw_bam_mapstats_filename)
+
+    output = { "mapped_reads": dxpy.dxlink(mapped_reads),
+               "mapping_statistics": dxpy.dxlink(mapping_statistics) }
+    print "Returning from align with output: %s" %(output)
+    return output
+
 @dxpy.entry_point("main")
-def main(reads1=None, reference_tar=None, bwa_aln_params=None, bwa_version=None, samtools_version=None, reads2=None, input_JSON=None, debug=False):
+def main(reads1=None, reference_tar=None, bwa_aln_params=None, bwa_version=None, samtools_version=None, reads2=None, input_JSON=None, debug=False, chunks=1, single_job=False):
 
     # Main entry-point.  Parameter defaults assumed to come from dxapp.json.
     # reads1, reference_tar, reads2 are links to DNAnexus files or None
@@ -243,14 +417,19 @@ def main(reads1=None, reference_tar=None, bwa_aln_params=None, bwa_version=None,
             bwa_version = input_JSON['bwa_version']
         if 'samtools_version' in input_JSON:
             samtools_version = input_JSON['samtools_version']
+        if 'chunks' in input_JSON:
+            chunks = input_JSON['chunks']
+        if 'single_job' in input_JSON:
+            single_job = input_JSON['single_job']
 
     if not reads1:
         logger.error('reads1 is required, explicitly or in input_JSON')
         raise Exception
 
     # This spawns only one or two subjobs for single- or paired-end,
-    # respectively.  It could also download the files, chunk the reads,
-    # and spawn multiple subjobs.
+    # respectively, unless chunks > 1, when a scatter subjob splits the
+    # reads and each chunk gets its own subjobs.  With single_job each
+    # chunk is aligned and postprocessed by one align subjob instead.
 
     # Files are downloaded later by subjobs into their own filesystems
     # and uploaded to the project.
@@ -259,29 +438,58 @@ def main(reads1=None, reference_tar=None, bwa_aln_params=None, bwa_version=None,
 
     paired_end = reads2 is not None
     unmapped_reads = [r for r in [reads1, reads2] if r]
-    
-    subjobs = []
-    for reads in unmapped_reads:
-        subjob_input = {"reads_file": reads,
-                        "reference_tar": reference_tar,
-                        "bwa_aln_params": bwa_aln_params,
-                        "bwa_version": bwa_version}
-        print "Submitting:"
-        print subjob_input
-        subjobs.append(dxpy.new_dxjob(subjob_input, "process"))
-
-    # Create the job that will perform the "postprocess" step.  depends_on=subjobs, so blocks on all subjobs
-
-    postprocess_job = dxpy.new_dxjob(fn_input={ "indexed_reads": [subjob.get_output_ref("output") for subjob in subjobs],
-                                                "unmapped_reads": unmapped_reads,
-                                                "reference_tar": reference_tar,
-                                                "bwa_version": bwa_version,
-                                                "samtools_version": samtools_version },
-                                     fn_name="postprocess",
-                                     depends_on=subjobs)
-
-    mapped_reads = postprocess_job.get_output_ref("mapped_reads")
-    mapping_statistics = postprocess_job.get_output_ref("mapping_statistics")
+
+    if chunks > 1:
+        scatter_job = dxpy.new_dxjob({"unmapped_reads": unmapped_reads, "chunks": chunks}, "scatter")
+        chunked_reads = [[scatter_job.get_output_ref("reads%d_chunks" %(n+1), index=i) for n in range(len(unmapped_reads))]
+                         for i in range(chunks)]
+    else:
+        chunked_reads = [unmapped_reads]
+
+    postprocess_jobs = []
+    for chunk_reads in chunked_reads:
+        if single_job:
+            postprocess_jobs.append(dxpy.new_dxjob(fn_input={ "unmapped_reads": chunk_reads,
+                                                              "reference_tar": reference_tar,
+                                                              "bwa_aln_params": bwa_aln_params,
+                                                              "bwa_version": bwa_version,
+                                                              "samtools_version": samtools_version },
+                                                   fn_name="align"))
+            continue
+
+        subjobs = []
+        for reads in chunk_reads:
+            subjob_input = {"reads_file": reads,
+                            "reference_tar": reference_tar,
+                            "bwa_aln_params": bwa_aln_params,
+                            "bwa_version": bwa_version}
+            print "Submitting:"
+            print subjob_input
+            subjobs.append(dxpy.new_dxjob(subjob_input, "process"))
+
+        # Create the job that will perform the "postprocess" step.  depends_on=subjobs, so blocks on all subjobs
+
+        postprocess_jobs.append(dxpy.new_dxjob(fn_input={ "indexed_reads": [subjob.get_output_ref("output") for subjob in subjobs],
+                                                          "unmapped_reads": chunk_reads,
+                                                          "reference_tar": reference_tar,
+                                                          "bwa_version": bwa_version,
+                                                          "samtools_version": samtools_version },
+                                               fn_name="postprocess",
+                                               depends_on=subjobs))
+
+    if chunks > 1:
+        raw_bam_filename = '%s.raw.srt.bam' %(mapped_basename([dxpy.describe(reads)['name'] for reads in unmapped_reads]))
+        gather_job = dxpy.new_dxjob(fn_input={ "mapped_chunks": [job.get_output_ref("mapped_reads") for job in postprocess_jobs],
+                                               "mapping_statistics_chunks": [job.get_output_ref("mapping_statistics") for job in postprocess_jobs],
+                                               "raw_bam_filename": raw_bam_filename,
+                                               "samtools_version": samtools_version },
+                                    fn_name="gather",
+                                    depends_on=postprocess_jobs)
+        mapped_reads = gather_job.get_output_ref("mapped_reads")
+        mapping_statistics = gather_job.get_output_ref("mapping_statistics")
+    else:
+        mapped_reads = postprocess_jobs[0].get_output_ref("mapped_reads")
+        mapping_statistics = postprocess_jobs[0].get_output_ref("mapping_statistics")
 
     output = {
         "mapped_reads": mapped_reads,
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encode_bwa filter_bad_cigars unit tests
+
+import imp, os, sys, unittest
+from StringIO import StringIO
+
+import dxpy
+
+src_dir = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(src_dir, "resources", "home", "dnanexus"))
+
+def load_applet():
+    # the applet calls dxpy.run() when it is imported
+    run = dxpy.run
+    dxpy.run = lambda *args, **kwargs: None
+    try:
+        return imp.load_source('encode_bwa', os.path.join(src_dir, "src", "encode_bwa.py"))
+    finally:
+        dxpy.run = run
+
+encode_bwa = load_applet()
+
+def sam_line(name, flag, cigar, seq):
+    return '\t'.join([name, str(flag), 'chr1', '100', '37', cigar, '=', '300', '0', seq, '#'*len(seq), 'XT:A:U']) + '\n'
+
+HEADER = ['@SQ\tSN:chr1\tLN:1000000\n', '@PG\tID:bwa\tPN:bwa\n']
+
+class TestFilterBadCigars(unittest.TestCase):
+    def filter(self, lines, **kwargs):
+        outfh = StringIO()
+        dropped = encode_bwa.filter_bad_cigars(StringIO(''.join(lines)), outfh, **kwargs)
+        return dropped, outfh.getvalue().splitlines(True)
+
+    def test_cigar_read_length(self):
+        self.assertEqual(encode_bwa.cigar_read_length('36M'), 36)
+        self.assertEqual(encode_bwa.cigar_read_length('5S20M2I3D9M'), 36)
+        self.assertEqual(encode_bwa.cigar_read_length('10M100N26M'), 136)
+
+    def test_good_reads_kept(self):
+        lines = HEADER + [sam_line('r1', 99, '36M', 'N'*36), sam_line('r1', 147, '30M6S', 'N'*36),
+                          sam_line('r2', 4, '*', 'N'*36)]
+        self.assertEqual(self.filter(lines), (0, lines))
+
+    def test_bad_read_dropped_with_its_mate(self):
+        good = [sam_line('r1', 99, '36M', 'N'*36), sam_line('r1', 147, '36M', 'N'*36)]
+        bad = [sam_line('r2', 99, '36M', 'N'*36), sam_line('r2', 147, '30M', 'N'*36)]
+        last = [sam_line('r3', 0, '2I34M', 'N'*36)]
+        self.assertEqual(self.filter(HEADER + good + bad + last), (1, HEADER + good + last))
+
+    def test_deletions_not_counted(self):
+        lines = [sam_line('r1', 0, '20M4D16M', 'N'*36)]
+        self.assertEqual(self.filter(lines), (0, lines))
+
+    def test_last_read_bad(self):
+        lines = [sam_line('r1', 0, '36M', 'N'*36), sam_line('r2', 0, '35M', 'N'*36)]
+        self.assertEqual(self.filter(lines), (1, lines[:1]))
+
+    def test_reads_across_chunks(self):
+        # a read's records may be split between readlines chunks
+        lines = HEADER
+        for i in range(200):
+            lines = lines + [sam_line('r%d' %(i), 99, '36M', 'N'*36),
+                             sam_line('r%d' %(i), 147, '36M' if i % 3 else '35M', 'N'*36)]
+        dropped, kept = self.filter(lines, chunk_bytes=500)
+        self.assertEqual(dropped, 67)
+        self.assertEqual(kept, [line for line in lines if line[0] == '@' or int(line.split('\t')[0][1:]) % 3])
+
+if __name__ == '__main__':
+    unittest.main()
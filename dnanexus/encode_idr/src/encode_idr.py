@@ -41,6 +41,10 @@ def blacklist_filter(input_fname, output_fname, input_blacklist_fname):
 		], output_fname)
 	#subprocess.check_call(shlex.split('cp %s %s' %(peaks_fname, output_fname)))
 
+def upload_peaks(peaks_fname, npeaks):
+	# compressed, with the count of its peaks, which keep IDR's -k7n,7n order
+	gz_fname = common.compress(peaks_fname)
+	return dxpy.upload_local_file(gz_fname, properties=common.record_counts(gz_fname, npeaks, sort_order='-k7n,7n'))
 
 @dxpy.entry_point("main")
 def main(experiment, reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks, chrom_sizes, as_file, blacklist=None):
@@ -87,13 +91,14 @@ def main(experiment, reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks, chrom_s
 	r2pr_peaks_filename = common.uncompress(r2pr_peaks_filename)
 	pooledpr_peaks_filename = common.uncompress(pooledpr_peaks_filename)
 
-	Nt = common.count_lines(reps_peaks_filename)
+	# the IDR applets record their thresholded peak counts on upload
+	Nt = common.count_lines(reps_peaks_filename, reps_peaks_file)
 	print "%d peaks from true replicates" %(Nt)
-	N1 = common.count_lines(r1pr_peaks_filename)
+	N1 = common.count_lines(r1pr_peaks_filename, r1pr_peaks_file)
 	print "%d peaks from rep1 self-pseudoreplicates" %(N1)
-	N2 = common.count_lines(r2pr_peaks_filename)
+	N2 = common.count_lines(r2pr_peaks_filename, r2pr_peaks_file)
 	print "%d peaks from rep2 self-pseudoreplicates" %(N2)
-	Np = common.count_lines(pooledpr_peaks_filename)
+	Np = common.count_lines(pooledpr_peaks_filename, pooledpr_peaks_file)
 	print "%d peaks from pooled pseudoreplicates" %(Np)
 
 	conservative_set_filename = '%s_final_conservative.narrowPeak' %(experiment)
@@ -146,8 +151,8 @@ def main(experiment, reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks, chrom_s
 		"N1": N1,
 		"N2": N2,
 		"Np": Np,
-		"conservative_set": dxpy.dxlink(dxpy.upload_local_file(common.compress(conservative_set_filename))),
-		"optimal_set": dxpy.dxlink(dxpy.upload_local_file(common.compress(optimal_set_filename))),
+		"conservative_set": dxpy.dxlink(upload_peaks(conservative_set_filename, Ncb)),
+		"optimal_set": dxpy.dxlink(upload_peaks(optimal_set_filename, Nob)),
 		"rescue_ratio": rescue_ratio,
 		"self_consistency_ratio": self_consistency_ratio,
 		"reproducibility_test": reproducibility,
@@ -15,50 +15,7 @@ import os, subprocess, shlex, time, re
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
 import dxpy
-
-def run_pipe(steps, outfile=None):
-        #break this out into a recursive function
-        #TODO:  capture stderr
-        from subprocess import Popen, PIPE
-        p = None
-        p_next = None
-        first_step_n = 1
-        last_step_n = len(steps)
-        for n,step in enumerate(steps, start=first_step_n):
-                print "step %d: %s" %(n,step)
-                if n == first_step_n:
-                        if n == last_step_n and outfile: #one-step pipeline with outfile
-                                with open(outfile, 'w') as fh:
-                                        print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                                        p = Popen(shlex.split(step), stdout=fh)
-                                break
-                        print "first step shlex to stdout: %s" %(shlex.split(step))
-                        p = Popen(shlex.split(step), stdout=PIPE)
-                        #need to close p.stdout here?
-                elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-                        with open(outfile, 'w') as fh:
-                                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                                p.stdout.close()
-                                p = p_last
-                else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-                        print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-                        p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-                        p.stdout.close()
-                        p = p_next
-        out,err = p.communicate()
-        return out,err
-
-def count_lines(filename):
-        if filename.endswith(('.Z','.gz','.bz','.bz2')):
-                catcommand = 'gzip -dc'
-        else:
-                catcommand = 'cat'
-        out,err = run_pipe([
-                '%s %s' %(catcommand, filename),
-                'wc -l'
-        ])
-        return int(out)
+import common
 
 def spp(experiment, control, xcor_scores, chrom_sizes, bigbed=False, as_file=None, name='spp'):
         spp_applet = dxpy.find_one_data_object(
@@ -114,10 +71,10 @@ def main(rep1_ta, rep2_ta, ctl1_ta, ctl2_ta, rep1_xcor, rep2_xcor, npeaks, nodup
         rep1_xcor_filename = rep1_xcor_file.name
         rep2_xcor_filename = rep2_xcor_file.name
 
-        ntags_rep1 = count_lines(rep1_ta_filename)
-        ntags_rep2 = count_lines(rep2_ta_filename)
-        ntags_ctl1 = count_lines(ctl1_ta_filename)
-        ntags_ctl2 = count_lines(ctl2_ta_filename)
+        ntags_rep1 = common.count_lines(rep1_ta_filename, rep1_ta_file)
+        ntags_rep2 = common.count_lines(rep2_ta_filename, rep2_ta_file)
+        ntags_ctl1 = common.count_lines(ctl1_ta_filename, ctl1_ta_file)
+        ntags_ctl2 = common.count_lines(ctl2_ta_filename, ctl2_ta_file)
 
         for n,name,filename in [(ntags_rep1, 'replicate 1', rep1_ta_filename),
                                                         (ntags_rep2, 'replicate 2', rep2_ta_filename),
@@ -11,13 +11,369 @@
 # DNAnexus Python Bindings (dxpy) documentation:
 #   http://autodoc.dnanexus.com/bindings/python/current/
 
-import os, subprocess, shlex, time
+import os, subprocess, shlex, time, re, logging, shutil, struct, heapq, cStringIO
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
 import dxpy
+import common
 
 logger = logging.getLogger(__name__)
 
+# PBC File output
+# TotalReadPairs [tab] DistinctReadPairs [tab] OneReadPair [tab] TwoReadPairs [tab] NRF=Distinct/Total [tab] PBC1=OnePair/Distinct [tab] PBC2=OnePair/TwoPair
+PBC_FORMAT = "%d\t%d\t%d\t%d\t%s\t%s\t%s\n"
+
+# bamToBed columns that locate a read, and bamToBed -bedpe columns that
+# locate a pair: (chromosome columns, coordinate columns, strand columns)
+SE_KEY_COLUMNS = ([0], [1, 2], [5])
+PE_KEY_COLUMNS = ([0, 3], [1, 5], [8, 9])
+
+def field_bounds(buf, ncols):
+	# start and end offsets of every field of every line in buf, a uint8
+	# array of whole tab-delimited lines with ncols fields each
+	import numpy as np
+	ends = np.flatnonzero((buf == ord('\t')) | (buf == ord('\n'))).reshape(-1, ncols)
+	starts = np.empty_like(ends)
+	starts[:, 1:] = ends[:, :-1] + 1
+	starts[1:, 0] = ends[:-1, -1] + 1
+	starts[:1, 0] = 0
+	return starts, ends
+
+def parse_ints(buf, starts, ends, max_digits=10):
+	# non-negative decimal fields, a digit position at a time for all lines
+	import numpy as np
+	values = np.zeros(len(starts), dtype=np.int64)
+	scale = 1
+	for d in range(1, max_digits + 1):
+		has_digit = ends - d >= starts
+		if not has_digit.any():
+			break
+		digits = buf[np.where(has_digit, ends - d, 0)].astype(np.int64) - ord('0')
+		values += np.where(has_digit, digits, 0)*scale
+		scale *= 10
+	return values
+
+def hash_fields(buf, starts, ends, width=32):
+	# a 64 bit polynomial hash of each field, to stand in for it when
+	# grouping by a field that has only a handful of distinct values
+	import numpy as np
+	hashes = np.zeros(len(starts), dtype=np.uint64)
+	lengths = ends - starts
+	for i in range(min(width, lengths.max() if len(lengths) else 0)):
+		has_char = lengths > i
+		chars = buf[np.where(has_char, starts + i, 0)].astype(np.uint64)
+		hashes = hashes*np.uint64(1000003) + np.where(has_char, chars, np.uint64(0))
+	return hashes
+
+def read_key_columns(infh, key_columns, ncols, exclude_chroms='chrM', chunk_bytes=16*1024*1024):
+	'''
+	Read the chromosome, coordinate and strand columns of every line of a
+	bamToBed or bamToBed -bedpe stream into integer arrays - chromosome
+	ids, coordinates and 1 for + strand - skipping lines on chromosomes
+	that match the exclude_chroms regex.  Returns a list of arrays, one
+	per key column.
+	'''
+	import numpy as np
+	chrom_cols, coord_cols, strand_cols = key_columns
+	exclude = re.compile(exclude_chroms) if exclude_chroms else None
+	chrom_ids = {}
+	chrom_hashes = {}
+	excluded_ids = set()
+	columns = [[] for c in chrom_cols + coord_cols + strand_cols]
+	while True:
+		chunk = infh.read(chunk_bytes)
+		if not chunk:
+			break
+		chunk += infh.readline()
+		if not chunk.endswith('\n'):
+			chunk += '\n'
+		buf = np.frombuffer(chunk, dtype=np.uint8)
+		starts, ends = field_bounds(buf, ncols)
+		keep = np.ones(len(starts), dtype=bool)
+		values = []
+		for col in chrom_cols:
+			hashes = hash_fields(buf, starts[:, col], ends[:, col])
+			distinct, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+			ids = np.empty(len(distinct), dtype=np.int32)
+			for i, (h, line) in enumerate(zip(distinct, first)):
+				name = chunk[starts[line, col]:ends[line, col]]
+				if name not in chrom_ids:
+					if h in chrom_hashes:
+						raise ValueError('%s and %s hash alike' %(name, chrom_hashes[h]))
+					chrom_hashes[h] = name
+					chrom_ids[name] = len(chrom_ids)
+					if exclude and exclude.search(name):
+						excluded_ids.add(chrom_ids[name])
+				ids[i] = chrom_ids[name]
+			values.append(ids[inverse])
+			if excluded_ids:
+				keep &= ~np.in1d(values[-1], list(excluded_ids))
+		for col in coord_cols:
+			values.append(parse_ints(buf, starts[:, col], ends[:, col]).astype(np.int32))
+		for col in strand_cols:
+			values.append((buf[starts[:, col]] == ord('+')).astype(np.int8))
+		for column, value in zip(columns, values):
+			column.append(value[keep])
+	return [np.concatenate(column) if column else np.zeros(0, dtype=np.int32) for column in columns]
+
+def count_duplicates(columns):
+	'''
+	How many times each distinct row of the key columns occurs.  Rows are
+	packed into int64 keys, each column offset by its minimum and given
+	just the bits its range needs, and counted after a sort; keys too wide
+	to pack are lexsorted instead.
+	'''
+	import numpy as np
+	if not len(columns[0]):
+		return np.zeros(0, dtype=np.int64)
+	lows = [int(column.min()) for column in columns]
+	bits = [int(column.max() - low).bit_length() for column, low in zip(columns, lows)]
+	if sum(bits) <= 63:
+		keys = np.zeros(len(columns[0]), dtype=np.int64)
+		for column, low, width in zip(columns, lows, bits):
+			keys <<= width
+			keys |= column.astype(np.int64) - low
+		return common.value_counts(keys)[1]
+	order = np.lexsort(columns[::-1])
+	changed = np.zeros(len(order), dtype=bool)
+	changed[0] = True
+	for column in columns:
+		ordered = column[order]
+		changed[1:] |= ordered[1:] != ordered[:-1]
+	return np.diff(np.append(np.flatnonzero(changed), len(order)))
+
+def complexity_counts(infh, paired_end, exclude_chroms='chrM'):
+	# total, distinct, one and two read (pair) counts for library_complexity
+	if paired_end:
+		columns = read_key_columns(infh, PE_KEY_COLUMNS, 10, exclude_chroms)
+	else:
+		columns = read_key_columns(infh, SE_KEY_COLUMNS, 6, exclude_chroms)
+	counts = count_duplicates(columns)
+	return int(counts.sum()), len(counts), int((counts == 1).sum()), int((counts == 2).sum())
+
+def pbc_line(total, distinct, one, two):
+	ratio = lambda a, b: '%f' %(float(a)/b) if b else 'NA'
+	return PBC_FORMAT %(total, distinct, one, two, ratio(distinct, total), ratio(one, distinct), ratio(one, two))
+
+def library_complexity(infh, paired_end, exclude_chroms='chrM'):
+	'''
+	NRF, PBC1 and PBC2 from a bamToBed stream (bamToBed -bedpe for paired
+	end), counting reads (pairs) with the same chromosome, coordinates and
+	strands as duplicates.  Returns the .pbc.qc line.
+	'''
+	return pbc_line(*complexity_counts(infh, paired_end, exclude_chroms))
+
+def shard_references(bam_filename, nshards):
+	'''
+	Split the references of an indexed, coordinate-sorted BAM into at most
+	nshards runs of consecutive references with about the same number of
+	mapped reads, so shards sorted on their own concatenate in order.
+	'''
+	out = subprocess.check_output(shlex.split("samtools idxstats %s" %(bam_filename)))
+	counts = []
+	for line in out.splitlines():
+		name, length, mapped, unmapped = line.split('\t')
+		if name != '*' and int(mapped):
+			counts.append((name, int(mapped)))
+	total = sum(n for name, n in counts)
+	shards = [[]]
+	done = 0
+	for name, n in counts:
+		if shards[-1] and done >= total*len(shards)/float(nshards):
+			shards.append([])
+		shards[-1].append(name)
+		done += n
+	return [shard for shard in shards if shard]
+
+def bedpe_steps(input_name, nmsrt_prefix, bedpe_filename, threads=None):
+	# run_dag steps that name-sort the uncompressed BAM from step input_name
+	# and write its read pairs to bedpe_filename, the BEDPE xcor and
+	# bam2tagAlign would otherwise make from the final BAM
+	return [
+		{'name': 'nmsrt_bgzf', 'input': input_name,
+		 'command': lambda infh, outfh: common.pgzip(infh, outfh, threads, level=1, bgzf=True)},
+		{'name': 'nmsrt', 'input': 'nmsrt_bgzf', 'command': "samtools sort -no - %s" %(nmsrt_prefix)},
+		{'name': 'bedpe', 'input': 'nmsrt', 'command': "bamToBed -bedpe -mate1 -i stdin"},
+		{'name': 'bedpe_gzip', 'input': 'bedpe', 'outfile': bedpe_filename,
+		 'command': lambda infh, outfh: common.pgzip(infh, outfh, threads)}]
+
+def split_mates(infh, outfh, crossfh=None):
+	# copy an uncompressed BAM stream to outfh, but for the records of reads
+	# whose mates are on another reference, which go to crossfh
+	header, text, references = common.read_bam_header(infh)
+	outfh.write(header)
+	if not crossfh:
+		shutil.copyfileobj(infh, outfh, 4*1024*1024)
+		return
+	write, cross = outfh.write, crossfh.write
+	for rec in common.bam_records(infh):
+		if rec[4:8] == rec[24:28]:
+			write(rec)
+		else:
+			cross(rec)
+
+def strip_header(infh, outfh, headers):
+	headers.append(common.read_bam_header(infh)[0])
+	shutil.copyfileobj(infh, outfh, 4*1024*1024)
+
+def filter_shard(work):
+	'''
+	Filter, remove duplicates and count library complexity as main does,
+	for the reads on some references of an indexed BAM (or with references
+	None, all of a BAM).  The BGZF blocks of the shard's final records,
+	without header or EOF block, go to prefix.body.  For paired-end data
+	the final read pairs go to prefix.bedpe.gz, and reads whose mates are
+	on another reference go to prefix.cross to be paired up once every
+	shard is done.  Returns the header, flagstat, duplication metrics and
+	library complexity counts.
+	'''
+	bam_filename, references, paired_end, samtools_params, prefix, threads = work
+	region = ' '.join(references or [])
+	body_filename = prefix + ".body"
+	cross_filename = prefix + ".cross"
+	bedpe_filename = prefix + ".bedpe.gz"
+	headers = []
+	flagstat = common.FlagStat()
+	metrics = {}
+	pbc = []
+	if paired_end:
+		# as main does, but the name-sorted reads come from the shard and
+		# the PBC bedPE from fixmate's name-sorted output
+		nmsrt_prefix = prefix + ".nmsrt"
+		with open(cross_filename, 'wb') as crossfh:
+			common.run_dag([
+				{'name': 'view', 'command': "samtools view -F 1804 -f 2 %s -u %s %s" %(samtools_params, bam_filename, region)},
+				{'name': 'gunzip', 'input': 'view', 'command': lambda infh, outfh: common.pgunzip(infh, outfh, threads)},
+				{'name': 'split', 'input': 'gunzip',
+				 'command': lambda infh, outfh: split_mates(infh, outfh, crossfh if references else None)},
+				{'name': 'bgzf', 'input': 'split', 'command': lambda infh, outfh: common.pgzip(infh, outfh, threads, level=1, bgzf=True)},
+				{'name': 'nmsrt', 'input': 'bgzf', 'command': "samtools sort -n - %s" %(nmsrt_prefix)}])
+		steps = [
+			{'name': 'fixmate', 'command': "samtools fixmate -r %s.bam -" %(nmsrt_prefix)},
+			{'name': 'refilt', 'input': 'fixmate', 'command': "samtools view -F 1804 -f 2 -u -"},
+			{'name': 'filt', 'input': 'refilt', 'command': "samtools sort -o - %s" %(prefix)},
+			{'name': 'bed', 'input': 'refilt', 'command': "bamToBed -bedpe -i stdin"}]
+	else:
+		steps = [
+			{'name': 'filt', 'command': "samtools view -F 1804 %s -u %s %s" %(samtools_params, bam_filename, region)},
+			{'name': 'bed', 'input': 'filt', 'command': "bamToBed -i stdin"}]
+	steps.extend([
+		{'name': 'pbc', 'input': 'bed',
+		 'command': lambda infh, outfh: pbc.extend(complexity_counts(infh, paired_end, exclude_chroms='chrM'))},
+		{'name': 'gunzip', 'input': 'filt', 'command': lambda infh, outfh: common.pgunzip(infh, outfh, threads)},
+		{'name': 'markdup', 'input': 'gunzip',
+		 'command': lambda infh, outfh: metrics.update(common.mark_duplicates(infh, outfh, remove_duplicates=True, flagstat=flagstat))},
+		{'name': 'body', 'input': 'markdup', 'command': lambda infh, outfh: strip_header(infh, outfh, headers)},
+		{'name': 'bgzf', 'input': 'body', 'outfile': body_filename,
+		 'command': lambda infh, outfh: common.pgzip(infh, outfh, threads, bgzf=True, eof=False)}])
+	if paired_end:
+		steps.extend(bedpe_steps('markdup', prefix + ".final.nmsrt", bedpe_filename, threads))
+	common.run_dag(steps)
+	if paired_end:
+		os.remove(nmsrt_prefix + ".bam")
+	return {'body': body_filename, 'cross': cross_filename if paired_end else None,
+			'bedpe': bedpe_filename if paired_end else None, 'header': headers[0],
+			'flagstat': flagstat, 'metrics': metrics, 'pbc': pbc}
+
+def coordinate_key(rec):
+	# the order samtools sort puts records in
+	tid, pos = struct.unpack_from('<ii', rec, 4)
+	return (tid & 0xffffffff) << 32 | (pos + 1) << 1 | (struct.unpack_from('<H', rec, 18)[0] & common.BAM_FREVERSE) >> 4
+
+def merge_records(infh, outfh, header, records):
+	# write header, then the records of the uncompressed BAM body infh
+	# merged in coordinate order with the coordinate-sorted records
+	outfh.write(header)
+	decorate = lambda recs: ((coordinate_key(rec), i, rec) for i, rec in enumerate(recs))
+	for key, i, rec in heapq.merge(decorate(common.bam_records(infh)), decorate(records)):
+		outfh.write(rec)
+
+def filter_shards(bam_filename, paired_end, samtools_params, nshards, final_bam_filename, dup_file_qc_filename, pbc_file_qc_filename, final_BEDPE_filename=None):
+	'''
+	main's filtering, duplicate removal and library complexity, run on
+	shards of the BAM's references in parallel.  The shards' sorted
+	outputs are concatenated into final_bam_filename without re-sorting,
+	and pairs with mates on different references, which no one shard has
+	both of, are filtered together afterwards and merged in.  For
+	paired-end data the shards' BEDPE, name-sorted within each shard, is
+	concatenated into final_BEDPE_filename.  Returns the final BAM's
+	flagstat.
+	'''
+	subprocess.check_call(shlex.split("samtools index %s" %(bam_filename)))
+	shards = shard_references(bam_filename, nshards) or [None]
+	print "Filtering in %d shards: %s" %(len(shards), shards)
+	processes = min(cpu_count(), len(shards))
+	threads = max(1, cpu_count()/processes)
+	basename = bam_filename.rstrip('.bam')
+	work = [(bam_filename, references, paired_end, samtools_params, "%s.shard%d" %(basename, i), threads)
+			for i, references in enumerate(shards)]
+	pool = Pool(processes)
+	try:
+		results = pool.map(filter_shard, work)
+	finally:
+		pool.close()
+		pool.join()
+	header = results[0]['header']
+
+	cross = None
+	if paired_end and any(os.path.getsize(result['cross']) for result in results):
+		# the shards wrote their cross-reference reads in coordinate order
+		cross_prefix = basename + ".cross"
+		with open(cross_prefix + ".ubam", 'wb') as fh:
+			fh.write(header)
+			for result in results:
+				with open(result['cross'], 'rb') as crossfh:
+					shutil.copyfileobj(crossfh, fh)
+		with open(cross_prefix + ".ubam", 'rb') as infh, open(cross_prefix + ".bam", 'wb') as outfh:
+			common.pgzip(infh, outfh, bgzf=True)
+		cross = filter_shard((cross_prefix + ".bam", None, paired_end, samtools_params, cross_prefix, cpu_count()))
+		for fn in [cross_prefix + ".ubam", cross_prefix + ".bam"]:
+			os.remove(fn)
+
+	bodies = [result['body'] for result in results]
+	if cross and os.path.getsize(cross['body']):
+		cross_records = cStringIO.StringIO()
+		with open(cross['body'], 'rb') as fh:
+			common.pgunzip(fh, cross_records)
+		cross_records.seek(0)
+		common.run_dag([
+			{'name': 'cat', 'command': "cat %s" %(' '.join(bodies))},
+			{'name': 'gunzip', 'input': 'cat', 'command': common.pgunzip},
+			{'name': 'merge', 'input': 'gunzip',
+			 'command': lambda infh, outfh: merge_records(infh, outfh, header, common.bam_records(cross_records))},
+			{'name': 'bgzf', 'input': 'merge', 'outfile': final_bam_filename,
+			 'command': lambda infh, outfh: common.pgzip(infh, outfh, bgzf=True)}])
+	else:
+		# BGZF blocks concatenate, so only the header is compressed here
+		with open(final_bam_filename, 'wb') as outfh:
+			common.pgzip(cStringIO.StringIO(header), outfh, bgzf=True, eof=False)
+			for body in bodies:
+				with open(body, 'rb') as fh:
+					shutil.copyfileobj(fh, outfh, 4*1024*1024)
+			outfh.write(common.BGZF_EOF)
+	if cross:
+		results.append(cross)
+	if paired_end:
+		# gzip members concatenate
+		with open(final_BEDPE_filename, 'wb') as outfh:
+			for result in results:
+				with open(result['bedpe'], 'rb') as fh:
+					shutil.copyfileobj(fh, outfh, 4*1024*1024)
+	for result in results:
+		for fn in [result['body'], result['cross'], result['bedpe']]:
+			if fn and os.path.exists(fn):
+				os.remove(fn)
+
+	flagstat = common.FlagStat()
+	for result in results:
+		flagstat.update(result['flagstat'])
+	common.write_duplication_metrics(common.combine_duplication_metrics([result['metrics'] for result in results]),
+		dup_file_qc_filename, 'mark_duplicates REMOVE_DUPLICATES=true OPTICAL_DUPLICATE_PIXEL_DISTANCE=100')
+	pbc = [sum(counts) for counts in zip(*[result['pbc'] for result in results])]
+	with open(pbc_file_qc_filename, 'w') as fh:
+		fh.write(pbc_line(*pbc))
+	return flagstat
+
 def run_pipe(steps, outfile=None):
 	#break this out into a recursive function
 	#TODO:  capture stderr
@@ -52,7 +408,7 @@ def run_pipe(steps, outfile=None):
 	return out,err
 
 @dxpy.entry_point('main')
-def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None, debug=False): #
+def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None, debug=False, shards=1, picard=True): #
 
 	if debug:
 		logger.setLevel(logging.DEBUG)
@@ -68,6 +424,10 @@ def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None,
 			paired_end = input_JSON['paired_end']
 		if 'samtools_params' in input_JSON:
 			samtools_params = input_JSON['samtools_params']
+		if 'shards' in input_JSON:
+			shards = input_JSON['shards']
+		if 'picard' in input_JSON:
+			picard = input_JSON['picard']
 
 
 	if not input_bam:
@@ -92,62 +452,7 @@ def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None,
 
 	print subprocess.check_output('ls -l', shell=True)
 
-	filt_bam_prefix = raw_bam_basename + ".filt.srt" 
-	filt_bam_filename = filt_bam_prefix + ".bam"
-	if paired_end:
-		# =============================
-		# Remove  unmapped, mate unmapped
-		# not primary alignment, reads failing platform
-		# Remove low MAPQ reads
-		# Only keep properly paired reads
-		# Obtain name sorted BAM file
-		# ==================
-		tmp_filt_bam_prefix = "tmp.%s" %(filt_bam_prefix) #was tmp.prefix.nmsrt
-		tmp_filt_bam_filename = tmp_filt_bam_prefix + ".bam"
-		out,err = run_pipe([
-			#filter:  -F 1804 FlAG bits to exclude; -f 2 FLAG bits to reqire; -q 30 exclude MAPQ < 30; -u uncompressed output
-			#exclude FLAG 1804: unmapped, next segment unmapped, secondary alignments, not passing platform q, PCR or optical duplicates
-			#require FLAG 2: properly aligned
-			"samtools view -F 1804 -f 2 %s -u %s" %(samtools_params, raw_bam_filename),
-			#sort:  -n sort by name; - take input from stdin; out to specified filename
-			"samtools sort -n - %s" %(tmp_filt_bam_prefix)])  # Will produce name sorted BAM
-		if err:
-			logger.error("samtools error: %s" %(err))
-		# Remove orphan reads (pair was removed)
-		# and read pairs mapping to different chromosomes
-		# Obtain position sorted BAM
-		print subprocess.check_output('ls -l', shell=True)
-		out,err = run_pipe([
-			#fill in mate coordinates, ISIZE and mate-related flags
-			#fixmate requires name-sorted alignment; -r removes secondary and unmapped (redundant here because already done above?)
-			#- send output to stdout
-			"samtools fixmate -r %s -" %(tmp_filt_bam_filename),
-			#repeat filtering after mate repair
-			"samtools view -F 1804 -f 2 -u -",
-			#produce the coordinate-sorted BAM
-			"samtools sort - %s" %(filt_bam_prefix)])
-		print subprocess.check_output('ls -l', shell=True)
-	else: #single-end data
-		# =============================
-		# Remove unmapped, mate unmapped
-		# not primary alignment, reads failing platform
-		# Remove low MAPQ reads
-		# Obtain name sorted BAM file
-		# ==================  
-		with open(filt_bam_filename, 'w') as fh:
-			subprocess.check_call(shlex.split("samtools view -F 1804 %s -b %s"
-				%(samtools_params, raw_bam_filename)), stdout=fh)
-
-	# ========================
-	# Mark duplicates
-	# ======================
-	tmp_filt_bam_filename = raw_bam_basename + ".dupmark.bam"
 	dup_file_qc_filename = raw_bam_basename + ".dup.qc"
-	subprocess.check_call(shlex.split(
-		"java -Xmx4G -jar /picard/MarkDuplicates.jar INPUT=%s OUTPUT=%s METRICS_FILE=%s \
-		 VALIDATION_STRINGENCY=LENIENT ASSUME_SORTED=true REMOVE_DUPLICATES=false"
-		 %(filt_bam_filename, tmp_filt_bam_filename, dup_file_qc_filename)))
-	os.rename(tmp_filt_bam_filename,filt_bam_filename)
 
 	if paired_end:
 		final_bam_prefix = raw_bam_basename + ".filt.srt.nodup"
@@ -156,64 +461,128 @@ def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None,
 	final_bam_filename = final_bam_prefix + ".bam" # To be stored
 	final_bam_index_filename = final_bam_prefix + ".bai" # To be stored
 	final_bam_file_mapstats_filename = final_bam_prefix + ".flagstat.qc" # QC file
-
 	if paired_end:
-		# ============================
-		# Remove duplicates
-		# Index final position sorted BAM
-		# Create final name sorted BAM
-		# ============================
-		with open(final_bam_filename, 'w') as fh:
-			subprocess.check_call(shlex.split("samtools view -F 1804 -f2 -b %s"
-				%(filt_bam_filename)), stdout=fh)
-		#namesorting is needed for bam->bedPE, so moved to xcor
-		#final_nmsrt_bam_prefix = raw_bam_basename + ".filt.nmsrt.nodup"
-		#final_nmsrt_bam_filename = final_nmsrt_bam_prefix + ".bam"
-		#subprocess.check_call(shlex.split("samtools sort -n %s %s" %(final_bam_filename, final_nmsrt_bam_prefix)))
+		final_BEDPE_filename = final_bam_prefix + ".bedpe.gz" # To be stored
+	else:
+		final_BEDPE_filename = None
+	pbc_file_qc_filename = final_bam_prefix + ".pbc.qc"
+
+	if shards > 1:
+		# =============================
+		# Filter, remove duplicates and
+		# compute library complexity
+		# for shards of the references
+		# in parallel
+		# =============================
+		if picard:
+			logger.warning("Marking duplicates in process, as sharding needs to")
+		final_flagstat = filter_shards(raw_bam_filename, paired_end, samtools_params, shards,
+			final_bam_filename, dup_file_qc_filename, pbc_file_qc_filename, final_BEDPE_filename)
 	else:
-		# ============================
-		# Remove duplicates
-		# Index final position sorted BAM
-		# ============================
-		with open(final_bam_filename, 'w') as fh:
-			subprocess.check_call(shlex.split("samtools view -F 1804 -b %s"
-				%(filt_bam_filename)), stdout=fh)
+		filt_bam_prefix = raw_bam_basename + ".filt.srt" 
+		filt_bam_filename = filt_bam_prefix + ".bam"
+		if paired_end:
+			# =============================
+			# Remove  unmapped, mate unmapped
+			# not primary alignment, reads failing platform
+			# Remove low MAPQ reads
+			# Only keep properly paired reads
+			# Obtain name sorted BAM file
+			# ==================
+			tmp_filt_bam_prefix = "tmp.%s" %(filt_bam_prefix) #was tmp.prefix.nmsrt
+			tmp_filt_bam_filename = tmp_filt_bam_prefix + ".bam"
+			out,err = run_pipe([
+				#filter:  -F 1804 FlAG bits to exclude; -f 2 FLAG bits to reqire; -q 30 exclude MAPQ < 30; -u uncompressed output
+				#exclude FLAG 1804: unmapped, next segment unmapped, secondary alignments, not passing platform q, PCR or optical duplicates
+				#require FLAG 2: properly aligned
+				"samtools view -F 1804 -f 2 %s -u %s" %(samtools_params, raw_bam_filename),
+				#sort:  -n sort by name; - take input from stdin; out to specified filename
+				"samtools sort -n - %s" %(tmp_filt_bam_prefix)])  # Will produce name sorted BAM
+			if err:
+				logger.error("samtools error: %s" %(err))
+			# Remove orphan reads (pair was removed)
+			# and read pairs mapping to different chromosomes
+			# Obtain position sorted BAM
+			# fixmate's output is still name sorted, so the bedPE for
+			# library complexity is made from it rather than by sorting
+			# the filtered BAM by name again
+			print subprocess.check_output('ls -l', shell=True)
+			out,err = common.run_dag([
+				#fill in mate coordinates, ISIZE and mate-related flags
+				#fixmate requires name-sorted alignment; -r removes secondary and unmapped (redundant here because already done above?)
+				#- send output to stdout
+				{'name': 'fixmate', 'command': "samtools fixmate -r %s -" %(tmp_filt_bam_filename)},
+				#repeat filtering after mate repair
+				{'name': 'refilt', 'input': 'fixmate', 'command': "samtools view -F 1804 -f 2 -u -"},
+				#produce the coordinate-sorted BAM
+				{'name': 'sort', 'input': 'refilt', 'command': "samtools sort - %s" %(filt_bam_prefix)},
+				#convert to bedPE and obtain fragment coordinates
+				#count read pairs at each position and strand in memory
+				{'name': 'bed', 'input': 'refilt', 'command': "bamToBed -bedpe -i stdin"},
+				{'name': 'pbc', 'input': 'bed', 'outfile': pbc_file_qc_filename,
+				 'command': lambda infh, outfh: outfh.write(library_complexity(infh, paired_end, exclude_chroms='chrM'))}])
+			print subprocess.check_output('ls -l', shell=True)
+		else: #single-end data
+			# =============================
+			# Remove unmapped, mate unmapped
+			# not primary alignment, reads failing platform
+			# Remove low MAPQ reads
+			# Obtain name sorted BAM file
+			# ==================  
+			with open(filt_bam_filename, 'w') as fh:
+				subprocess.check_call(shlex.split("samtools view -F 1804 %s -b %s"
+					%(samtools_params, raw_bam_filename)), stdout=fh)
+
+		# ========================
+		# Mark duplicates
+		# and remove them
+		# ======================
+		# The filtered BAM already has only the -F 1804 (and for PE -f 2) reads,
+		# so dropping duplicates as they are found leaves the final BAM, with
+		# Picard's METRICS_FILE alongside.
+		# For paired-end data the final reads are also name sorted once
+		# here for the BEDPE, which xcor and bam2tagAlign take as is
+		final_flagstat = common.FlagStat()
+		if picard:
+			subprocess.check_call(shlex.split(
+				"java -Xmx4G -jar /picard/MarkDuplicates.jar INPUT=%s OUTPUT=%s METRICS_FILE=%s \
+				 VALIDATION_STRINGENCY=LENIENT ASSUME_SORTED=true REMOVE_DUPLICATES=true"
+				 %(filt_bam_filename, final_bam_filename, dup_file_qc_filename)))
+			final_flagstat.add_report(subprocess.check_output(shlex.split("samtools flagstat %s" %(final_bam_filename))))
+			if paired_end:
+				out,err = common.run_dag(
+					[{'name': 'gunzip', 'input': final_bam_filename, 'command': common.pgunzip}] +
+					bedpe_steps('gunzip', final_bam_prefix + ".nmsrt", final_BEDPE_filename))
+		else:
+			# the flagstat counts are of the reads written, so the final
+			# BAM need not be read again for them
+			steps = [
+				{'name': 'gunzip', 'input': filt_bam_filename, 'command': common.pgunzip},
+				{'name': 'markdup', 'input': 'gunzip',
+				 'command': lambda infh, outfh: common.mark_duplicates(infh, outfh, dup_file_qc_filename, remove_duplicates=True, flagstat=final_flagstat)},
+				{'name': 'bgzf', 'input': 'markdup', 'outfile': final_bam_filename,
+				 'command': lambda infh, outfh: common.pgzip(infh, outfh, bgzf=True)}]
+			if paired_end:
+				steps.extend(bedpe_steps('markdup', final_bam_prefix + ".nmsrt", final_BEDPE_filename))
+			out,err = common.run_dag(steps)
+
+		# =============================
+		# Compute library complexity
+		# =============================
+		# (paired-end PBC was computed from fixmate's output above)
+		# convert to bed and obtain read coordinates
+		# count reads at each position and strand in memory
+		if not paired_end:
+			#TODO chrM should be implemented as an explicit list of allowable names, so that mapping can be done to a complete reference
+			out,err = common.run_dag([
+				{'name': 'bed', 'command': "bamToBed -i %s" %(filt_bam_filename)}, #for some reason 'bedtools bamtobed' does not work but bamToBed does
+				{'name': 'pbc', 'input': 'bed', 'outfile': pbc_file_qc_filename,
+				 'command': lambda infh, outfh: outfh.write(library_complexity(infh, paired_end, exclude_chroms='chrM'))}])
+
 	# Index final bam file
 	subprocess.check_call(shlex.split("samtools index %s %s" %(final_bam_filename, final_bam_index_filename)))
 	# Generate mapping statistics
-	with open(final_bam_file_mapstats_filename, 'w') as fh:
-		subprocess.check_call(shlex.split("samtools flagstat %s"
-			%(final_bam_filename)), stdout=fh)
-
-	# =============================
-	# Compute library complexity
-	# =============================
-	# Sort by name
-	# convert to bedPE and obtain fragment coordinates
-	# sort by position and strand
-	# Obtain unique count statistics
-	pbc_file_qc_filename = final_bam_prefix + ".pbc.qc"
-	# PBC File output
-	# TotalReadPairs [tab] DistinctReadPairs [tab] OneReadPair [tab] TwoReadPairs [tab] NRF=Distinct/Total [tab] PBC1=OnePair/Distinct [tab] PBC2=OnePair/TwoPair
-	if paired_end:
-		steps = [
-			"samtools sort -no %s -" %(filt_bam_filename),
-			"bamToBed -bedpe -i stdin",
-			r"""awk 'BEGIN{OFS="\t"}{print $1,$2,$4,$6,$9,$10}'"""]
-	else:
-		steps = [
-			"bamToBed -i %s" %(filt_bam_filename), #for some reason 'bedtools bamtobed' does not work but bamToBed does
-			r"""awk 'BEGIN{OFS="\t"}{print $1,$2,$3,$6}'"""]
-	# these st
-	steps.extend([
-		"grep -v 'chrM'", #TODO this should be implemented as an explicit list of allowable names, so that mapping can be done to a complete reference
-		"sort",
-		"uniq -c",
-		r"""awk 'BEGIN{mt=0;m0=0;m1=0;m2=0} ($1==1){m1=m1+1} ($1==2){m2=m2+1} {m0=m0+1} {mt=mt+$1} END{printf "%d\t%d\t%d\t%d\t%f\t%f\t%f\n",mt,m0,m1,m2,m0/mt,m1/m0,m1/m2}'"""
-		])
-	out,err = run_pipe(steps,pbc_file_qc_filename)
-	if err:
-		print "PBC file error: %s" %(err)
+	final_flagstat.write(final_bam_file_mapstats_filename)
 
 	print "Uploading results files to the project"
 	# Use the Python bindings to upload the file outputs to the project.
@@ -222,6 +591,8 @@ def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None,
 	filtered_mapstats = dxpy.upload_local_file(final_bam_file_mapstats_filename)
 	dup_file_qc = dxpy.upload_local_file(dup_file_qc_filename)
 	pbc_file_qc = dxpy.upload_local_file(pbc_file_qc_filename)
+	if paired_end:
+		BEDPE_file = dxpy.upload_local_file(final_BEDPE_filename)
 
 	# Return links to the output files
 	output = {
@@ -232,6 +603,8 @@ def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None,
 		"pbc_file_qc": dxpy.dxlink(pbc_file_qc),
 		"paired_end": paired_end
 	}
+	if paired_end:
+		output.update({"BEDPE_file": dxpy.dxlink(BEDPE_file)})
 	output.update({'output_JSON': output.copy()})
 
 	print "Exiting with output: %s" %(output)
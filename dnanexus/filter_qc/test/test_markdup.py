@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# filter_qc duplicate marking, flagstat and library complexity unit tests
+
+import imp, os, struct, sys, unittest
+from StringIO import StringIO
+
+import dxpy
+
+src_dir = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(src_dir, "resources", "home", "dnanexus"))
+
+import common
+
+def load_applet():
+    # the applet calls dxpy.run() when it is imported
+    run = dxpy.run
+    dxpy.run = lambda *args, **kwargs: None
+    try:
+        return imp.load_source('filter_qc', os.path.join(src_dir, "src", "filter_qc.py"))
+    finally:
+        dxpy.run = run
+
+filter_qc = load_applet()
+
+REFERENCES = [('chr1', 1000000), ('chr2', 1000000)]
+
+PAIRED, PROPER, MATE_UNMAPPED, REVERSE, MATE_REVERSE, READ1, READ2 = 0x1, 0x2, 0x8, 0x10, 0x20, 0x40, 0x80
+
+def bam_record(name, flag, ref, pos, cigar, quals, mate_ref=-1, mate_pos=-1):
+    # cigar is a list of (length, op code); the sequence is all Ns
+    body = struct.pack('<iiBBHHHiiii', ref, pos, len(name) + 1, 60, 0, len(cigar), flag, len(quals), mate_ref, mate_pos, 0)
+    body += name + '\x00'
+    body += ''.join(struct.pack('<I', length << 4 | op) for length, op in cigar)
+    body += '\xff'*((len(quals) + 1)/2)
+    body += ''.join(chr(q) for q in quals)
+    return struct.pack('<i', len(body)) + body
+
+def bam_stream(records):
+    text = '@HD\tVN:1.0\tSO:coordinate\n'
+    refs = ''.join(struct.pack('<i', len(name) + 1) + name + '\x00' + struct.pack('<i', length) for name, length in REFERENCES)
+    return StringIO(common.BAM_MAGIC + struct.pack('<i', len(text)) + text + struct.pack('<i', len(REFERENCES)) + refs + ''.join(records))
+
+def mark(records, **kwargs):
+    # {read name: [duplicate flag of each of its records]} and the metrics
+    outfh = StringIO()
+    metrics = common.mark_duplicates(bam_stream(records), outfh, **kwargs)
+    outfh.seek(0)
+    common.read_bam_header(outfh)
+    flags = {}
+    for rec in common.bam_records(outfh):
+        l_read_name = struct.unpack_from('<B', rec, 12)[0]
+        flag = struct.unpack_from('<H', rec, 18)[0]
+        flags.setdefault(rec[36:35 + l_read_name], []).append(bool(flag & common.BAM_FDUP))
+    return flags, metrics['Unknown Library']
+
+def pair(name, left, right, left_quals, right_quals, clip=0):
+    # a forward read1 at left and a reverse read2 at right, each 10 bases
+    cigar = [(clip, 4), (10 - clip, 0)] if clip else [(10, 0)]
+    return [(left, bam_record(name, PAIRED | PROPER | MATE_REVERSE | READ1, 0, left, cigar, left_quals, 0, right)),
+            (right, bam_record(name, PAIRED | PROPER | REVERSE | READ2, 0, right, [(10, 0)], right_quals, 0, left))]
+
+def in_order(*reads):
+    return [rec for pos, rec in sorted(sum(reads, []), key=lambda read: read[0])]
+
+class TestMarkDuplicates(unittest.TestCase):
+    def test_unpaired_highest_score_kept(self):
+        records = [bam_record('a', 0, 0, 100, [(10, 0)], [20]*10),
+                   bam_record('b', 0, 0, 100, [(10, 0)], [30]*10),
+                   bam_record('c', 0, 0, 100, [(10, 0)], [25]*10)]
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [True], 'b': [False], 'c': [True]})
+        self.assertEqual(metrics['UNPAIRED_READS_EXAMINED'], 3)
+        self.assertEqual(metrics['UNPAIRED_READ_DUPLICATES'], 2)
+
+    def test_score_counts_only_qualities_from_15(self):
+        # b's qualities add up to more, but only a's all count
+        records = [bam_record('a', 0, 0, 100, [(10, 0)], [20]*10),
+                   bam_record('b', 0, 0, 100, [(10, 0)], [40]*4 + [14]*6)]
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [False], 'b': [True]})
+
+    def test_tie_keeps_first(self):
+        records = [bam_record('a', 0, 0, 100, [(10, 0)], [30]*10),
+                   bam_record('b', 0, 0, 100, [(10, 0)], [30]*10)]
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [False], 'b': [True]})
+
+    def test_unclipped_five_prime(self):
+        # soft clipped reads are grouped by where they would have started,
+        # reverse reads by their (unclipped) end
+        records = [bam_record('a', 0, 0, 95, [(10, 0)], [20]*10),
+                   bam_record('b', 0, 0, 100, [(5, 4), (5, 0)], [30]*10),
+                   bam_record('c', REVERSE, 0, 200, [(8, 0), (2, 4)], [20]*10),
+                   bam_record('d', REVERSE, 0, 200, [(10, 0)], [40]*10),
+                   bam_record('e', REVERSE, 0, 202, [(8, 0)], [30]*8)]
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [True], 'b': [False], 'c': [True], 'd': [False], 'e': [True]})
+
+    def test_strands_differ(self):
+        records = [bam_record('a', 0, 0, 100, [(10, 0)], [20]*10),
+                   bam_record('b', REVERSE, 0, 91, [(10, 0)], [20]*10)]
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [False], 'b': [False]})
+
+    def test_pairs_by_summed_score(self):
+        # b has the best read but a the best pair
+        records = in_order(pair('a', 100, 300, [30]*10, [30]*10),
+                           pair('b', 100, 300, [40]*10, [15]*10),
+                           pair('c', 100, 301, [20]*10, [20]*10))
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [False, False], 'b': [True, True], 'c': [False, False]})
+        self.assertEqual(metrics['READ_PAIRS_EXAMINED'], 3)
+        self.assertEqual(metrics['READ_PAIR_DUPLICATES'], 1)
+
+    def test_clipped_pair(self):
+        records = in_order(pair('a', 100, 300, [30]*10, [30]*10),
+                           pair('b', 103, 300, [20]*10, [20]*10, clip=3))
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [False, False], 'b': [True, True]})
+
+    def test_unpaired_read_at_a_pair_end(self):
+        # a read whose mate is unmapped is a duplicate of any pair with an
+        # end at the same place, whatever its score
+        records = in_order(pair('a', 100, 300, [20]*10, [20]*10),
+                           [(100, bam_record('b', PAIRED | MATE_UNMAPPED | READ1, 0, 100, [(10, 0)], [40]*10))])
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [False, False], 'b': [True]})
+        self.assertEqual(metrics['UNPAIRED_READS_EXAMINED'], 1)
+        self.assertEqual(metrics['UNPAIRED_READ_DUPLICATES'], 1)
+        self.assertEqual(metrics['READ_PAIR_DUPLICATES'], 0)
+
+    def test_unpaired_reads_without_a_pair(self):
+        records = [bam_record('a', PAIRED | MATE_UNMAPPED | READ1, 0, 100, [(10, 0)], [20]*10),
+                   bam_record('b', 0, 0, 100, [(10, 0)], [30]*10)]
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [True], 'b': [False]})
+
+    def test_orphan(self):
+        # a read whose mate should be further on but never comes is kept,
+        # and the stream after it is still settled
+        records = [bam_record('a', PAIRED | PROPER | MATE_REVERSE | READ1, 0, 100, [(10, 0)], [20]*10, 0, 300),
+                   bam_record('b', 0, 0, 500, [(10, 0)], [20]*10),
+                   bam_record('c', 0, 1, 100, [(10, 0)], [20]*10),
+                   bam_record('d', 0, 1, 100, [(10, 0)], [10]*10)]
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [False], 'b': [False], 'c': [False], 'd': [True]})
+        self.assertEqual(metrics['READ_PAIR_DUPLICATES'], 0)
+
+    def test_unmapped_passed_through(self):
+        records = [bam_record('a', 0, 0, 100, [(10, 0)], [20]*10),
+                   bam_record('b', 0x4, -1, -1, [], [20]*10)]
+        flags, metrics = mark(records)
+        self.assertEqual(flags, {'a': [False], 'b': [False]})
+        self.assertEqual(metrics['UNMAPPED_READS'], 1)
+
+    def test_remove_duplicates(self):
+        records = in_order(pair('a', 100, 300, [30]*10, [30]*10),
+                           pair('b', 100, 300, [20]*10, [20]*10))
+        flags, metrics = mark(records, remove_duplicates=True)
+        self.assertEqual(flags, {'a': [False, False]})
+
+    def test_optical_duplicates(self):
+        records = in_order(pair('M:1:FC:1:1101:1000:1000', 100, 300, [30]*10, [30]*10),
+                           pair('M:1:FC:1:1101:1050:1020', 100, 300, [20]*10, [20]*10),
+                           pair('M:1:FC:1:1102:1000:1000', 100, 300, [20]*10, [20]*10))
+        flags, metrics = mark(records)
+        self.assertEqual(metrics['READ_PAIR_DUPLICATES'], 2)
+        self.assertEqual(metrics['READ_PAIR_OPTICAL_DUPLICATES'], 1)
+
+    def test_flagstat_of_written_reads(self):
+        flagstat = common.FlagStat()
+        records = [bam_record('a', 0, 0, 100, [(10, 0)], [20]*10),
+                   bam_record('b', 0, 0, 100, [(10, 0)], [30]*10)]
+        mark(records, flagstat=flagstat)
+        counts = flagstat.tally()
+        self.assertEqual(counts['in_total'], [2, 0])
+        self.assertEqual(counts['duplicates'], [1, 0])
+
+# what samtools 0.1.19 flagstat prints for FLAGSTAT_SAM
+FLAGSTAT_REPORT = '''6 + 1 in total (QC-passed reads + QC-failed reads)
+1 + 0 duplicates
+5 + 1 mapped (83.33%:100.00%)
+4 + 1 paired in sequencing
+3 + 0 read1
+1 + 1 read2
+2 + 0 properly paired (50.00%:0.00%)
+3 + 1 with itself and mate mapped
+1 + 0 singletons (25.00%:0.00%)
+1 + 1 with mate mapped to a different chr
+1 + 0 with mate mapped to a different chr (mapQ>=5)
+'''
+
+FLAGSTAT_SAM = [
+    '@HD\tVN:1.0\tSO:coordinate\n',
+    'r1\t99\tchr1\t100\t60\t10M\t=\t300\t210\tNNNNNNNNNN\t##########\n',
+    'r1\t147\tchr1\t300\t60\t10M\t=\t100\t-210\tNNNNNNNNNN\t##########\n',
+    'r2\t1024\tchr1\t100\t3\t10M\t*\t0\t0\tNNNNNNNNNN\t##########\n',
+    'r3\t4\t*\t0\t0\t*\t*\t0\t0\tNNNNNNNNNN\t##########\n',
+    'r4\t73\tchr1\t500\t60\t10M\t=\t500\t0\tNNNNNNNNNN\t##########\n',
+    'r5\t97\tchr1\t700\t60\t10M\tchr2\t100\t0\tNNNNNNNNNN\t##########\n',
+    'r6\t657\tchr2\t100\t2\t10M\tchr1\t900\t0\tNNNNNNNNNN\t##########\n']
+
+class TestFlagStat(unittest.TestCase):
+    def test_report(self):
+        flagstat = common.FlagStat()
+        flagstat.add_sam_lines(FLAGSTAT_SAM)
+        self.assertEqual(str(flagstat), FLAGSTAT_REPORT)
+
+    def test_no_reads(self):
+        self.assertEqual(str(common.FlagStat()).splitlines()[2], '0 + 0 mapped (-nan%:-nan%)')
+
+    def test_add_report(self):
+        flagstat = common.FlagStat()
+        flagstat.add_report(FLAGSTAT_REPORT)
+        flagstat.add_sam_lines(FLAGSTAT_SAM)
+        self.assertEqual(flagstat.tally()['in_total'], [12, 2])
+        self.assertEqual(flagstat.tally()['mate_mapped_different_chr_hiQ'], [2, 0])
+
+    def test_add_report_skips_secondary(self):
+        # samtools 1.x reports have secondary and supplementary lines
+        lines = FLAGSTAT_REPORT.splitlines(True)
+        flagstat = common.FlagStat()
+        flagstat.add_report(''.join(lines[:1] + ['2 + 0 secondary\n', '1 + 0 supplementary\n'] + lines[1:]))
+        self.assertEqual(str(flagstat), FLAGSTAT_REPORT)
+
+    def test_update(self):
+        halves = [common.FlagStat(), common.FlagStat()]
+        halves[0].add_sam_lines(FLAGSTAT_SAM[:4])
+        halves[1].add_sam_lines(FLAGSTAT_SAM[4:])
+        flagstat = common.FlagStat()
+        for half in halves:
+            flagstat.update(half)
+        self.assertEqual(str(flagstat), FLAGSTAT_REPORT)
+
+class TestLibraryComplexity(unittest.TestCase):
+    def test_single_end(self):
+        bed = StringIO(
+            'chr1\t100\t136\tr1\t60\t+\n'
+            'chr1\t100\t136\tr2\t60\t+\n'
+            'chr1\t100\t136\tr3\t60\t-\n'
+            'chr1\t200\t236\tr4\t60\t+\n'
+            'chr1\t200\t236\tr5\t60\t+\n'
+            'chr2\t100\t136\tr6\t60\t+\n'
+            'chrM\t100\t136\tr7\t60\t+\n')
+        self.assertEqual(filter_qc.complexity_counts(bed, False), (6, 4, 2, 2))
+
+    def test_paired_end(self):
+        bed = StringIO(
+            'chr1\t100\t136\tchr1\t300\t336\tp1\t60\t+\t-\n'
+            'chr1\t100\t136\tchr1\t300\t336\tp2\t60\t+\t-\n'
+            'chr1\t100\t136\tchr1\t300\t337\tp3\t60\t+\t-\n'
+            'chr1\t100\t136\tchr2\t300\t336\tp4\t60\t+\t-\n')
+        self.assertEqual(filter_qc.complexity_counts(bed, True), (4, 3, 2, 1))
+
+    def test_pbc_line(self):
+        self.assertEqual(filter_qc.pbc_line(6, 4, 2, 2), '6\t4\t2\t2\t0.666667\t0.500000\t1.000000\n')
+        self.assertEqual(filter_qc.pbc_line(0, 0, 0, 0), '0\t0\t0\t0\tNA\tNA\tNA\n')
+
+    def test_count_duplicates_wide_keys(self):
+        # keys too wide to pack into 64 bits are counted by lexsort
+        import numpy as np
+        columns = [np.array([0, 0, 1, 0], dtype=np.int64),
+                   np.array([0, 2**40, 0, 0], dtype=np.int64),
+                   np.array([0, 2**40, 0, 0], dtype=np.int64)]
+        self.assertEqual(sorted(filter_qc.count_duplicates(columns)), [1, 1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
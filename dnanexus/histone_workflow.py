@@ -312,14 +312,19 @@ def main():
                 )
                 mapping_superstage.update({'filter_qc_stage_id': filter_qc_stage_id})
 
+                xcor_stage_input = {
+                    'input_bam': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'filtered_bam'}),
+                    'paired_end': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'paired_end'})
+                }
+                # filter_qc only has a BEDPE_file for paired-end reads, which
+                # are given as read1,read2
+                if not blank_workflow and len(mapping_superstage['input_args']) == 2:
+                    xcor_stage_input.update({'input_bedpe': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'BEDPE_file'})})
                 xcor_stage_id = workflow.add_stage(
                     xcor_applet,
                     name='Xcor %s' %(superstage_name),
                     folder=xcor_output_folder,
-                    stage_input={
-                        'input_bam': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'filtered_bam'}),
-                        'paired_end': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'paired_end'})
-                    }
+                    stage_input=xcor_stage_input
                 )
                 mapping_superstage.update({'xcor_stage_id': xcor_stage_id})
 
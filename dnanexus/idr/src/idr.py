@@ -13,6 +13,7 @@
 
 import os, re, logging, subprocess, shlex, sys, time, math
 import dxpy
+import common
 
 def run_pipe(steps, outfile=None, debug=True):
     #break this out into a recursive function
@@ -60,29 +61,6 @@ def run_pipe(steps, outfile=None, debug=True):
         print "stderr: %s" %(err)
     return out,err
 
-def common_peaks(pooled_peaks_filename, rep1_peaks_filename, rep2_peaks_filename, pooled_common_peaks_filename):
-    print pooled_peaks_filename
-    print rep1_peaks_filename
-    print rep2_peaks_filename
-    print pooled_common_peaks_filename
-    return run_pipe([
-        'intersectBed -u -a %s -b %s' %(pooled_peaks_filename, rep1_peaks_filename),
-        'intersectBed -u -a - -b %s' %(rep2_peaks_filename),
-        'sort -k7n,7n -k1,1 -k2n,2n -k3n,3n -k10n,10n'
-        #'gzip -c'
-    ], pooled_common_peaks_filename)
-
-def common_peaks_recalibrated(pooled_common_peaks_filename, rep_peaks_filename, common_match_filename):
-    #time.sleep(3600)
-    return run_pipe([
-        'intersectBed -wa -wb -a %s -b %s' %(pooled_common_peaks_filename, rep_peaks_filename),
-        r"""awk 'BEGIN{OFS="\t"}{d=$2+$10-$12-$20;$21=sqrt(d^2);print $0}'""",
-        'groupBy -i - -g 1,2,3,10 -c 21 -o min -full',
-        'sort -k7n,7n -k1,1 -k2n,2n -k3n,3n -k10n,10n',
-        r"""awk 'BEGIN{OFS="\t"}{print $1,$2+$10-2,$2+$10+2,$4,$5,$6,$17,$18,$19,2}'"""
-        #'qzip -c'
-    ], common_match_filename)
-
 def uncompress(filename):
     m = re.match('(.*)(\.((gz)|(Z)|(bz)|(bz2)))',filename)
     if m:
@@ -113,7 +91,6 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
         # Find peaks in pooled set common to both replicates
         # =============================
         pooled_common_peaks_filename = '%s_pool_common.narrowPeak' %(os.path.basename(pooled_peaks_filename))
-        common_peaks(pooled_peaks_filename, rep1_peaks_filename, rep2_peaks_filename, pooled_common_peaks_filename)
 
         # =============================
         # Create 2 new peak file per replicate with coordinates from common pooled set
@@ -123,8 +100,10 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
         common_rep1_match_filename = '%s_common_match.narrowPeak' %(os.path.basename(rep1_peaks_filename))
         common_rep2_match_filename = '%s_common_match.narrowPeak' %(os.path.basename(rep2_peaks_filename))
 
-        common_peaks_recalibrated(pooled_common_peaks_filename, rep1_peaks_filename, common_rep1_match_filename)
-        common_peaks_recalibrated(pooled_common_peaks_filename, rep2_peaks_filename, common_rep2_match_filename)
+        # the three peak sets are read once for both steps
+        pooled_common_peaks = common.idr_match_peaks(
+            pooled_peaks_filename, [rep1_peaks_filename, rep2_peaks_filename],
+            pooled_common_peaks_filename, [common_rep1_match_filename, common_rep2_match_filename])
 
         # =============================
         # Pass recalibrated peak files to IDR
@@ -159,27 +138,11 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
         # =============================
         IDR_overlap_filename = rep1_vs_rep2_prefix + '-overlapped-peaks.txt'
         IDR_overlap_narrowpeak_filename = rep1_vs_rep2_prefix + '-overlapped-peaks.narrowPeak'
-        run_pipe([
-            'sed 1d %s' %(IDR_overlap_filename),
-            r"""sed 's/"//g'""", # why was there a -r r"""sed -r 's/"//g'""" Don't need it bcz this is not an extended regex and some seds don't support -r
-            'sort -k11g,11g',
-            r"""awk '{if ($3 <=$7) st=$3 ; else st=$7 ; if ($4 >= $8) sto=$4 ; else sto=$8 ; printf "%s\t%d\t%d\t%d\t%s\t.\t%s\t%f\t%f\n",$2,st,sto,NR,$5,$9,$10,$11}'"""
-            #'gzip -c'
-        ], IDR_overlap_narrowpeak_filename)
-
-        # =============================
-        # Create a recalibrated vesion of ${POOLED_COMMON_PEAKS} where coordinates are to be +/- 2 bp from pooled set summit.
-        # This is so we can match it with IDR output and retranslate back to original pooled set coordinates
-        # =============================
-        recalibrated_pooled_common_peaks_filename = 'recalibrated_pooled_common.narrowPeak'
-        run_pipe([
-            'cat %s' %(pooled_common_peaks_filename),
-            r"""awk 'BEGIN{OFS="\t"}{$11=$2;$12=$3;$2=$2+$10-2;$3=$2+$10+2; print $0}'"""
-            #'gzip -c'
-        ], recalibrated_pooled_common_peaks_filename)
+        IDR_overlap_peaks = common.idr_overlapped_peaks(IDR_overlap_filename, IDR_overlap_narrowpeak_filename)
 
         # =============================
-        # Overlap IDR output with ${RECAL_POOLED_COMMON_PEAKS} to add in IDR scores and switch back to original common pooled set coordinates
+        # Match the IDR output to the pooled common peaks +/- 2 bp from their summits to add in IDR scores
+        # and switch back to original common pooled set coordinates
         # Columns 1-10 are same as pooled common peaks columns
         # Col 11: ranking measure from Rep1
         # Col 12: ranking measure from Rep2
@@ -188,11 +151,7 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
         # IMPORTANT: DCC should store this file! All other files are temporary
         # =============================
         pooled_common_peaks_IDR_filename = rep1_vs_rep2_prefix + ".pooled_common_IDRv%d.narrowPeak" %(idr_version)
-        run_pipe([
-            'bedtools intersect -wa -wb -a %s -b %s' %(recalibrated_pooled_common_peaks_filename, IDR_overlap_narrowpeak_filename),
-            r"""awk 'BEGIN{OFS="\t"}{print $1,$11,$12,$4,$5,$6,$7,$8,$9,$10,$17,$19,$20,$21}'"""
-            #'gzip -c'
-        ], pooled_common_peaks_IDR_filename)
+        common.idr_pooled_table(pooled_common_peaks, IDR_overlap_peaks, pooled_common_peaks_IDR_filename)
 
         print "Files after IDR"
         print subprocess.check_output('ls -la', shell=True)
@@ -204,13 +163,6 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
         return pooled_common_peaks_IDR_filename, IDR_overlap_narrowpeak_filename
 
     elif idr_version == 2:
-        for command in [
-            "sudo mv /etc/apt/apt.conf.d/99dnanexus /tmp",
-            "sudo add-apt-repository -y ppa:fkrull/deadsnakes",
-            "sudo apt-get update",
-            "sudo apt-get -y install python3.4-dev libfreetype6-dev",
-            ]:
-            print subprocess.check_output(shlex.split(command), stderr=subprocess.STDOUT)
         pooled_common_peaks_IDR_filename = rep1_vs_rep2_prefix + ".pooled_common_IDRv%d.narrowPeak" %(idr_version)
         log_filename = rep1_vs_rep2_prefix + ".log.txt"
         print "Files before calling IDR"
@@ -221,22 +173,16 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
         print subprocess.check_output('head %s' %(rep2_peaks_filename), shell=True)
         print "Pool head"
         print subprocess.check_output('head %s' %(pooled_peaks_filename), shell=True)
-        idr_command = ( "env3/bin/python env3/idr/bin/idr "
-                        "--plot "
-                        "--rank %s "
-                        "--output-file %s "
-                        "--log-output-file %s "
-                        "--peak-list %s "
-                        "--samples %s %s"
-                        %(  rank,
-                            pooled_common_peaks_IDR_filename,
-                            log_filename,
-                            pooled_peaks_filename,
-                            rep1_peaks_filename, rep2_peaks_filename))
-        print idr_command
-        process = subprocess.Popen(shlex.split(idr_command), stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-        for line in iter(process.stdout.readline, ''):
-            sys.stdout.write(line)
+        # IDR v2 is scored here with NumPy, rather than by the python3 idr package
+        # that had to be installed on every job
+        print "IDR v2 is experimental here: common.idr2_peaks has not yet been compared with the idr package (idr2_compare.py)"
+        common.idr2_peaks(
+            common.read_peaks(pooled_peaks_filename),
+            [common.read_peaks(rep1_peaks_filename), common.read_peaks(rep2_peaks_filename)],
+            pooled_common_peaks_IDR_filename,
+            log_filename,
+            rank=rank,
+            plot_fn=pooled_common_peaks_IDR_filename + '.png')
         print "Files after IDR"
         print subprocess.check_output('ls -la', shell=True)
         print "Head log %s" %(log_filename)
@@ -247,13 +193,11 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
 
 
 @dxpy.entry_point('main')
-def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive):
+def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive, idr_version=1):
 
     # Initialize the data object inputs on the platform into
     # dxpy.DXDataObject instances.
 
-    idr_version = 1
-
     rep1_peaks_file = dxpy.DXFile(rep1_peaks)
     rep2_peaks_file = dxpy.DXFile(rep2_peaks)
     pooled_peaks_file = dxpy.DXFile(pooled_peaks)
@@ -341,7 +285,9 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive)
 
     npeaks_pass = dxpy.upload_local_file(npeaks_pass_filename)
     IDR_output = dxpy.upload_local_file(compress(pooled_common_peaks_IDR_filename))
-    IDR_peaks = dxpy.upload_local_file(compress(final_IDR_thresholded_filename))
+    IDR_peaks_filename = compress(final_IDR_thresholded_filename)
+    IDR_peaks = dxpy.upload_local_file(IDR_peaks_filename,
+        properties=common.record_counts(IDR_peaks_filename, n_peaks, sort_order='-k7n,7n'))
 
     #
     # return { "app_output_field": postprocess_job.get_output_ref("answer"), ...}
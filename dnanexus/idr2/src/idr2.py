@@ -13,6 +13,7 @@
 
 import os, re, logging, subprocess, shlex, sys, time, math
 import dxpy
+import common
 
 def run_pipe(steps, outfile=None, debug=True):
     #break this out into a recursive function
@@ -60,29 +61,6 @@ def run_pipe(steps, outfile=None, debug=True):
         print "stderr: %s" %(err)
     return out,err
 
-def common_peaks(pooled_peaks_filename, rep1_peaks_filename, rep2_peaks_filename, pooled_common_peaks_filename):
-    print pooled_peaks_filename
-    print rep1_peaks_filename
-    print rep2_peaks_filename
-    print pooled_common_peaks_filename
-    return run_pipe([
-        'intersectBed -u -a %s -b %s' %(pooled_peaks_filename, rep1_peaks_filename),
-        'intersectBed -u -a - -b %s' %(rep2_peaks_filename),
-        'sort -k7n,7n -k1,1 -k2n,2n -k3n,3n -k10n,10n'
-        #'gzip -c'
-    ], pooled_common_peaks_filename)
-
-def common_peaks_recalibrated(pooled_common_peaks_filename, rep_peaks_filename, common_match_filename):
-    #time.sleep(3600)
-    return run_pipe([
-        'intersectBed -wa -wb -a %s -b %s' %(pooled_common_peaks_filename, rep_peaks_filename),
-        r"""awk 'BEGIN{OFS="\t"}{d=$2+$10-$12-$20;$21=sqrt(d^2);print $0}'""",
-        'groupBy -i - -g 1,2,3,10 -c 21 -o min -full',
-        'sort -k7n,7n -k1,1 -k2n,2n -k3n,3n -k10n,10n',
-        r"""awk 'BEGIN{OFS="\t"}{print $1,$2+$10-2,$2+$10+2,$3,$4,$5,$6,$17,$18,$19,2}'"""
-        #'qzip -c'
-    ], common_match_filename)
-
 def uncompress(filename):
     m = re.match('(.*)(\.((gz)|(Z)|(bz)|(bz2)))',filename)
     if m:
@@ -224,7 +202,9 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank):
 
     npeaks_pass = dxpy.upload_local_file(npeaks_pass_filename)
     IDR_output = dxpy.upload_local_file(compress(pooled_common_peaks_IDR_filename))
-    IDR_peaks = dxpy.upload_local_file(compress(final_IDR_thresholded_filename))
+    IDR_peaks_filename = compress(final_IDR_thresholded_filename)
+    IDR_peaks = dxpy.upload_local_file(IDR_peaks_filename,
+        properties=common.record_counts(IDR_peaks_filename, n_peaks, sort_order='-k7n,7n'))
 
     #
     # return { "app_output_field": postprocess_job.get_output_ref("answer"), ...}
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''Compare common.idr2_peaks with the idr package on the same replicate and pooled peaks'''
+
+import os, sys, math, shutil, subprocess, tempfile, logging
+import common
+
+EPILOG = '''Notes:
+	Runs idr --peak-list with the options the idr2 applet uses and
+	common.idr2_peaks on the same narrowPeaks, then reports how many
+	peaks pass each IDR threshold in each, the peaks only one of them
+	scored, how closely columns 11 and 12 (-log10 local and global IDR)
+	agree on the rest, and both fitted parameter sets.  Exits non-zero if
+	the pass counts at --threshold differ by more than --tolerance.
+
+	Needs the idr package (2.0.3, python3) on the PATH or given with --idr.
+	Use real ENCODE replicate, pooled and pseudoreplicate peaks - the
+	differences are in merging and ties, which made-up peaks won't show.
+
+Examples:
+
+	%(prog)s --rep1 rep1.narrowPeak.gz --rep2 rep2.narrowPeak.gz --pooled pooled.narrowPeak.gz
+	%(prog)s --rep1 r1.narrowPeak --rep2 r2.narrowPeak --pooled p.narrowPeak --rank p.value --idr /usr/local/bin/idr
+'''
+
+logger = logging.getLogger(__name__)
+
+THRESHOLDS = [0.01, 0.02, 0.05, 0.1]
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser(
+		description=__doc__, epilog=EPILOG,
+		formatter_class=argparse.RawDescriptionHelpFormatter)
+
+	parser.add_argument('--rep1', help="First replicate peaks", required=True)
+	parser.add_argument('--rep2', help="Second replicate peaks", required=True)
+	parser.add_argument('--pooled', help="Pooled replicates peaks", required=True)
+	parser.add_argument('--rank', help="Ranking measure", default='signal.value', choices=sorted(common.IDR2_RANK_COLUMNS))
+	parser.add_argument('--threshold', help="IDR threshold the pass counts must agree at", type=float, default=0.05)
+	parser.add_argument('--tolerance', help="Largest allowed difference in pass counts, as a share of the package's", type=float, default=0.02)
+	parser.add_argument('--idr', help="idr executable", default='idr')
+	parser.add_argument('--workdir', help="Scratch directory, kept if given", default=None)
+	parser.add_argument('--debug', help="Print debug messages", default=False, action='store_true')
+	args = parser.parse_args()
+
+	if args.debug:
+		logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+	else:
+		logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+	return args
+
+def read_idr(fname):
+	# -log10 local and global IDR by pooled peak and summit, the best of any repeats
+	scores = {}
+	with open(fname, 'r') as fh:
+		for line in fh:
+			f = line.rstrip('\n').split('\t')
+			key = (f[0], int(f[1]), int(f[2]), f[9])
+			value = (float(f[10]), float(f[11]))
+			if key not in scores or value[1] > scores[key][1]:
+				scores[key] = value
+	return scores
+
+def final_parameters(log_fname):
+	with open(log_fname, 'r') as fh:
+		for line in fh:
+			if 'Final parameter values' in line:
+				return line.split(':', 1)[1].strip()
+	return None
+
+def agreement(xs, ys):
+	# Pearson r, and the median and largest absolute differences
+	import numpy as np
+	xs, ys = np.asarray(xs), np.asarray(ys)
+	if len(xs) < 2:
+		return float('nan'), float('nan'), float('nan')
+	diffs = np.abs(xs - ys)
+	return np.corrcoef(xs, ys)[0, 1], np.median(diffs), diffs.max()
+
+def main():
+	args = get_args()
+	workdir = args.workdir or tempfile.mkdtemp()
+	if not os.path.isdir(workdir):
+		os.makedirs(workdir)
+
+	try:
+		# the idr package wants plain text
+		inputs = []
+		for name, fname in [('rep1', args.rep1), ('rep2', args.rep2), ('pooled', args.pooled)]:
+			local_fname = os.path.join(workdir, '%s.narrowPeak' %(name))
+			with open(local_fname, 'w') as fh:
+				fh.writelines(common.read_peaks(fname))
+			inputs.append(local_fname)
+		rep1_fname, rep2_fname, pooled_fname = inputs
+
+		package_fname = os.path.join(workdir, 'package.IDRv2.narrowPeak')
+		package_log = os.path.join(workdir, 'package.log.txt')
+		command = [args.idr,
+			'--use-best-multisummit-IDR',
+			'--soft-idr-threshold', str(args.threshold),
+			'--rank', args.rank,
+			'--output-file', package_fname,
+			'--log-output-file', package_log,
+			'--peak-list', pooled_fname,
+			'--samples', rep1_fname, rep2_fname]
+		logger.info(' '.join(command))
+		subprocess.check_call(command)
+
+		here_fname = os.path.join(workdir, 'common.IDRv2.narrowPeak')
+		here_log = os.path.join(workdir, 'common.log.txt')
+		common.idr2_peaks(
+			common.read_peaks(pooled_fname),
+			[common.read_peaks(rep1_fname), common.read_peaks(rep2_fname)],
+			here_fname, here_log, rank=args.rank)
+
+		package = read_idr(package_fname)
+		here = read_idr(here_fname)
+
+		print "Final parameters\tidr %s\tcommon %s" %(final_parameters(package_log), final_parameters(here_log))
+		print "Peaks scored\tidr %d\tcommon %d\tboth %d" %(len(package), len(here), len(set(package) & set(here)))
+		for threshold in THRESHOLDS:
+			cutoff = -math.log10(threshold)
+			print "Passing IDR %.2f\tidr %d\tcommon %d" %(threshold,
+				sum(1 for local, glob in package.itervalues() if glob >= cutoff),
+				sum(1 for local, glob in here.itervalues() if glob >= cutoff))
+
+		shared = sorted(set(package) & set(here))
+		for column, label in [(0, 'column 11 (-log10 local IDR)'), (1, 'column 12 (-log10 global IDR)')]:
+			r, median, largest = agreement([package[k][column] for k in shared], [here[k][column] for k in shared])
+			print "%s\tr %.4f\tmedian |diff| %.4f\tmax |diff| %.4f" %(label, r, median, largest)
+		cutoff = -math.log10(args.threshold)
+		disagree = sum(1 for k in shared if (package[k][1] >= cutoff) != (here[k][1] >= cutoff))
+		print "Shared peaks on opposite sides of IDR %.2f\t%d" %(args.threshold, disagree)
+
+		npackage = sum(1 for local, glob in package.itervalues() if glob >= cutoff)
+		nhere = sum(1 for local, glob in here.itervalues() if glob >= cutoff)
+		if abs(npackage - nhere) > args.tolerance*max(npackage, 1):
+			logger.error("Pass counts at IDR %s differ by more than %s: idr %d, common %d" %(args.threshold, args.tolerance, npackage, nhere))
+			sys.exit(1)
+	finally:
+		if not args.workdir:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# idr_batch 0.0.1
+#
+# IDR v2 of the four replicate comparisons encode_idr needs, in one job.
+#
+# DNAnexus Python Bindings (dxpy) documentation:
+#   http://autodoc.dnanexus.com/bindings/python/current/
+
+import subprocess, logging
+from multiprocessing import Pool, cpu_count
+import dxpy
+import common
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+# each comparison's output name, its replicate and pooled peak inputs, and
+# the name of the count encode_idr takes from it
+COMPARISONS = [
+    ('reps',     'rep1_peaks',      'rep2_peaks',      'pooled_peaks', 'Nt'),
+    ('r1pr',     'rep1pr1_peaks',   'rep1pr2_peaks',   'rep1_peaks',   'N1'),
+    ('r2pr',     'rep2pr1_peaks',   'rep2pr2_peaks',   'rep2_peaks',   'N2'),
+    ('pooledpr', 'pooledpr1_peaks', 'pooledpr2_peaks', 'pooled_peaks', 'Np')]
+
+# the lines of each peak input, read before the pool forks so that every
+# comparison shares the one parsed copy
+PEAKS = {}
+
+def run_comparison(args):
+    name, rep1, rep2, pooled, prefix, idr_threshold, rank = args
+    idr_filename = prefix + '.pooled_common_IDRv2.narrowPeak'
+    log_filename = prefix + '.log.txt'
+    thresholded_filename = prefix + '.IDR%2.2f.narrowPeak' %(idr_threshold)
+    common.idr2_peaks(PEAKS[pooled], [PEAKS[rep1], PEAKS[rep2]], idr_filename, log_filename, rank=rank)
+    n_peaks = common.idr2_threshold(idr_filename, thresholded_filename, idr_threshold)
+    logging.info("%s: %d peaks pass IDR %s" %(name, n_peaks, idr_threshold))
+    return idr_filename, log_filename, thresholded_filename, n_peaks
+
+@dxpy.entry_point('main')
+def main(rep1_peaks, rep2_peaks, pooled_peaks, rep1pr1_peaks, rep1pr2_peaks,
+         rep2pr1_peaks, rep2pr2_peaks, pooledpr1_peaks, pooledpr2_peaks,
+         idr_threshold, rank):
+
+    inputs = {
+        'rep1_peaks': rep1_peaks,
+        'rep2_peaks': rep2_peaks,
+        'pooled_peaks': pooled_peaks,
+        'rep1pr1_peaks': rep1pr1_peaks,
+        'rep1pr2_peaks': rep1pr2_peaks,
+        'rep2pr1_peaks': rep2pr1_peaks,
+        'rep2pr2_peaks': rep2pr2_peaks,
+        'pooledpr1_peaks': pooledpr1_peaks,
+        'pooledpr2_peaks': pooledpr2_peaks}
+
+    # the replicate and pooled peaks are each in two comparisons, but are
+    # downloaded and parsed once
+    names = {}
+    for input_name, peaks in inputs.items():
+        peaks_file = dxpy.DXFile(peaks)
+        peaks_filename = '%s-%s' %(input_name, peaks_file.name)
+        dxpy.download_dxfile(peaks_file.get_id(), peaks_filename)
+        PEAKS[input_name] = common.read_peaks(peaks_filename)
+        names[input_name] = peaks_file.name
+
+    print subprocess.check_output('ls -l', shell=True, stderr=subprocess.STDOUT)
+
+    comparisons = [
+        (name, rep1, rep2, pooled,
+         '%s.%sv%s.IDRv2' %(name, names[rep1][0:11], names[rep2][0:11]),
+         idr_threshold, rank)
+        for name, rep1, rep2, pooled, count_name in COMPARISONS]
+    pool = Pool(min(len(comparisons), cpu_count()))
+    try:
+        results = pool.map(run_comparison, comparisons)
+    finally:
+        pool.close()
+        pool.join()
+
+    print subprocess.check_output('ls -l', shell=True, stderr=subprocess.STDOUT)
+
+    output = {}
+    for (name, rep1, rep2, pooled, count_name), (idr_filename, log_filename, thresholded_filename, n_peaks) in zip(COMPARISONS, results):
+        EM_parameters_log = dxpy.upload_local_file(log_filename)
+        IDR_output = dxpy.upload_local_file(common.compress(idr_filename))
+        IDR_peaks_filename = common.compress(thresholded_filename)
+        IDR_peaks = dxpy.upload_local_file(IDR_peaks_filename,
+            properties=common.record_counts(IDR_peaks_filename, n_peaks, sort_order='-k7n,7n'))
+        output.update({
+            name + "_EM_parameters_log": dxpy.dxlink(EM_parameters_log),
+            name + "_IDR_output": dxpy.dxlink(IDR_output),
+            name + "_IDR_peaks": dxpy.dxlink(IDR_peaks),
+            count_name: n_peaks
+        })
+
+    logging.info("Exiting with output: %s", output)
+    return output
+
+dxpy.run()
@@ -73,6 +73,8 @@ def main():
 
     authid, authpw, server = common.processkey(args.key, args.keyfile)
     keypair = (authid,authpw)
+    # this report only reads from the portal, so repeated GETs can be cached
+    common.encoded_client(cache=True)
 
     if args.experiments:
         ids = args.experiments
@@ -83,15 +83,9 @@ def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gap
     clipped_narrowpeak_fn = common.slop_clip('%s/%s_peaks.narrowPeak' %(peaks_dirname, prefix), chrom_sizes.name)
 
     # Rescale Col5 scores to range 10-1000 to conform to narrowPeak.as format (score must be <1000)
-    rescaled_narrowpeak_fn = common.rescale_scores(clipped_narrowpeak_fn, scores_col=5)
-
     # Sort by Col8 in descending order and replace long peak names in Column 4 with Peak_<peakRank>
-    pipe = ['sort -k 8gr,8gr %s' %(rescaled_narrowpeak_fn),
-            r"""awk 'BEGIN{OFS="\t"}{$4="Peak_"NR ; print $0}'""",
-            'tee %s' %(narrowPeak_fn),
-            'gzip -c']
-    print pipe
-    out,err = common.run_pipe(pipe,'%s' %(narrowPeak_gz_fn))
+    common.rescale_scores(clipped_narrowpeak_fn, scores_col=5, sort_col=8, name_peaks=True, rescaled_fn=narrowPeak_fn)
+    common.compress(narrowPeak_fn)
 
     # remove additional files
     #rm -f ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_peaks.xls ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_peaks.bed ${peakFile}_summits.bed
@@ -113,28 +107,16 @@ def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gap
     clipped_broadpeak_fn = common.slop_clip('%s/%s_peaks.broadPeak' %(peaks_dirname, prefix), chrom_sizes.name)
 
     # Rescale Col5 scores to range 10-1000 to conform to narrowPeak.as format (score must be <1000)
-    rescaled_broadpeak_fn = common.rescale_scores(clipped_broadpeak_fn, scores_col=5)
-
     # Sort by Col8 (for broadPeak) or Col 14(for gappedPeak)  in descending order and replace long peak names in Column 4 with Peak_<peakRank>
-    pipe = ['sort -k 8gr,8gr %s' %(rescaled_broadpeak_fn),
-            r"""awk 'BEGIN{OFS="\t"}{$4="Peak_"NR ; print $0}'""",
-            'tee %s' %(broadPeak_fn),
-            'gzip -c']
-    print pipe
-    out,err = common.run_pipe(pipe,'%s' %(broadPeak_gz_fn))
+    common.rescale_scores(clipped_broadpeak_fn, scores_col=5, sort_col=8, name_peaks=True, rescaled_fn=broadPeak_fn)
+    common.compress(broadPeak_fn)
 
     # MACS2 sometimes calls features off the end of chromosomes.  Fix that.
     clipped_gappedpeaks_fn = common.slop_clip('%s/%s_peaks.gappedPeak' %(peaks_dirname, prefix), chrom_sizes.name)
 
     # Rescale Col5 scores to range 10-1000 to conform to narrowPeak.as format (score must be <1000)
-    rescaled_gappedpeak_fn = common.rescale_scores(clipped_gappedpeaks_fn, scores_col=5)
-
-    pipe = ['sort -k 14gr,14gr %s' %(rescaled_gappedpeak_fn),
-            r"""awk 'BEGIN{OFS="\t"}{$4="Peak_"NR ; print $0}'""",
-            'tee %s' %(gappedPeak_fn),
-            'gzip -c']
-    print pipe
-    out,err = common.run_pipe(pipe,'%s' %(gappedPeak_gz_fn))
+    common.rescale_scores(clipped_gappedpeaks_fn, scores_col=5, sort_col=14, name_peaks=True, rescaled_fn=gappedPeak_fn)
+    common.compress(gappedPeak_fn)
 
     # remove additional files
     #rm -f ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_peaks.xls ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_peaks.bed ${peakFile}_summits.bed
@@ -180,14 +162,8 @@ def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gap
 
     # Compute sval = min(no. of reads in ChIP, no. of reads in control) / 1,000,000
 
-    out, err = common.run_pipe([
-        'gzip -dc %s' %(experiment.name),
-        'wc -l'])
-    chipReads = out.strip()
-    out, err = common.run_pipe([
-        'gzip -dc %s' %(control.name),
-        'wc -l'])
-    controlReads = out.strip()
+    chipReads = common.count_lines(experiment.name, experiment)
+    controlReads = common.count_lines(control.name, control)
     sval=str(min(float(chipReads), float(controlReads))/1000000)
 
     print "chipReads = %s, controlReads = %s, sval = %s" %(chipReads, controlReads, sval)
@@ -236,9 +212,13 @@ def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gap
 
     # Upload the file outputs
 
-    narrowPeak    = dxpy.upload_local_file(narrowPeak_gz_fn)
-    gappedPeak    = dxpy.upload_local_file(gappedPeak_gz_fn)
-    broadPeak     = dxpy.upload_local_file(broadPeak_gz_fn)
+    # with their line counts, so overlap_peaks and encode_idr need not count them
+    narrowPeak    = dxpy.upload_local_file(narrowPeak_gz_fn,
+        properties=common.record_counts(narrowPeak_gz_fn, common.count_lines(narrowPeak_fn), sort_order='-k8gr,8gr'))
+    gappedPeak    = dxpy.upload_local_file(gappedPeak_gz_fn,
+        properties=common.record_counts(gappedPeak_gz_fn, common.count_lines(gappedPeak_fn), sort_order='-k14gr,14gr'))
+    broadPeak     = dxpy.upload_local_file(broadPeak_gz_fn,
+        properties=common.record_counts(broadPeak_gz_fn, common.count_lines(broadPeak_fn), sort_order='-k8gr,8gr'))
     narrowPeak_bb = dxpy.upload_local_file(narrowPeak_bb_fn)
     gappedPeak_bb = dxpy.upload_local_file(gappedPeak_bb_fn)
     broadPeak_bb  = dxpy.upload_local_file(broadPeak_bb_fn)
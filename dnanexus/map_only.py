@@ -445,9 +445,10 @@ def main():
         replicates = replicates_to_map(files, server, keypair, biorep_ns)
         in_process = False
         if files:
+            files_provenance = common.resolve_provenance(files, server, keypair)
             for biorep_n in set([rep.get('biological_replicate_number') for rep in replicates]):
                 outstrings.append('rep%s' %(biorep_n))
-                biorep_files = [f for f in files if biorep_n in common.biorep_ns(f,server,keypair)]
+                biorep_files = [f for f, provenance in zip(files, files_provenance) if biorep_n in provenance['biorep_ns']]
                 paired_files = []
                 unpaired_files = []
                 while biorep_files:
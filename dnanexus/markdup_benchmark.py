@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+'''Check and time common.mark_duplicates on synthetic BAMs, against Picard if given'''
+
+import os, sys, time, shutil, struct, shlex, subprocess, tempfile, logging
+from cStringIO import StringIO
+import common
+
+EPILOG = '''Notes:
+	Makes coordinate-sorted single- and paired-end BAMs with a known share
+	of duplicate fragments, soft clipped and optically close reads among
+	them, and marks duplicates with common.mark_duplicates.  The duplicates
+	are checked against an in-memory version of the same rules, and with
+	--picard against MarkDuplicates.jar run on the same BAM, comparing the
+	flagged reads and every metric.
+
+Examples:
+
+	%(prog)s --fragments 200000
+	%(prog)s --picard /picard/MarkDuplicates.jar
+'''
+
+logger = logging.getLogger(__name__)
+
+CHROMS = [('chr1', 20000000), ('chr2', 10000000), ('chrM', 16571)]
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser(
+		description=__doc__, epilog=EPILOG,
+		formatter_class=argparse.RawDescriptionHelpFormatter)
+
+	parser.add_argument('--fragments', help="Distinct fragments in each BAM", type=int, default=100000)
+	parser.add_argument('--duplication', help="Share of fragments that are sequenced more than once", type=float, default=0.2)
+	parser.add_argument('--read_length', help="Read length", type=int, default=36)
+	parser.add_argument('--seed', help="Random seed", type=int, default=0)
+	parser.add_argument('--picard', help="MarkDuplicates.jar to compare with", default=None)
+	parser.add_argument('--workdir', help="Scratch directory", default=None)
+	parser.add_argument('--debug', help="Print debug messages", default=False, action='store_true')
+	args = parser.parse_args()
+
+	if args.debug:
+		logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+	else:
+		logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+	return args
+
+def reg2bin(beg, end):
+	# the UCSC binning scheme from the SAM spec
+	end -= 1
+	for shift, offset in [(14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)]:
+		if beg >> shift == end >> shift:
+			return offset + (beg >> shift)
+	return 0
+
+def bam_record(name, flag, ref, pos, cigar, quals, mate_ref=-1, mate_pos=-1, tlen=0):
+	# cigar is a list of (length, op code); the sequence is all Ns
+	ref_length = sum(length for length, op in cigar if op in (0, 2, 3, 7, 8))
+	l_seq = len(quals)
+	body = struct.pack('<iiBBHHHiiii', ref, pos, len(name) + 1, 60, reg2bin(pos, pos + max(ref_length, 1)),
+					   len(cigar), flag, l_seq, mate_ref, mate_pos, tlen)
+	body += name + '\x00'
+	body += ''.join(struct.pack('<I', length << 4 | op) for length, op in cigar)
+	body += '\xff'*((l_seq + 1)/2)
+	body += ''.join(chr(q) for q in quals)
+	return struct.pack('<i', len(body)) + body
+
+def bam_header():
+	text = '@HD\tVN:1.0\tSO:coordinate\n' + ''.join('@SQ\tSN:%s\tLN:%d\n' %(name, length) for name, length in CHROMS)
+	refs = ''.join(struct.pack('<i', len(name) + 1) + name + '\x00' + struct.pack('<i', length) for name, length in CHROMS)
+	return common.BAM_MAGIC + struct.pack('<i', len(text)) + text + struct.pack('<i', len(CHROMS)) + refs
+
+def synthetic_reads(n_fragments, duplication, read_length, paired_end, rs):
+	# (ref, pos, record) for every read, duplicates sharing a fragment's
+	# ends but not its qualities, clipping or flowcell location
+	reads = []
+	names = set()
+	def name(tile, x, y):
+		while 'SYN:1:FC:1:%d:%d:%d' %(tile, x, y) in names:
+			x += 1
+		names.add('SYN:1:FC:1:%d:%d:%d' %(tile, x, y))
+		return 'SYN:1:FC:1:%d:%d:%d' %(tile, x, y)
+	def quals():
+		return list(rs.randint(2, 41, read_length))
+	def cigar(clip):
+		return [(clip, 4), (read_length - clip, 0)] if clip else [(read_length, 0)]
+	for i in range(n_fragments):
+		ref = rs.randint(0, len(CHROMS))
+		start = rs.randint(1000, CHROMS[ref][1] - 2000)
+		fragment_length = rs.randint(150, 400)
+		copies = 1 + (rs.geometric(0.5) if rs.random_sample() < duplication else 0)
+		reverse = rs.random_sample() < 0.5
+		tile, x, y = rs.randint(1101, 1104), rs.randint(0, 20000), rs.randint(0, 20000)
+		for copy in range(copies):
+			if copy and rs.random_sample() < 0.2:
+				# an optical duplicate, right next to the first copy
+				read_name = name(tile, x + rs.randint(0, 50), y + rs.randint(0, 50))
+			else:
+				read_name = name(rs.randint(1101, 1104), rs.randint(0, 20000), rs.randint(0, 20000))
+			clip = rs.randint(1, 4) if rs.random_sample() < 0.1 else 0
+			if not paired_end or rs.random_sample() < 0.02:
+				# a read with no mapped mate, at the fragment's 5' end
+				flag = 0x1 | 0x8 if paired_end else 0
+				if reverse:
+					pos = start + fragment_length - read_length
+					reads.append((ref, pos, bam_record(read_name, flag | 0x10, ref, pos, cigar(0), quals())))
+				else:
+					reads.append((ref, start + clip, bam_record(read_name, flag, ref, start + clip, cigar(clip), quals())))
+				continue
+			left, right = start + clip, start + fragment_length - read_length
+			tlen = right + read_length - left
+			left_flag, right_flag = (0x1 | 0x2 | 0x20, 0x1 | 0x2 | 0x10)
+			left_flag |= 0x80 if reverse else 0x40
+			right_flag |= 0x40 if reverse else 0x80
+			reads.append((ref, left, bam_record(read_name, left_flag, ref, left, cigar(clip), quals(), ref, right, tlen)))
+			reads.append((ref, right, bam_record(read_name, right_flag, ref, right, cigar(0), quals(), ref, left, -tlen)))
+	reads.sort(key=lambda read: read[:2])
+	return reads
+
+def write_bam(reads, bam_filename):
+	data = StringIO()
+	data.write(bam_header())
+	for ref, pos, record in reads:
+		data.write(record)
+	data.seek(0)
+	with open(bam_filename, 'wb') as outfh:
+		common.pgzip(data, outfh, bgzf=True)
+
+def read_flags(bam_filename):
+	# (name, flag) of every record, in file order
+	fh = subprocess.Popen(['gzip', '-dc', bam_filename], stdout=subprocess.PIPE).stdout
+	common.read_bam_header(fh)
+	flags = []
+	for rec in common.bam_records(fh):
+		l_read_name = ord(rec[12])
+		flags.append((rec[36:35 + l_read_name], struct.unpack_from('<H', rec, 18)[0]))
+	return flags
+
+def expected_duplicates(bam_filename):
+	# the MarkDuplicates rules applied to the whole file at once
+	fh = subprocess.Popen(['gzip', '-dc', bam_filename], stdout=subprocess.PIPE).stdout
+	header, text, references = common.read_bam_header(fh)
+	fragments = {}
+	pairs = {}
+	mates = {}
+	for index, rec in enumerate(common.bam_records(fh)):
+		ref, pos, l_read_name, mapq, bin_, n_cigar, flag, l_seq, mate_ref, mate_pos, tlen = struct.unpack_from('<iiBBHHHiiii', rec, 4)
+		cigar = [(op >> 4, op & 0xf) for op in struct.unpack_from('<%dI' %(n_cigar), rec, 36 + l_read_name)]
+		qual_offset = 36 + l_read_name + 4*n_cigar + (l_seq + 1)/2
+		score = sum(q for q in bytearray(rec[qual_offset:qual_offset + l_seq]) if q >= 15)
+		reverse = bool(flag & 0x10)
+		if reverse:
+			five_prime = pos - 1 + sum(length for length, op in cigar if op in (0, 2, 3, 7, 8))
+			for length, op in reversed(cigar):
+				if op not in (4, 5):
+					break
+				five_prime += length
+		else:
+			five_prime = pos
+			for length, op in cigar:
+				if op not in (4, 5):
+					break
+				five_prime -= length
+		paired = bool(flag & 0x1) and not flag & 0x8
+		fragments.setdefault((ref, five_prime, reverse), []).append((index, score, paired))
+		if paired:
+			name = rec[36:35 + l_read_name]
+			if name in mates:
+				m_index, m_ref, m_five_prime, m_reverse, m_score = mates.pop(name)
+				if (m_ref, m_five_prime) >= (ref, five_prime):
+					key, indexes = (ref, five_prime, reverse, m_ref, m_five_prime, m_reverse), (index, m_index)
+				else:
+					key, indexes = (m_ref, m_five_prime, m_reverse, ref, five_prime, reverse), (m_index, index)
+				pairs.setdefault(key, []).append(indexes + (score + m_score,))
+			else:
+				mates[name] = (index, ref, five_prime, reverse, score)
+	duplicates = set()
+	for ends in fragments.itervalues():
+		unpaired = [end for end in ends if not end[2]]
+		if len(unpaired) < len(ends):
+			duplicates.update(end[0] for end in unpaired)
+		elif unpaired:
+			best = sorted(unpaired, key=lambda end: (-end[1], end[0]))[0]
+			duplicates.update(end[0] for end in unpaired if end is not best)
+	for ends in pairs.itervalues():
+		best = sorted(ends, key=lambda end: (-end[2], end[0], end[1]))[0]
+		for end in ends:
+			if end is not best:
+				duplicates.update(end[:2])
+	return duplicates
+
+def mark(bam_filename, marked_filename, metrics_filename):
+	steps = [
+		{'name': 'gunzip', 'input': bam_filename, 'command': common.pgunzip},
+		{'name': 'markdup', 'input': 'gunzip',
+		 'command': lambda infh, outfh: common.mark_duplicates(infh, outfh, metrics_filename)},
+		{'name': 'bgzf', 'input': 'markdup', 'outfile': marked_filename,
+		 'command': lambda infh, outfh: common.pgzip(infh, outfh, bgzf=True)}]
+	common.run_dag(steps)
+
+def read_metrics(metrics_filename):
+	lines = iter(open(metrics_filename).read().splitlines())
+	for line in lines:
+		if line.startswith('## METRICS CLASS'):
+			return dict(zip(lines.next().split('\t'), lines.next().split('\t')))
+
+def main():
+	import numpy as np
+	args = get_args()
+	workdir = tempfile.mkdtemp(dir=args.workdir)
+	failed = False
+	try:
+		for paired_end in [False, True]:
+			label = 'PE' if paired_end else 'SE'
+			rs = np.random.RandomState(args.seed)
+			bam_filename = os.path.join(workdir, '%s.bam' %(label))
+			reads = synthetic_reads(args.fragments, args.duplication, args.read_length, paired_end, rs)
+			write_bam(reads, bam_filename)
+			del reads
+
+			marked_filename = os.path.join(workdir, '%s.markdup.bam' %(label))
+			metrics_filename = os.path.join(workdir, '%s.dup.qc' %(label))
+			start = time.time()
+			mark(bam_filename, marked_filename, metrics_filename)
+			duration = time.time() - start
+			metrics = read_metrics(metrics_filename)
+			flags = read_flags(marked_filename)
+			marked = set(i for i, (name, flag) in enumerate(flags) if flag & common.BAM_FDUP)
+			print "%s\tmark_duplicates\t%.2f s\t%d reads\t%d duplicates\t%s" %(
+				label, duration, len(flags), len(marked), metrics['PERCENT_DUPLICATION'])
+			if marked != expected_duplicates(bam_filename):
+				logger.error("%s: streaming and in-memory duplicates differ" %(label))
+				failed = True
+
+			if args.picard:
+				picard_filename = os.path.join(workdir, '%s.picard.bam' %(label))
+				picard_metrics_filename = os.path.join(workdir, '%s.picard.dup.qc' %(label))
+				start = time.time()
+				subprocess.check_call(shlex.split(
+					"java -Xmx4G -jar %s INPUT=%s OUTPUT=%s METRICS_FILE=%s VALIDATION_STRINGENCY=LENIENT ASSUME_SORTED=true REMOVE_DUPLICATES=false"
+					%(args.picard, bam_filename, picard_filename, picard_metrics_filename)))
+				duration = time.time() - start
+				picard_metrics = read_metrics(picard_metrics_filename)
+				picard_flags = read_flags(picard_filename)
+				picard_marked = set(i for i, (name, flag) in enumerate(picard_flags) if flag & common.BAM_FDUP)
+				print "%s\tMarkDuplicates.jar\t%.2f s\t%d reads\t%d duplicates\t%s" %(
+					label, duration, len(picard_flags), len(picard_marked), picard_metrics['PERCENT_DUPLICATION'])
+				if picard_marked != marked:
+					logger.error("%s: %d reads flagged differently from Picard" %(label, len(picard_marked ^ marked)))
+					failed = True
+				for field in common.DUPLICATION_METRICS[1:]:
+					if metrics[field] != picard_metrics.get(field):
+						logger.error("%s: %s is %s, Picard says %s" %(label, field, metrics[field], picard_metrics.get(field)))
+						failed = True
+	finally:
+		shutil.rmtree(workdir)
+	if failed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+'''Local stand-in for the ENCODE portal, for exercising common.encoded_*'''
+
+import os, sys, json, time, hashlib, logging, threading, urlparse
+import BaseHTTPServer, SocketServer
+import common
+
+EPILOG = '''Notes:
+	Serves objects from a JSON file that maps @id to object, or a made up
+	experiment with --replicates replicates and --files files per
+	replicate.  Supports ETag/If-None-Match and --latency per request.
+	With --bench, resolves the replicates of every file one at a time
+	with and without the client cache, and all at once with
+	resolve_provenance, and reports wall time and requests served.
+
+Examples:
+
+	%(prog)s --port 8000
+	%(prog)s --bench --latency 50
+	ENCODE_SERVER=http://localhost:8000/ peaks_report.py ...
+'''
+
+logger = logging.getLogger(__name__)
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser(
+		description=__doc__, epilog=EPILOG,
+		formatter_class=argparse.RawDescriptionHelpFormatter)
+
+	parser.add_argument('--objects', help="JSON file of @id to object", type=argparse.FileType('r'), default=None)
+	parser.add_argument('--port', help="Port to listen on, 0 for any", type=int, default=0)
+	parser.add_argument('--latency', help="ms to wait before each response", type=float, default=0)
+	parser.add_argument('--replicates', help="Replicates in the made up experiment", type=int, default=2)
+	parser.add_argument('--files', help="Peak files per replicate in the made up experiment", type=int, default=20)
+	parser.add_argument('--bench', help="Run the client benchmark and exit", default=False, action='store_true')
+	parser.add_argument('--debug', help="Print debug messages", default=False, action='store_true')
+	args = parser.parse_args()
+
+	if args.debug:
+		logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+	else:
+		logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+	return args
+
+def made_up_experiment(n_replicates, n_files):
+	# peaks <- bams <- fastqs <- replicate -> library -> biosample, with the
+	# fastqs and the genome shared the way they are in real pipelines
+	objects = {}
+	def add(obj):
+		objects[obj['@id']] = obj
+		return obj['@id']
+	genome = add({'@id': '/files/ENCFF000GEN/', 'accession': 'ENCFF000GEN', 'output_category': 'reference'})
+	peaks = []
+	for rep in range(1, n_replicates+1):
+		biosample = add({'@id': '/biosamples/ENCBS%03dXXX/' %(rep), 'age_display': '%d weeks' %(rep)})
+		library = add({'@id': '/libraries/ENCLB%03dXXX/' %(rep), 'biosample': biosample})
+		replicate = add({'@id': '/replicates/rep%d/' %(rep), 'biological_replicate_number': rep, 'library': library})
+		fastqs = [add({'@id': '/files/ENCFF%03dFQ%d/' %(rep, i), 'accession': 'ENCFF%03dFQ%d' %(rep, i), 'replicate': replicate, 'output_category': 'raw data'})
+				  for i in range(2)]
+		bam = add({'@id': '/files/ENCFF%03dBAM/' %(rep), 'accession': 'ENCFF%03dBAM' %(rep), 'derived_from': fastqs + [genome], 'output_category': 'alignment'})
+		for i in range(n_files):
+			peaks.append(add({'@id': '/files/ENCFF%03dP%02d/' %(rep, i), 'accession': 'ENCFF%03dP%02d' %(rep, i), 'derived_from': [bam], 'output_category': 'annotation'}))
+	return objects, peaks
+
+class MockPortal(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, objects, port=0, latency=0):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), MockPortalHandler)
+		self.objects = dict((at_id.rstrip('/'), obj) for at_id, obj in objects.iteritems())
+		self.latency = latency
+		self.requests_served = 0
+		self.lock = threading.Lock()
+
+	@property
+	def url(self):
+		return 'http://127.0.0.1:%d/' %(self.server_address[1])
+
+	def serve_in_thread(self):
+		t = threading.Thread(target=self.serve_forever)
+		t.daemon = True
+		t.start()
+		return t
+
+class MockPortalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		with self.server.lock:
+			self.server.requests_served += 1
+		if self.server.latency:
+			time.sleep(self.server.latency/1000.0)
+		path = urlparse.urlsplit(self.path).path.rstrip('/')
+		obj = self.server.objects.get(path)
+		if obj is None:
+			self.send_response(404)
+			body = json.dumps({'status': 'error', 'code': 404})
+		else:
+			body = json.dumps(obj, sort_keys=True)
+			etag = '"%s"' %(hashlib.md5(body).hexdigest())
+			if self.headers.get('if-none-match') == etag:
+				self.send_response(304)
+				self.send_header('ETag', etag)
+				self.end_headers()
+				return
+			self.send_response(200)
+			self.send_header('ETag', etag)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_PATCH(self):
+		path = urlparse.urlsplit(self.path).path.rstrip('/')
+		payload = json.loads(self.rfile.read(int(self.headers.get('content-length', 0))))
+		with self.server.lock:
+			self.server.requests_served += 1
+			self.server.objects.setdefault(path, {'@id': path + '/'}).update(payload)
+			body = json.dumps({'@graph': [self.server.objects[path]]})
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logger.debug(format %(args))
+
+def bench(portal, peaks):
+	def run(label, walk):
+		common._provenance_nodes.clear()
+		served = portal.requests_served
+		start = time.time()
+		repns = walk()
+		duration = time.time() - start
+		print "%s\t%.2f s\t%d requests\t%s" %(label, duration, portal.requests_served - served, sorted(set(common.flat(repns))))
+
+	def one_at_a_time():
+		repns = []
+		for f in peaks:
+			# what every call used to cost, with nothing remembered between them
+			common._provenance_nodes.clear()
+			repns.append(common.biorep_ns(f, portal.url, None))
+		return repns
+
+	common.encoded_client()
+	run('uncached', one_at_a_time)
+	common.encoded_client(cache=True)
+	run('http cache', one_at_a_time)
+	common.encoded_client()
+	run('batched', lambda: [p['biorep_ns'] for p in common.resolve_provenance(peaks, portal.url, None)])
+
+def main():
+	args = get_args()
+	if args.objects:
+		objects = json.load(args.objects)
+		peaks = [at_id for at_id, obj in objects.iteritems() if obj.get('derived_from')]
+	else:
+		objects, peaks = made_up_experiment(args.replicates, args.files)
+	portal = MockPortal(objects, args.port, args.latency)
+	if args.bench:
+		portal.serve_in_thread()
+		bench(portal, peaks)
+	else:
+		logger.info("Serving %d objects at %s" %(len(objects), portal.url))
+		portal.serve_forever()
+
+if __name__ == '__main__':
+	main()
@@ -12,17 +12,45 @@
 #   http://autodoc.dnanexus.com/bindings/python/current/
 
 import sys, os, re
+from multiprocessing import Pool, cpu_count
 import dxpy
 import common
 
+# bedToBigBed types of the peak files
+BED_TYPES = {'narrowPeak': 'bed6+4', 'gappedPeak': 'bed12+3', 'broadPeak': 'bed6+3'}
+
+def _supported(args):
+	index, npeaks, peaks_fn, min_overlap = args
+	return common.peaks_supported(index, npeaks, common.index_peaks(common.read_peaks(peaks_fn)), min_overlap)
+
+def support(index, npeaks, peaks_fns, min_overlap=0.5, processes=None):
+	'''
+	common.peaks_supported() for the peaks of index against each of the files
+	peaks_fns, read and compared in parallel.  Returns a boolean array
+	with a row per file.
+	'''
+	import numpy as np
+	pool = Pool(min(len(peaks_fns), processes or cpu_count()))
+	try:
+		found = pool.map(_supported, [(index, npeaks, fn, min_overlap) for fn in peaks_fns])
+	finally:
+		pool.close()
+		pool.join()
+	return np.array(found, dtype=bool).reshape(len(peaks_fns), npeaks)
+
 @dxpy.entry_point('main')
-def main(rep1_peaks, rep2_peaks, pooled_peaks, pooledpr1_peaks, pooledpr2_peaks, chrom_sizes, as_file, peak_type):
+def main(pooled_peaks, pooledpr1_peaks, pooledpr2_peaks, chrom_sizes, as_file, peak_type,
+		 rep1_peaks=None, rep2_peaks=None, rep_peaks=None, min_replicates=None):
+
+	# Replicate peaks are rep1_peaks and rep2_peaks followed by any in rep_peaks, so
+	# experiments with more than two replicates are overlapped in one run.  A pooled
+	# peak is replicated if it overlaps the peaks of at least min_replicates of them
+	# (all of them by default) or of both pooled pseudoreplicates.
 
 	# Initialize data object inputs on the platform
 	# into dxpy.DXDataObject instances
 
-	rep1_peaks 		= dxpy.DXFile(rep1_peaks)
-	rep2_peaks 		= dxpy.DXFile(rep2_peaks)
+	rep_peaks 		= [dxpy.DXFile(peaks) for peaks in [rep1_peaks, rep2_peaks] + (rep_peaks or []) if peaks]
 	pooled_peaks 	= dxpy.DXFile(pooled_peaks)
 	pooledpr1_peaks = dxpy.DXFile(pooledpr1_peaks)
 	pooledpr2_peaks = dxpy.DXFile(pooledpr2_peaks)
@@ -31,8 +59,7 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, pooledpr1_peaks, pooledpr2_peaks,
 
 	#Input filenames - necessary to define each explicitly because input files could have the same name, in which case subsequent
 	#file would overwrite previous file
-	rep1_peaks_fn		= 'rep1-%s' %(rep1_peaks.name)
-	rep2_peaks_fn		= 'rep2-%s' %(rep2_peaks.name)
+	rep_peaks_fns		= ['rep%d-%s' %(i+1, peaks.name) for i, peaks in enumerate(rep_peaks)]
 	pooled_peaks_fn 	= 'pooled-%s' %(pooled_peaks.name)
 	pooledpr1_peaks_fn	= 'pooledpr1-%s' %(pooledpr1_peaks.name)
 	pooledpr2_peaks_fn	= 'pooledpr2-%s' %(pooledpr2_peaks.name)
@@ -50,101 +77,62 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, pooledpr1_peaks, pooledpr2_peaks,
 	rejected_peaks_fn		= '%s.rejected.%s' %(basename, peak_type)
 	rejected_peaks_bb_fn	= rejected_peaks_fn + '.bb'
 
-	# Intermediate filenames
-	overlap_tr_fn 	= 'replicated_tr.%s' %(peak_type)
-	overlap_pr_fn 	= 'replicated_pr.%s' %(peak_type)
-
 	# Download file inputs to the local file system with local filenames
 
-	dxpy.download_dxfile(rep1_peaks.get_id(), rep1_peaks_fn)
-	dxpy.download_dxfile(rep2_peaks.get_id(), rep2_peaks_fn)
+	for peaks, peaks_fn in zip(rep_peaks, rep_peaks_fns):
+		dxpy.download_dxfile(peaks.get_id(), peaks_fn)
 	dxpy.download_dxfile(pooled_peaks.get_id(), pooled_peaks_fn)
 	dxpy.download_dxfile(pooledpr1_peaks.get_id(), pooledpr1_peaks_fn)
 	dxpy.download_dxfile(pooledpr2_peaks.get_id(), pooledpr2_peaks_fn)
 	dxpy.download_dxfile(chrom_sizes.get_id(), chrom_sizes_fn)
 	dxpy.download_dxfile(as_file.get_id(), as_file_fn)
 
-	'''
-	#find pooled peaks that are in (rep1 AND rep2)
-	out, err = common.run_pipe([
-		'intersectBed -wa -f 0.50 -r -a %s -b %s' %(pooled_peaks_fn, rep1_peaks_fn),
-		'intersectBed -wa -f 0.50 -r -a stdin -b %s' %(rep2_peaks_fn)
-		], overlap_tr_fn)
-	print "%d peaks overlap with both true replicates" %(common.count_lines(overlap_tr_fn))
-
-	#pooled peaks that are in (pooledpseudorep1 AND pooledpseudorep2)
-	out, err = common.run_pipe([
-		'intersectBed -wa -f 0.50 -r -a %s -b %s' %(pooled_peaks_fn, pooledpr1_peaks_fn),
-		'intersectBed -wa -f 0.50 -r -a stdin -b %s' %(pooledpr2_peaks_fn)
-		], overlap_pr_fn)
-	print "%d peaks overlap with both pooled pseudoreplicates" %(common.count_lines(overlap_pr_fn))
-
-	#combined pooled peaks in (rep1 AND rep2) OR (pooledpseudorep1 AND pooledpseudorep2)
-	out, err = common.run_pipe([
-		'intersectBed -wa -a %s -b %s %s' %(pooled_peaks_fn, overlap_tr_fn, overlap_pr_fn),
-		'intersectBed -wa -u -a %s -b stdin' %(pooled_peaks_fn)
-		], overlapping_peaks_fn)
-	print "%d peaks overall with true replicates or with pooled pseudorepliates" %(common.count_lines(overlapping_peaks_fn))
-	'''
-	#the only difference between the peak_types is how the extra columns are handled
-	if peak_type == "narrowPeak":
-		awk_command = r"""awk 'BEGIN{FS="\t";OFS="\t"}{s1=$3-$2; s2=$13-$12; if (($21/s1 >= 0.5) || ($21/s2 >= 0.5)) {print $0}}'"""
-		cut_command = 'cut -f 1-10'
-		bed_type = 'bed6+4'
-	elif peak_type == "gappedPeak":
-		awk_command = r"""awk 'BEGIN{FS="\t";OFS="\t"}{s1=$3-$2; s2=$18-$17; if (($31/s1 >= 0.5) || ($31/s2 >= 0.5)) {print $0}}'"""
-		cut_command = 'cut -f 1-15'
-		bed_type = 'bed12+3'
-	elif peak_type == "broadPeak":
-		awk_command = r"""awk 'BEGIN{FS="\t";OFS="\t"}{s1=$3-$2; s2=$12-$11; if (($19/s1 >= 0.5) || ($19/s2 >= 0.5)) {print $0}}'"""
-		cut_command = 'cut -f 1-9'
-		bed_type = 'bed6+3'
+	if peak_type in BED_TYPES:
+		bed_type = BED_TYPES[peak_type]
 	else:
 		print "%s is unrecognized.  peak_type should be narrowPeak, gappedPeak or broadPeak."
 		sys.exit()
 
-	# Find pooled peaks that overlap Rep1 and Rep2 where overlap is defined as the fractional overlap wrt any one of the overlapping peak pairs  > 0.5
-	out, err = common.run_pipe([
-		'intersectBed -wo -a %s -b %s' %(pooled_peaks_fn, rep1_peaks_fn),
-		awk_command,
-		cut_command,
-		'sort -u',
-		'intersectBed -wo -a stdin -b %s' %(rep2_peaks_fn),
-		awk_command,
-		cut_command,
-		'sort -u'
-		], overlap_tr_fn)
-	print "%d peaks overlap with both true replicates" %(common.count_lines(overlap_tr_fn))
-
-	# Find pooled peaks that overlap PseudoRep1 and PseudoRep2 where overlap is defined as the fractional overlap wrt any one of the overlapping peak pairs  > 0.5
-	out, err = common.run_pipe([
-		'intersectBed -wo -a %s -b %s' %(pooled_peaks_fn, pooledpr1_peaks_fn),
-		awk_command,
-		cut_command,
-		'sort -u',
-		'intersectBed -wo -a stdin -b %s' %(pooledpr2_peaks_fn),
-		awk_command,
-		cut_command,
-		'sort -u'
-		], overlap_pr_fn)
-	print "%d peaks overlap with both pooled pseudoreplicates" %(common.count_lines(overlap_pr_fn))
-
-	# Combine peak lists
-	out, err = common.run_pipe([
-		'cat %s %s' %(overlap_tr_fn, overlap_pr_fn),
-		'sort -u'
-		], overlapping_peaks_fn)
-	print "%d peaks overlap with true replicates or with pooled pseudorepliates" %(common.count_lines(overlapping_peaks_fn))
-
-	#rejected peaks
-	out, err = common.run_pipe([
-		'intersectBed -wa -v -a %s -b %s' %(pooled_peaks_fn, overlapping_peaks_fn)
-		], rejected_peaks_fn)
-	print "%d peaks were rejected" %(common.count_lines(rejected_peaks_fn))
-
-	npeaks_in 		= common.count_lines(common.uncompress(pooled_peaks_fn))
-	npeaks_out 		= common.count_lines(overlapping_peaks_fn)
-	npeaks_rejected = common.count_lines(rejected_peaks_fn)
+	nreps = len(rep_peaks_fns)
+	if min_replicates is None:
+		min_replicates = nreps
+	if not 0 < min_replicates <= nreps:
+		raise ValueError("min_replicates must be between 1 and the %d replicates" %(nreps))
+
+	# Overlap is defined as the fractional overlap wrt any one of the overlapping peak pairs >= 0.5.
+	# The pooled peaks are indexed once and compared with all the true replicates and the pooled
+	# pseudoreplicates in parallel, a process for each file.
+	pooled_lines = common.read_peaks(pooled_peaks_fn)
+	pooled_index = common.index_peaks(pooled_lines)
+	found = support(pooled_index, len(pooled_lines),
+		rep_peaks_fns + [pooledpr1_peaks_fn, pooledpr2_peaks_fn])
+
+	# Find pooled peaks that overlap at least min_replicates of the replicates
+	rep_support = found[:nreps].sum(axis=0)
+	for k in range(1, nreps+1):
+		print "%d peaks overlap with %d of %d true replicates" %((rep_support == k).sum(), k, nreps)
+	overlap_tr = rep_support >= min_replicates
+	print "%d peaks overlap with at least %d of %d true replicates" %(len(set(pooled_lines[i] for i in overlap_tr.nonzero()[0])), min_replicates, nreps)
+
+	# Find pooled peaks that overlap PseudoRep1 and PseudoRep2
+	overlap_pr = found[nreps] & found[nreps+1]
+	print "%d peaks overlap with both pooled pseudoreplicates" %(len(set(pooled_lines[i] for i in overlap_pr.nonzero()[0])))
+
+	# Combine peak lists, each distinct peak once
+	overlapping_lines = sorted(set(pooled_lines[i] for i in (overlap_tr | overlap_pr).nonzero()[0]))
+	with open(overlapping_peaks_fn, 'w') as fh:
+		fh.writelines(overlapping_lines)
+	print "%d peaks overlap with true replicates or with pooled pseudorepliates" %(len(overlapping_lines))
+
+	#rejected peaks are those that do not overlap any replicated peak at all
+	rejected = ~common.peaks_supported(pooled_index, len(pooled_lines), common.index_peaks(overlapping_lines), min_overlap=0)
+	with open(rejected_peaks_fn, 'w') as fh:
+		fh.writelines(pooled_lines[i] for i in rejected.nonzero()[0])
+	print "%d peaks were rejected" %(rejected.sum())
+
+	npeaks_in 		= len(pooled_lines)
+	npeaks_out 		= len(overlapping_lines)
+	npeaks_rejected = int(rejected.sum())
 
 	#make bigBed files for visualization
 	overlapping_peaks_bb_fn = common.bed2bb(overlapping_peaks_fn, chrom_sizes_fn, as_file_fn, bed_type=bed_type)
@@ -152,9 +140,14 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, pooledpr1_peaks, pooledpr2_peaks,
 
 	# Upload file outputs from the local file system.
 
-	overlapping_peaks 		= dxpy.upload_local_file(common.compress(overlapping_peaks_fn))
+	# the peak counts are known here, so are recorded for whatever counts them next
+	overlapping_peaks_gz_fn	= common.compress(overlapping_peaks_fn)
+	rejected_peaks_gz_fn	= common.compress(rejected_peaks_fn)
+	overlapping_peaks 		= dxpy.upload_local_file(overlapping_peaks_gz_fn,
+		properties=common.record_counts(overlapping_peaks_gz_fn, npeaks_out))
 	overlapping_peaks_bb 	= dxpy.upload_local_file(overlapping_peaks_bb_fn)
-	rejected_peaks 			= dxpy.upload_local_file(common.compress(rejected_peaks_fn))
+	rejected_peaks 			= dxpy.upload_local_file(rejected_peaks_gz_fn,
+		properties=common.record_counts(rejected_peaks_gz_fn, npeaks_rejected))
 	rejected_peaks_bb 		= dxpy.upload_local_file(rejected_peaks_bb_fn)
 
 	# The following line fills in some basic dummy output and assumes
@@ -127,8 +127,10 @@ def accession_file(f, keypair, server, dryrun, force):
 
 	local_fname = dx.name
 	logger.info("Downloading %s" %(local_fname))
-	dxpy.download_dxfile(dx.get_id(),local_fname)
-	f.update({'md5sum': common.md5(local_fname)})
+	# hash on the way down rather than reading the file back
+	downloaded = common.stream_dxfile(dx, local_fname)
+	calculated_md5 = downloaded['md5sum']
+	f.update({'md5sum': calculated_md5})
 	f['notes'] = json.dumps(f.get('notes'))
 
 	url = urlparse.urljoin(server,'files/')
@@ -333,10 +335,8 @@ def main():
 					os.makedirs(args.outdir)
 				dxpy.download_dxfile(fid, local_path)
 			replicates = []
-			for derived_from in f['derived_from']:
-				rep_ns = common.biorep_ns(derived_from, server, keypair)
-				for r in rep_ns:
-					replicates.append(r)
+			for provenance in common.resolve_provenance(f['derived_from'], server, keypair):
+				replicates.extend(provenance['biorep_ns'])
 			experiment = common.encoded_get(urlparse.urljoin(server,'/experiments/%s' %(f['dataset'])), keypair)
 			rep = common.encoded_get(urlparse.urljoin(server, experiment['replicates'][0]), keypair)
 			lib = common.encoded_get(urlparse.urljoin(server, rep['library']), keypair)
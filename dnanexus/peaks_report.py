@@ -36,21 +36,7 @@ def get_args():
 	return args
 
 def biorep_ns(file_accession,server,keypair):
-	m = re.match('^/?(files)?/?(\w*)', file_accession)
-	if m:
-		acc = m.group(2)
-	else:
-		return
-	url = urlparse.urljoin(server, '/files/%s' %(acc))
-	file_object = common.encoded_get(url, keypair)
-	if file_object.get('derived_from'):
-		for f in file_object.get('derived_from'):
-			for repnum in biorep_ns(f,server,keypair):
-				yield repnum
-	else:
-		url = urlparse.urljoin(server, '%s' %(file_object.get('replicate')))
-		replicate_object = common.encoded_get(url, keypair)
-		yield replicate_object.get('biological_replicate_number')
+	return common.biorep_ns(file_accession, server, keypair)
 
 def biorep_ages(file_accession,server,keypair):
 	m = re.match('^/?(files)?/?(\w*)', file_accession)
@@ -84,6 +70,8 @@ def main():
 
 	authid, authpw, server = common.processkey(args.key, args.keyfile)
 	keypair = (authid,authpw)
+	# this report only reads from the portal, so repeated GETs can be cached
+	common.encoded_client(cache=True)
 
 	if args.experiments:
 		exp_ids = args.experiments
@@ -11,65 +11,164 @@
 # DNAnexus Python Bindings (dxpy) documentation:
 #   http://autodoc.dnanexus.com/bindings/python/current/
 
-import os, subprocess, shlex, time, re, gzip
+import os, subprocess, shlex, time, re, gzip, heapq
 from os.path import splitext
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
 import dxpy
+import common
 
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
+# the order sort -k1,1 -k2,2n leaves tagAligns and BEDs in under LC_ALL=C
+MERGE_SORT_ORDER = '-k1,1 -k2,2n'
+
+# the recorded sort orders merge_sorted can merge: coordinate is BAM header
+# order, which bamToBed keeps in the tagAligns made from sorted BAMs
+MERGEABLE_SORT_ORDERS = ['coordinate', MERGE_SORT_ORDER]
+
+def concatenate(dxfiles, outfh, validate=False, count_lines=False):
+    '''
+    Concatenated gzip members are a gzip file, so pool the compressed bytes
+    as they download.  If validate, each input is also piped through
+    gzip -t, which checks every member's CRC and length.
+    Returns the line count of each input if count_lines, else Nones.
+    '''
+    line_counts = []
+    for dxf in dxfiles:
+        sinks = [outfh]
+        if validate:
+            checker = Popen(['gzip', '-t'], stdin=PIPE, stderr=PIPE)
+            sinks.append(checker.stdin)
+        try:
+            streamed = common.stream_dxfile(dxf, sinks=sinks, count_lines=count_lines)
+        except IOError:
+            # gzip -t quits at the first bad member, so fall through to its verdict
+            if not validate:
+                raise
+            streamed = {'line_count': None}
+        if validate:
+            checker.stdin.close()
+            err = checker.stderr.read()
+            if checker.wait() != 0:
+                raise IOError("%s is not valid gzip: %s" %(dxf.name, err))
+        print "%s: pooled %s" %(dxf.name, streamed)
+        line_counts.append(streamed['line_count'])
+    return line_counts
+
+def recorded_sort_order(dxfiles):
+    '''The sort order recorded on all of dxfiles if it is one merge_sorted can merge, else None'''
+    sort_orders = set(dxf.get_properties().get('sort_order', 'unknown') for dxf in dxfiles)
+    print "Recorded sort orders: %s" %(sorted(sort_orders))
+    if len(sort_orders) == 1 and list(sort_orders)[0] in MERGEABLE_SORT_ORDERS:
+        return sort_orders.pop()
+    return None
+
+def chromosomes(filename):
+    '''The chromosomes of a gzipped tagAlign/BED file in the order they first appear'''
+    out,err = common.run_dag([
+        {'name': 'gzip', 'command': 'gzip -dc %s' %(filename)},
+        {'name': 'cut', 'input': 'gzip', 'command': 'cut -f1'},
+        {'name': 'uniq', 'input': 'cut', 'command': 'uniq'}])
+    chroms = out['uniq'].split()
+    if len(set(chroms)) != len(chroms):
+        raise ValueError("%s is not sorted by chromosome" %(filename))
+    return chroms
+
+def chromosome_ranks(chrom_lists, sort_order):
+    '''
+    The rank of every chromosome in chrom_lists, each input's chromosomes as
+    they appear, in the order sort_order puts them.  The BAM header that
+    gives coordinate order isn't at hand, so it is pieced together from the
+    inputs, which must not contradict each other.
+    '''
+    if sort_order == MERGE_SORT_ORDER:
+        order = sorted(set(chrom for chroms in chrom_lists for chrom in chroms))
+    else:
+        # take the first chromosome that no input has anything ahead of
+        positions = [dict((chrom, i) for i, chrom in enumerate(chroms)) for chroms in chrom_lists]
+        heads = [0 for chroms in chrom_lists]
+        order = []
+        while True:
+            current = [chroms[head] for chroms, head in zip(chrom_lists, heads) if head < len(chroms)]
+            if not current:
                 break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
+            for chrom in current:
+                if all(position.get(chrom, head) == head for position, head in zip(positions, heads)):
+                    break
+            else:
+                raise ValueError("Inputs have their chromosomes in different orders, from %s" %(sorted(set(current))))
+            order.append(chrom)
+            heads = [head + 1 if head < len(chroms) and chroms[head] == chrom else head
+                     for chroms, head in zip(chrom_lists, heads)]
+    return dict((chrom, rank) for rank, chrom in enumerate(order))
+
+def sorted_tags(fh, name, ranks, sort_order):
+    last = None
+    for line in fh:
+        fields = line.split('\t', 2)
+        if len(fields) < 3:
+            continue
+        key = (ranks[fields[0]], int(fields[1]))
+        if last is not None and key < last:
+            raise ValueError("%s is not sorted %s at %s" %(name, sort_order, line.rstrip()))
+        last = key
+        yield key + (line,)
+
+def merge_sorted_tags(filenames, outfh, sort_order=MERGE_SORT_ORDER):
+    '''k-way merge of gzipped tagAlign/BED files, all sorted sort_order, to outfh, returns the number of lines'''
+    ranks = chromosome_ranks([chromosomes(fn) for fn in filenames], sort_order)
+    tags = [Popen(['gzip', '-dc', fn], stdout=PIPE) for fn in filenames]
+    nlines = 0
+    for rank, start, line in heapq.merge(*[sorted_tags(p.stdout, fn, ranks, sort_order) for p, fn in zip(tags, filenames)]):
+        outfh.write(line)
+        nlines += 1
+    for p, fn in zip(tags, filenames):
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, 'gzip -dc %s' %(fn))
+    return nlines
 
 @dxpy.entry_point('main')
-def main(inputs):
+def main(inputs, validate=False, merge_sorted=False):
 
     # The following line(s) initialize your data object inputs on the platform
     # into dxpy.DXDataObject instances that you can start using immediately.
 
-    input_filenames = []
-    for input_file in inputs:
-        dxf = dxpy.DXFile(input_file)
-        input_filenames.append(dxf.name)
-        dxpy.download_dxfile(dxf.get_id(), dxf.name)
+    input_files = [dxpy.DXFile(input_file) for input_file in inputs]
+    input_filenames = [dxf.name for dxf in input_files]
 
     extension = splitext(splitext(input_filenames[-1])[0])[1] #uses last extension - presumably they are all the same
     pooled_filename = '-'.join([splitext(splitext(fn)[0])[0] for fn in input_filenames]) + "_pooled%s.gz" %(extension)
-    out,err = run_pipe([
-        'gzip -dc %s' %(' '.join(input_filenames)),
-        'gzip -c'],
-        outfile=pooled_filename)
 
-    pooled = dxpy.upload_local_file(pooled_filename)
+    sort_order = None
+    if merge_sorted:
+        sort_order = recorded_sort_order(input_files)
+        if sort_order is None:
+            print "Inputs are not all recorded as sorted the same way, concatenating instead of merging"
+
+    if sort_order:
+        # merge rather than concatenate, so the pool is sorted too
+        for dxf in input_files:
+            common.stream_dxfile(dxf, dxf.name)
+        merged = {}
+        def merge(infh, outfh):
+            merged['nlines'] = merge_sorted_tags(input_filenames, outfh, sort_order)
+        out,err = common.run_dag([
+            {'name': 'merge', 'command': merge},
+            {'name': 'gzip', 'input': 'merge', 'command': common.pgzip, 'outfile': pooled_filename}])
+        pooled_counts = common.record_counts(pooled_filename, merged['nlines'], sort_order=sort_order)
+    else:
+        input_line_counts = [common.recorded_line_count(dxf.name, dxf) for dxf in input_files]
+        # only pay to count lines if we're decompressing to validate anyway
+        count_lines = validate and None in input_line_counts
+        with open(pooled_filename, 'wb') as fh:
+            streamed_line_counts = concatenate(input_files, fh, validate, count_lines)
+        if count_lines:
+            input_line_counts = streamed_line_counts
+        # the pool is as long as its parts, so only record that if all of them were counted
+        if None not in input_line_counts:
+            pooled_counts = common.record_counts(pooled_filename, sum(input_line_counts), sort_order='unsorted')
+        else:
+            pooled_counts = {}
+    pooled = dxpy.upload_local_file(pooled_filename, properties=pooled_counts)
 
     # The following line fills in some basic dummy output and assumes
     # that you have created variables to represent your output with
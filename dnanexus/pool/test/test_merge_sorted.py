@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# pool merge_sorted unit tests
+
+import gzip, imp, os, shutil, sys, tempfile, unittest
+from StringIO import StringIO
+
+import dxpy
+
+src_dir = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(src_dir, "resources", "home", "dnanexus"))
+
+def load_applet():
+    # the applet calls dxpy.run() when it is imported
+    run = dxpy.run
+    dxpy.run = lambda *args, **kwargs: None
+    try:
+        return imp.load_source('pool', os.path.join(src_dir, "src", "pool.py"))
+    finally:
+        dxpy.run = run
+
+pool = load_applet()
+
+class FakeDXFile(object):
+    def __init__(self, properties):
+        self.properties = properties
+
+    def get_properties(self):
+        return self.properties
+
+class TestRecordedSortOrder(unittest.TestCase):
+    def sort_order(self, *sort_orders):
+        return pool.recorded_sort_order([FakeDXFile({'sort_order': s} if s else {}) for s in sort_orders])
+
+    def test_same(self):
+        self.assertEqual(self.sort_order('coordinate', 'coordinate'), 'coordinate')
+        self.assertEqual(self.sort_order('-k1,1 -k2,2n', '-k1,1 -k2,2n'), '-k1,1 -k2,2n')
+
+    def test_disagree(self):
+        self.assertEqual(self.sort_order('coordinate', '-k1,1 -k2,2n'), None)
+
+    def test_unsorted(self):
+        self.assertEqual(self.sort_order('unsorted', 'unsorted'), None)
+        self.assertEqual(self.sort_order('coordinate', None), None)
+
+class TestChromosomeRanks(unittest.TestCase):
+    def test_lexical(self):
+        ranks = pool.chromosome_ranks([['chr1', 'chr10', 'chr2'], ['chr1', 'chr2', 'chrX']], '-k1,1 -k2,2n')
+        self.assertEqual(sorted(ranks, key=ranks.get), ['chr1', 'chr10', 'chr2', 'chrX'])
+
+    def test_header_order(self):
+        # each input has some of the chromosomes, in BAM header order
+        ranks = pool.chromosome_ranks([['chr1', 'chr9', 'chr10', 'chrX'],
+                                       ['chr2', 'chr9', 'chr10', 'chrM'],
+                                       ['chr1', 'chr2', 'chrX', 'chrM']], 'coordinate')
+        self.assertEqual(sorted(ranks, key=ranks.get), ['chr1', 'chr2', 'chr9', 'chr10', 'chrX', 'chrM'])
+
+    def test_contradiction(self):
+        self.assertRaises(ValueError, pool.chromosome_ranks, [['chr1', 'chr2'], ['chr2', 'chr1']], 'coordinate')
+
+class TestMergeSortedTags(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def tag_file(self, name, tags):
+        filename = os.path.join(self.tmpdir, name)
+        with gzip.open(filename, 'wb') as fh:
+            fh.writelines('%s\t%d\t%d\tN\t1000\t+\n' %(chrom, start, start+36) for chrom, start in tags)
+        return filename
+
+    def test_coordinate(self):
+        rep1 = self.tag_file('rep1.tagAlign.gz', [('chr1', 5), ('chr9', 1), ('chr10', 3), ('chr10', 8), ('chrX', 2)])
+        rep2 = self.tag_file('rep2.tagAlign.gz', [('chr2', 4), ('chr9', 1), ('chr9', 7), ('chr10', 5), ('chrM', 1)])
+        outfh = StringIO()
+        self.assertEqual(pool.merge_sorted_tags([rep1, rep2], outfh, 'coordinate'), 10)
+        self.assertEqual([tuple(line.split('\t')[0:2]) for line in outfh.getvalue().splitlines()],
+                         [('chr1', '5'), ('chr2', '4'), ('chr9', '1'), ('chr9', '1'), ('chr9', '7'),
+                          ('chr10', '3'), ('chr10', '5'), ('chr10', '8'), ('chrX', '2'), ('chrM', '1')])
+
+    def test_lexical(self):
+        rep1 = self.tag_file('rep1.tagAlign.gz', [('chr1', 5), ('chr10', 3), ('chr9', 1)])
+        rep2 = self.tag_file('rep2.tagAlign.gz', [('chr10', 1), ('chr2', 4)])
+        outfh = StringIO()
+        self.assertEqual(pool.merge_sorted_tags([rep1, rep2], outfh), 5)
+        self.assertEqual([tuple(line.split('\t')[0:2]) for line in outfh.getvalue().splitlines()],
+                         [('chr1', '5'), ('chr10', '1'), ('chr10', '3'), ('chr2', '4'), ('chr9', '1')])
+
+    def test_unsorted(self):
+        rep1 = self.tag_file('rep1.tagAlign.gz', [('chr1', 5), ('chr1', 3)])
+        rep2 = self.tag_file('rep2.tagAlign.gz', [('chr1', 1)])
+        self.assertRaises(ValueError, pool.merge_sorted_tags, [rep1, rep2], StringIO(), 'coordinate')
+
+if __name__ == '__main__':
+    unittest.main()
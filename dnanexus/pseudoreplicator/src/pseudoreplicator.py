@@ -11,46 +11,60 @@
 # DNAnexus Python Bindings (dxpy) documentation:
 #   http://autodoc.dnanexus.com/bindings/python/current/
 
-import os, subprocess, shlex, time, re, gzip
+import os, subprocess, shlex, time, re, gzip, threading, binascii
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
 import dxpy
-
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
+import common
+
+# each BEDPE line becomes two tagAlign lines
+PE2SE_FORMAT = "%s\t%s\t%s\tN\t1000\t%s\n%s\t%s\t%s\tN\t1000\t%s\n"
+
+def pe2se(line):
+    f = line.split()
+    return PE2SE_FORMAT %(f[0], f[1], f[2], f[8], f[3], f[4], f[5], f[9])
+
+def split_tags(infh, outfhs, ntags, seed, paired_end=False, chunk_bytes=64*1024*1024):
+    '''
+    Deal the ntags lines of infh to the two outfhs in one pass, exactly
+    (ntags+1)/2 of them to the first, chosen uniformly at random from seed.
+    Each chunk takes a hypergeometric share of the first half's remaining
+    places, so memory is bounded by the chunk and input order is kept.
+    Returns the number of input lines written to each.
+    '''
+    import numpy as np
+    rs = np.random.RandomState(seed)
+    remaining = ntags
+    remaining_pr1 = (ntags+1)/2
+    counts = [0, 0]
+    for lines in iter(lambda: infh.readlines(chunk_bytes), []):
+        if not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        k = len(lines)
+        population = max(remaining, k)
+        good = min(remaining_pr1, population)
+        # old numpy rejects a hypergeometric draw with no good or no bad
+        if good == 0:
+            n_pr1 = 0
+        elif good == population:
+            n_pr1 = k
+        else:
+            n_pr1 = rs.hypergeometric(good, population - good, k)
+        to_pr1 = np.zeros(k, dtype=bool)
+        to_pr1[rs.permutation(k)[:n_pr1]] = True
+        remaining -= k
+        remaining_pr1 -= n_pr1
+        lines = np.array(lines, dtype=object)
+        for i, selected in enumerate([lines[to_pr1], lines[~to_pr1]]):
+            if paired_end:
+                outfhs[i].write(''.join([pe2se(line) for line in selected]))
+            else:
+                outfhs[i].write(''.join(selected))
+            counts[i] += len(selected)
+    return counts
 
 @dxpy.entry_point('main')
-def main(input_tags):
+def main(input_tags, seed=None):
 
     # The following line(s) initialize your data object inputs on the platform
     # into dxpy.DXDataObject instances that you can start using immediately.
@@ -92,28 +106,52 @@ def main(input_tags):
     pr_ta_filenames = [input_tags_basename + ".%s.pr1.tagAlign.gz" %(filename_infix),
                        input_tags_filename + ".%s.pr2.tagAlign.gz" %(filename_infix)]
 
+    # record the seed so the split can be reproduced
+    if seed is None:
+        seed = int(binascii.hexlify(os.urandom(4)), 16)
+    print "Pseudoreplicate seed %d" %(seed)
+
     #count lines in the file
-    out,err = run_pipe([
-        'gzip -dc %s' %(input_tags_filename),
-        'wc -l'])
-    #number of lines in each split   
-    nlines = (int(out)+1)/2
-    # Shuffle and split BEDPE file into 2 equal parts
-    splits_prefix = 'temp_split'
-    out,err = run_pipe([
-        'gzip -dc %s' %(input_tags_filename),
-        'shuf',
-        'split -a 2 -d -l %d - %s' %(nlines, splits_prefix)]) # gives two files named splits_prefix0n, n=1,2
-    # Convert read pairs to reads into standard tagAlign file
-    for i,index in enumerate(['00', '01']): #this should be made multi-threaded
-        steps = ['cat %s' %(splits_prefix+index)]
-        if paired_end:
-            steps.extend([r"""awk 'BEGIN{OFS="\t"}{printf "%s\t%s\t%s\tN\t1000\t%s\n%s\t%s\t%s\tN\t1000\t%s\n",$1,$2,$3,$9,$4,$5,$6,$10}'"""])
-        steps.extend(['gzip -c'])
-        out,err = run_pipe(steps, outfile=pr_ta_filenames[i])
-
-    pseudoreplicate1_file = dxpy.upload_local_file(pr_ta_filenames[0])
-    pseudoreplicate2_file = dxpy.upload_local_file(pr_ta_filenames[1])
+    ntags = common.count_lines(input_tags_filename, input_tags_file)
+
+    # Split into 2 equal random halves in one pass, converting read pairs
+    # to reads and compressing both halves as they are written
+    errors = []
+    pr_fhs = []
+    compressors = []
+    for pr_ta_filename in pr_ta_filenames:
+        r, w = os.pipe()
+        t = threading.Thread(target=common.compress_to, args=(os.fdopen(r, 'rb'), pr_ta_filename, max(1, cpu_count()/2), errors))
+        t.start()
+        compressors.append(t)
+        pr_fhs.append(os.fdopen(w, 'wb'))
+    tags = Popen(['gzip', '-dc', input_tags_filename], stdout=PIPE)
+    try:
+        pr_ntags = split_tags(tags.stdout, pr_fhs, ntags, seed, paired_end)
+    finally:
+        for fh in pr_fhs:
+            fh.close()
+        for t in compressors:
+            t.join()
+    if tags.wait() != 0:
+        raise subprocess.CalledProcessError(tags.returncode, 'gzip -dc %s' %(input_tags_filename))
+    if errors:
+        raise errors[0]
+    print "%d and %d of %d tags in the pseudoreplicates" %(pr_ntags[0], pr_ntags[1], ntags)
+
+    # the SE split keeps the input order, PE2SE does not
+    if paired_end:
+        sort_order = 'unsorted'
+    else:
+        sort_order = input_tags_file.get_properties().get('sort_order', 'unknown')
+    lines_per_tag = 2 if paired_end else 1
+    pr_counts = [common.record_counts(fn, n*lines_per_tag, sort_order=sort_order)
+                 for fn, n in zip(pr_ta_filenames, pr_ntags)]
+    for properties in pr_counts:
+        properties.update({'pseudoreplicate_seed': str(seed)})
+
+    pseudoreplicate1_file = dxpy.upload_local_file(pr_ta_filenames[0], properties=pr_counts[0])
+    pseudoreplicate2_file = dxpy.upload_local_file(pr_ta_filenames[1], properties=pr_counts[1])
 
     # Return the outputs.
 
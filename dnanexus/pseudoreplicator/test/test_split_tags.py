@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# pseudoreplicator split_tags unit tests
+
+import imp, os, sys, unittest
+from StringIO import StringIO
+
+import numpy as np
+import dxpy
+
+src_dir = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(src_dir, "resources", "home", "dnanexus"))
+
+def load_applet():
+    # the applet calls dxpy.run() when it is imported
+    run = dxpy.run
+    dxpy.run = lambda *args, **kwargs: None
+    try:
+        return imp.load_source('pseudoreplicator', os.path.join(src_dir, "src", "pseudoreplicator.py"))
+    finally:
+        dxpy.run = run
+
+pseudoreplicator = load_applet()
+
+class OldRandomState(np.random.RandomState):
+    # numpy before 1.7, as installed on the applet's worker, needs at least
+    # one good and one bad item for a hypergeometric draw
+    def hypergeometric(self, ngood, nbad, nsample, size=None):
+        if ngood < 1 or nbad < 1:
+            raise ValueError("ngood < 1 or nbad < 1")
+        return super(OldRandomState, self).hypergeometric(ngood, nbad, nsample, size)
+
+def tag_lines(ntags):
+    return ['chr1\t%d\t%d\tN\t1000\t+\n' %(i, i+36) for i in range(ntags)]
+
+class TestSplitTags(unittest.TestCase):
+    def setUp(self):
+        self.random_state = np.random.RandomState
+        np.random.RandomState = OldRandomState
+
+    def tearDown(self):
+        np.random.RandomState = self.random_state
+
+    def split(self, lines, seed=0, chunk_bytes=64*1024*1024):
+        outfhs = [StringIO(), StringIO()]
+        counts = pseudoreplicator.split_tags(StringIO(''.join(lines)), outfhs, len(lines), seed, chunk_bytes=chunk_bytes)
+        return counts, [fh.getvalue().splitlines(True) for fh in outfhs]
+
+    def assertSplit(self, lines, counts, halves):
+        self.assertEqual(counts, [(len(lines)+1)/2, len(lines)/2])
+        self.assertEqual([len(half) for half in halves], counts)
+        self.assertEqual(sorted(halves[0] + halves[1]), sorted(lines))
+        for half in halves:
+            self.assertEqual(half, [line for line in lines if line in half])
+
+    def test_one_tag(self):
+        # the only tag must go to the first pseudoreplicate
+        lines = tag_lines(1)
+        counts, halves = self.split(lines)
+        self.assertSplit(lines, counts, halves)
+        self.assertEqual(halves[0], lines)
+
+    def test_one_tag_per_chunk(self):
+        # with a line per chunk the first half fills up (no good places
+        # left) or every remaining tag has to go to it (no bad places left)
+        lines = tag_lines(25)
+        for seed in range(50):
+            counts, halves = self.split(lines, seed=seed, chunk_bytes=1)
+            self.assertSplit(lines, counts, halves)
+
+    def test_one_chunk(self):
+        lines = tag_lines(1001)
+        counts, halves = self.split(lines, seed=7)
+        self.assertSplit(lines, counts, halves)
+
+    def test_seed_reproducible(self):
+        lines = tag_lines(500)
+        self.assertEqual(self.split(lines, seed=3, chunk_bytes=1000),
+                         self.split(lines, seed=3, chunk_bytes=1000))
+
+    def test_paired_end(self):
+        lines = ['chr1\t%d\t%d\tchr1\t%d\t%d\tN\t1000\t+\t-\n' %(i, i+36, i+200, i+236) for i in range(11)]
+        outfhs = [StringIO(), StringIO()]
+        counts = pseudoreplicator.split_tags(StringIO(''.join(lines)), outfhs, len(lines), 1, paired_end=True)
+        self.assertEqual(counts, [6, 5])
+        self.assertEqual([len(fh.getvalue().splitlines()) for fh in outfhs], [12, 10])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -97,7 +97,8 @@ def main(experiment, control, xcor_scores_input, npeaks, nodups, bigbed, chrom_s
 
 	n_spp_peaks = common.count_lines(peaks_filename)
 	print "%s peaks called by spp" %(n_spp_peaks)
-	print "%s of those peaks removed due to bad coordinates" %(n_spp_peaks - common.count_lines(fix_coordinate_peaks_filename))
+	n_fixed_peaks = common.count_lines(fix_coordinate_peaks_filename)
+	print "%s of those peaks removed due to bad coordinates" %(n_spp_peaks - n_fixed_peaks)
 	print "First 50 peaks"
 	print subprocess.check_output('head -50 %s' %(fix_coordinate_peaks_filename), shell=True, stderr=subprocess.STDOUT)
 
@@ -115,7 +116,8 @@ def main(experiment, control, xcor_scores_input, npeaks, nodups, bigbed, chrom_s
 	#print subprocess.check_output('head %s' %(final_peaks_filename), shell=True, stderr=subprocess.STDOUT)
 	#print subprocess.check_output('head %s' %(xcor_scores_filename), shell=True, stderr=subprocess.STDOUT)
 
-	peaks = dxpy.upload_local_file(final_peaks_filename)
+	# the peaks returned are the fixed ones either way, so their count is known
+	peaks = dxpy.upload_local_file(final_peaks_filename, properties=common.record_counts(final_peaks_filename, n_fixed_peaks))
 	xcor_plot = dxpy.upload_local_file(xcor_plot_filename)
 	xcor_scores = dxpy.upload_local_file(xcor_scores_filename)
 
@@ -20,6 +20,10 @@ Examples:
     Build and run a workflow, specifying fastq's for two replicates and matched controls, reporting only IDR-processed peaks.
     %(prog)s --rep1 r1.fastq.gz --rep2 r2.fastq.gz --ctl1 c1.fastq.gz --ctl2 c2.fastq.gz --idronly --yes
 
+    As above, running the four IDR comparisons in one job with the experimental in-house IDR v2 scorer rather than the idr package.
+    idr_batch is not built by build_applets_production.sh, so build it into the applets project first.
+    %(prog)s --rep1 r1.fastq.gz --rep2 r2.fastq.gz --ctl1 c1.fastq.gz --ctl2 c2.fastq.gz --idronly --idrbatch --yes
+
     Build and run a workflow, skipping mapping and starting from tagAligns from paired-end data, reporting both naive and IDR-processed peaks.
     %(prog)s --rep1 f1.tagAlign.gz --rep2 r2.tagAlign.gz --ctl1 c1.tagAlign.gz --ctl2 c2.tagAlign.gz --rep1_ended PE --rep2_ended PE --idr --yes
 
@@ -45,6 +49,7 @@ ENCODE_MACS2_APPLET_NAME = 'encode_macs2'
 # IDR_APPLET_NAME='idr'
 IDR2_APPLET_NAME='idr2'
 ENCODE_IDR_APPLET_NAME='encode_idr'
+IDR_BATCH_APPLET_NAME='idr_batch'
 
 APPLETS = {}
 
@@ -77,6 +82,7 @@ def get_args():
     parser.add_argument('--blacklist', help="Blacklist to filter IDR peaks")
     parser.add_argument('--idr',     help='Report peaks with and without IDR analysis',                 default=False, action='store_true')
     parser.add_argument('--idronly',  help='Only report IDR peaks', default=None, action='store_true')
+    parser.add_argument('--idrbatch', help='Experimental: run the four IDR comparisons in one idr_batch job, scored in-house instead of by the idr package and not yet compared with it (idr2_compare.py)', default=False, action='store_true')
     # parser.add_argument('--idrversion', help='Version of IDR to use (1 or 2)', default="2")
     parser.add_argument('--yes',     help='Run the workflow',                   default=False, action='store_true')
 
@@ -333,14 +339,19 @@ def main():
                 )
                 mapping_superstage.update({'filter_qc_stage_id': filter_qc_stage_id})
 
+                xcor_stage_input = {
+                    'input_bam': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'filtered_bam'}),
+                    'paired_end': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'paired_end'})
+                }
+                # filter_qc only has a BEDPE_file for paired-end reads, which
+                # are given as read1,read2
+                if not blank_workflow and len(mapping_superstage['input_args']) == 2:
+                    xcor_stage_input.update({'input_bedpe': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'BEDPE_file'})})
                 xcor_stage_id = workflow.add_stage(
                     xcor_applet,
                     name='Xcor %s' %(superstage_name),
                     folder=xcor_output_folder,
-                    stage_input={
-                        'input_bam': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'filtered_bam'}),
-                        'paired_end': dxpy.dxlink({'stage': filter_qc_stage_id, 'outputField': 'paired_end'})
-                    }
+                    stage_input=xcor_stage_input
                 )
                 mapping_superstage.update({'xcor_stage_id': xcor_stage_id})
 
@@ -483,93 +494,119 @@ def main():
         idr_stages = []
         idr_output_folder = resolve_folder(output_project, output_folder + '/' + idr_applet.name)
         if (args.rep1 and args.ctl1 and args.rep2) or blank_workflow:
-            idr_stage_id = workflow.add_stage(
-                idr_applet,
-                name='IDR True Replicates',
-                folder=idr_output_folder,
-                stage_input={
-                    'rep1_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep1_peaks'}),
-                    'rep2_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep2_peaks'}),
-                    'pooled_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'pooled_peaks'})
-                }
-            )
-            idr_stages.append({'name': 'IDR True Replicates', 'stage_id': idr_stage_id})
+            if args.idrbatch:
+                # all four comparisons in one job that parses each peak file once
+                logging.warning("--idrbatch is experimental: it scores IDR with common.idr2_peaks, which has not been compared with the idr package the idr2 applet runs")
+                idr_batch_applet = find_applet_by_name(IDR_BATCH_APPLET_NAME, applet_project.get_id())
+                idr_batch_stage_id = workflow.add_stage(
+                    idr_batch_applet,
+                    name='IDR Batch',
+                    folder=idr_output_folder,
+                    stage_input=dict(
+                        (peaks, dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': peaks}))
+                        for peaks in ['rep1_peaks', 'rep2_peaks', 'pooled_peaks',
+                                      'rep1pr1_peaks', 'rep1pr2_peaks', 'rep2pr1_peaks', 'rep2pr2_peaks',
+                                      'pooledpr1_peaks', 'pooledpr2_peaks'])
+                )
+                idr_stages.append({'name': 'IDR Batch', 'stage_id': idr_batch_stage_id})
+
+                stage_input = {
+                        'reps_peaks' : dxpy.dxlink({'stage': idr_batch_stage_id, 'outputField': 'reps_IDR_peaks'}),
+                        'r1pr_peaks' : dxpy.dxlink({'stage': idr_batch_stage_id, 'outputField': 'r1pr_IDR_peaks'}),
+                        'r2pr_peaks' : dxpy.dxlink({'stage': idr_batch_stage_id, 'outputField': 'r2pr_IDR_peaks'}),
+                        'pooledpr_peaks': dxpy.dxlink({'stage': idr_batch_stage_id, 'outputField': 'pooledpr_IDR_peaks'}),
+                        'as_file': dxpy.dxlink(resolve_file(args.narrowpeak_as))
+                    }
+            else:
+                idr_stage_id = workflow.add_stage(
+                    idr_applet,
+                    name='IDR True Replicates',
+                    folder=idr_output_folder,
+                    stage_input={
+                        'rep1_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep1_peaks'}),
+                        'rep2_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep2_peaks'}),
+                        'pooled_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'pooled_peaks'})
+                    }
+                )
+                idr_stages.append({'name': 'IDR True Replicates', 'stage_id': idr_stage_id})
 
-            idr_stage_id = workflow.add_stage(
-                idr_applet,
-                name='IDR Rep 1 Self-pseudoreplicates',
-                folder=idr_output_folder,
-                stage_input={
-                    'rep1_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep1pr1_peaks'}),
-                    'rep2_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep1pr2_peaks'}),
-                    'pooled_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep1_peaks'})
-                }
-            )
-            idr_stages.append({'name': 'IDR Rep 1 Self-pseudoreplicates', 'stage_id': idr_stage_id})
+                idr_stage_id = workflow.add_stage(
+                    idr_applet,
+                    name='IDR Rep 1 Self-pseudoreplicates',
+                    folder=idr_output_folder,
+                    stage_input={
+                        'rep1_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep1pr1_peaks'}),
+                        'rep2_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep1pr2_peaks'}),
+                        'pooled_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep1_peaks'})
+                    }
+                )
+                idr_stages.append({'name': 'IDR Rep 1 Self-pseudoreplicates', 'stage_id': idr_stage_id})
 
-            idr_stage_id = workflow.add_stage(
-                idr_applet,
-                name='IDR Rep 2 Self-pseudoreplicates',
-                folder=idr_output_folder,
-                stage_input={
-                    'rep1_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep2pr1_peaks'}),
-                    'rep2_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep2pr2_peaks'}),
-                    'pooled_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep2_peaks'})
-                }
-            )
-            idr_stages.append({'name': 'IDR Rep 2 Self-pseudoreplicates', 'stage_id': idr_stage_id})
+                idr_stage_id = workflow.add_stage(
+                    idr_applet,
+                    name='IDR Rep 2 Self-pseudoreplicates',
+                    folder=idr_output_folder,
+                    stage_input={
+                        'rep1_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep2pr1_peaks'}),
+                        'rep2_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep2pr2_peaks'}),
+                        'pooled_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep2_peaks'})
+                    }
+                )
+                idr_stages.append({'name': 'IDR Rep 2 Self-pseudoreplicates', 'stage_id': idr_stage_id})
 
-            idr_stage_id = workflow.add_stage(
-                idr_applet,
-                name='IDR Pooled Pseudoreplicates',
-                folder=idr_output_folder,
-                stage_input={
-                    'rep1_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'pooledpr1_peaks'}),
-                    'rep2_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'pooledpr2_peaks'}),
-                    'pooled_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'pooled_peaks'})
-                }
-            )
-            idr_stages.append({'name': 'IDR Pooled Pseudoreplicates', 'stage_id': idr_stage_id})
-
-            stage_input = {
-                    'reps_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR True Replicates'),
-                         'outputField': 'IDR_peaks'}),
-                    'r1pr_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Rep 1 Self-pseudoreplicates'),
-                         'outputField': 'IDR_peaks'}),
-                    'r2pr_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Rep 2 Self-pseudoreplicates'),
-                         'outputField': 'IDR_peaks'}),
-                    'pooledpr_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Pooled Pseudoreplicates'),
-                         'outputField': 'IDR_peaks'}),
-                    'as_file': dxpy.dxlink(resolve_file(args.narrowpeak_as))
-                }
+                idr_stage_id = workflow.add_stage(
+                    idr_applet,
+                    name='IDR Pooled Pseudoreplicates',
+                    folder=idr_output_folder,
+                    stage_input={
+                        'rep1_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'pooledpr1_peaks'}),
+                        'rep2_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'pooledpr2_peaks'}),
+                        'pooled_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'pooled_peaks'})
+                    }
+                )
+                idr_stages.append({'name': 'IDR Pooled Pseudoreplicates', 'stage_id': idr_stage_id})
+
+                stage_input = {
+                        'reps_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR True Replicates'),
+                             'outputField': 'IDR_peaks'}),
+                        'r1pr_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Rep 1 Self-pseudoreplicates'),
+                             'outputField': 'IDR_peaks'}),
+                        'r2pr_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Rep 2 Self-pseudoreplicates'),
+                             'outputField': 'IDR_peaks'}),
+                        'pooledpr_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Pooled Pseudoreplicates'),
+                             'outputField': 'IDR_peaks'}),
+                        'as_file': dxpy.dxlink(resolve_file(args.narrowpeak_as))
+                    }
             if blacklist:
                 stage_input.update({'blacklist': blacklist})
             if chrom_sizes:
@@ -11,46 +11,13 @@
 # DNAnexus Python Bindings (dxpy) documentation:
 #   http://autodoc.dnanexus.com/bindings/python/current/
 
-import os, subprocess, shlex, time
-from multiprocessing import Pool, cpu_count
-from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
+import os, subprocess, binascii
+from multiprocessing import cpu_count
 import dxpy
-
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
+import common
 
 @dxpy.entry_point('main')
-def main(input_tagAlign, paired_end):
+def main(input_tagAlign, paired_end, seed=None):
 
     # The following line(s) initialize your data object inputs on the platform
     # into dxpy.DXDataObject instances that you can start using immediately.
@@ -64,9 +31,6 @@ def main(input_tagAlign, paired_end):
     input_tagAlign_basename = input_tagAlign_file.name.rstrip('.gz')
     dxpy.download_dxfile(input_tagAlign_file.get_id(), input_tagAlign_filename)
 
-    uncompressed_TA_filename = input_tagAlign_basename
-    out,err = run_pipe(['gzip -d %s' %(input_tagAlign_filename)])
-
     # if paired_end:
     #     end_infix = 'PE2SE'
     # else:
@@ -105,13 +69,14 @@ def main(input_tagAlign, paired_end):
     else:
         end_infix = 'SE'
     subsampled_TA_filename = input_tagAlign_basename + ".sample.%d.%s.tagAlign.gz" %(NREADS/1000000, end_infix)
-    steps = [
-        'grep -v "chrM" %s' %(uncompressed_TA_filename),
-        'shuf -n %d' %(NREADS)]
-    if paired_end:
-        steps.extend([r"""awk 'BEGIN{OFS="\t"}{$4="N";$5="1000";print $0}'"""])
-    steps.extend(['gzip -c'])
-    out,err = run_pipe(steps,outfile=subsampled_TA_filename)
+    # record the seed so the subsample can be reproduced
+    if seed is None:
+        seed = int(binascii.hexlify(os.urandom(4)), 16)
+    print "Subsample seed %d" %(seed)
+    out,err = common.run_dag([
+        {'name': 'gunzip', 'command': 'gzip -dc %s' %(input_tagAlign_filename)},
+        {'name': 'sample', 'input': 'gunzip',
+         'command': lambda infh, outfh: common.sample_tags(infh, {NREADS: subsampled_TA_filename}, seed, exclude_chroms='chrM')}])
     print subprocess.check_output('ls -l', shell=True)
 
     # Calculate Cross-correlation QC scores
@@ -121,22 +86,11 @@ def main(input_tagAlign, paired_end):
     # CC_SCORE FILE format
     # Filename <tab> numReads <tab> estFragLen <tab> corr_estFragLen <tab> PhantomPeak <tab> corr_phantomPeak <tab> argmin_corr <tab> min_corr <tab> phantomPeakCoef <tab> relPhantomPeakCoef <tab> QualityTag
 
-    #run_spp_command = subprocess.check_output('which run_spp.R', shell=True)
-    spp_tarball = '/phantompeakqualtools/spp_1.10.1.tar.gz'
-    run_spp_command = '/phantompeakqualtools/run_spp_nodups.R'
-    #install spp
-    print subprocess.check_output(shlex.split('R CMD INSTALL %s' %(spp_tarball)))
-    print subprocess.check_output('ls -l', shell=True)
-    out,err = run_pipe([
-        "Rscript %s -c=%s -p=%d -filtchr=chrM -savp=%s -out=%s" \
-            %(run_spp_command, subsampled_TA_filename, cpu_count(), CC_plot_filename, CC_scores_filename)])
+    # the same scores run_spp_nodups.R -filtchr=chrM computed, keeping only the
+    # top fragment length estimate as the sed over its output used to
+    common.strand_xcor(subsampled_TA_filename, CC_scores_filename, CC_plot_filename,
+        exclude_chroms='chrM', threads=cpu_count())
     print subprocess.check_output('ls -l', shell=True)
-    #time.sleep(3600)
-    out,err = run_pipe([
-        r"""sed -r  's/,[^\t]+//g' %s""" %(CC_scores_filename)],
-        outfile="temp")
-    out,err = run_pipe([
-        "mv temp %s" %(CC_scores_filename)])
 
     # tagAlign_file = dxpy.upload_local_file(final_TA_filename)
     # if not paired_end:
@@ -144,7 +98,7 @@ def main(input_tagAlign, paired_end):
     #     subprocess.check_call('touch %s' %(final_BEDPE_filename), shell=True)
     # BEDPE_file = dxpy.upload_local_file(final_BEDPE_filename)
 
-    CC_scores_file = dxpy.upload_local_file(CC_scores_filename)
+    CC_scores_file = dxpy.upload_local_file(CC_scores_filename, properties={'subsample_seed': str(seed)})
     CC_plot_file = dxpy.upload_local_file(CC_plot_filename)
 
     # Return the outputs